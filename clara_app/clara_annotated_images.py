@@ -81,8 +81,15 @@ def add_image_to_text(text_object, image, project_id_internal=None, callback=Non
 def image_to_content_element(image, project_id_internal=None, callback=None):
     # Check if page_object or associated_areas exists
     #print(f'--- Calling image_to_content_element. page_object = {image.page_object}, associated_areas = {image.associated_areas}')
-    width, height = get_image_dimensions(image.image_file_path, callback=callback)
-    thumbnail_width, thumbnail_height = get_image_dimensions(image.thumbnail_file_path, callback=callback)
+    # Use the dimensions cached in the image repository if we have them, to avoid opening the image files
+    if image.width and image.height:
+        width, height = image.width, image.height
+    else:
+        width, height = get_image_dimensions(image.image_file_path, callback=callback)
+    if image.thumbnail_width and image.thumbnail_height:
+        thumbnail_width, thumbnail_height = image.thumbnail_width, image.thumbnail_height
+    else:
+        thumbnail_width, thumbnail_height = get_image_dimensions(image.thumbnail_file_path, callback=callback)
     if not image.page_object or not image.associated_areas:
         transformed_segments = None
     else:
@@ -123,6 +130,10 @@ def image_to_content_element(image, project_id_internal=None, callback=None):
                                       'thumbnail_src': basename(image.thumbnail_file_path),
                                       'thumbnail_width': thumbnail_width,
                                       'thumbnail_height': thumbnail_height,
+                                      'renditions': [ { 'src': basename(rendition['file']),
+                                                        'width': rendition['width'],
+                                                        'format': rendition['format'] }
+                                                      for rendition in image.renditions ],
                                       'transformed_segments': transformed_segments})
     #print(f'--- Produced {result}') 
     return result
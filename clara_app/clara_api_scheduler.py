@@ -0,0 +1,357 @@
+"""
+Rate-limited scheduling of calls to external APIs: OpenAI (chat, vision and DALL-E-3) and the TTS engines.
+
+These calls are made from many separate django-q tasks, and until now each task just sent its requests
+and retried when something went wrong. When several users are active, the tasks between them exceed
+the providers' rate limits, get 429 responses, and retry immediately, which makes things worse.
+
+All calls now go through run_scheduled_api_call, which
+
+- takes a token from a token bucket before sending the request. There is one bucket for each
+  provider, API key and model, so e.g. users with their own OpenAI key don't use up the quota for the
+  C-LARA key, and DALL-E-3 has its own, much lower, limit. Rates are in requests per minute, from the
+  [api_rate_limits] section of config.ini, with entries either for a provider, e.g. "openai", or for
+  a provider and model, e.g. "openai.dall-e-3".
+
+- gives interactive calls priority over bulk ones, e.g. tic-tac-toe experiments, image sequences and TTS
+  for whole texts. A bulk call only gets a token if that leaves [api_scheduler] interactive_reserve of the
+  bucket for interactive calls. Calls are interactive unless config_info contains 'api_priority': 'bulk',
+  or the user is paying with C-LARA credit and has less than low_credit_threshold left, so that users about
+  to run out of credit can't crowd out everyone else.
+
+- retries rate limit errors (429), server errors and timeouts with exponential backoff and jitter, respecting
+  any Retry-After header. The backoff is recorded in the bucket, so all the other calls using it wait as well,
+  instead of each one finding out about the rate limit for itself. Other errors are raised as before, and
+  the callers' own retry loops, which are mostly there for unparseable responses, still apply.
+
+Callers which also limit their own concurrency, e.g. with clara_chatgpt4.AsyncRateLimiter, should take the token
+first with acquire_api_call_token_async, so that they don't hold one of their own slots while waiting for it.
+
+The buckets live in a SQLite database, [api_scheduler] db, on the local disk, and are updated in transactions,
+so the limits are shared by all the worker and web processes on the node, but not between nodes. If C-LARA runs
+on several nodes using the same API keys, the rates in [api_rate_limits] need to be divided between them.
+The database also holds the calls currently waiting for a token and cumulative counts and wait times,
+which api_scheduler_metrics returns.
+"""
+
+from .clara_utils import get_config, absolute_local_file_name, post_task_update
+
+from contextlib import contextmanager
+import asyncio
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+
+config = get_config()
+
+_schema = """
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    n_failures INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS waiting (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucket TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    since REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    bucket TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    n_calls INTEGER NOT NULL,
+    n_retries INTEGER NOT NULL,
+    total_wait REAL NOT NULL,
+    max_wait REAL NOT NULL,
+    PRIMARY KEY ( bucket, priority )
+);
+"""
+
+api_priorities = ( 'interactive', 'bulk' )
+
+# Status codes for errors which may go away if we try again later
+_retryable_status_codes = { 408, 429, 500, 502, 503, 504 }
+
+# Names of the exception classes used by requests, openai and google.api_core for network errors and timeouts
+_retryable_exception_names = { 'ConnectionError', 'ConnectTimeout', 'ReadTimeout', 'Timeout',
+                               'APIConnectionError', 'APITimeoutError', 'DeadlineExceeded', 'ServiceUnavailable' }
+
+# Waiting rows older than this were left behind by processes which died while waiting
+_stale_waiting_seconds = 3600
+
+class APIScheduler:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._schema_created = False
+        self._local = threading.local()
+
+    # Each thread keeps its own connection, since sqlite3 connections can't be shared between threads.
+    # A process forked from this one gets a copy of the thread-local data, so connections are also tagged with the pid.
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        # The directory is on local disk and may not exist yet, e.g. on a freshly started node
+        if not self._schema_created:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        # We manage transactions ourselves, so that we can use BEGIN IMMEDIATE
+        connection = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        if not self._schema_created:
+            connection.executescript(_schema)
+            self._schema_created = True
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    # Take the write lock at the start, so that reading and updating a bucket is atomic across processes
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    # Wait until a token is available in bucket and take it. Return the time waited in seconds.
+    def acquire(self, bucket, priority, requests_per_minute):
+        start_time = time.time()
+        waiting_id = None
+        try:
+            while True:
+                wait, waiting_id = self.try_acquire(bucket, priority, requests_per_minute, start_time, waiting_id)
+                if wait is None:
+                    break
+                time.sleep(jittered_wait(wait))
+        finally:
+            self._stop_waiting(waiting_id)
+        return time.time() - start_time
+
+    # Version of acquire for coroutines, which waits on the event loop instead of holding a thread
+    async def acquire_async(self, bucket, priority, requests_per_minute):
+        start_time = time.time()
+        waiting_id = None
+        try:
+            while True:
+                wait, waiting_id = self.try_acquire(bucket, priority, requests_per_minute, start_time, waiting_id)
+                if wait is None:
+                    break
+                await asyncio.sleep(jittered_wait(wait))
+        finally:
+            self._stop_waiting(waiting_id)
+        return time.time() - start_time
+
+    # Take a token from bucket if one is available, without waiting. Return ( wait, waiting_id ), where wait is None
+    # if we got the token, and otherwise the time until one may be available. The first time we don't get one,
+    # the call is recorded as waiting, and waiting_id is passed back in on the next try.
+    def try_acquire(self, bucket, priority, requests_per_minute, start_time, waiting_id=None):
+        rate = requests_per_minute / 60.0
+        capacity = bucket_capacity(requests_per_minute)
+        needed = 1.0 + ( bucket_reserve(capacity) if priority == 'bulk' else 0.0 )
+        with self._transaction() as connection:
+            now = time.time()
+            tokens, blocked_until, n_failures = self._refilled_bucket(connection, bucket, now, rate, capacity)
+            if now >= blocked_until and tokens >= needed:
+                tokens -= 1.0
+                wait = None
+            else:
+                wait = max(blocked_until - now, ( needed - tokens ) / rate)
+                if waiting_id is None:
+                    waiting_id = connection.execute('INSERT INTO waiting ( bucket, priority, since ) VALUES ( ?, ?, ? )',
+                                                    ( bucket, priority, start_time )).lastrowid
+            connection.execute('INSERT OR REPLACE INTO buckets VALUES ( ?, ?, ?, ?, ? )',
+                               ( bucket, tokens, now, blocked_until, n_failures ))
+        return wait, waiting_id
+
+    def _stop_waiting(self, waiting_id):
+        if waiting_id is not None:
+            with self._transaction() as connection:
+                connection.execute('DELETE FROM waiting WHERE id = ?', ( waiting_id, ))
+
+    def _refilled_bucket(self, connection, bucket, now, rate, capacity):
+        row = connection.execute('SELECT tokens, updated, blocked_until, n_failures FROM buckets WHERE bucket = ?', ( bucket, )).fetchone()
+        if row is None:
+            return capacity, 0.0, 0
+        tokens, updated, blocked_until, n_failures = row
+        return min(capacity, tokens + max(0.0, now - updated) * rate), blocked_until, n_failures
+
+    # Called after a rate limit or transient error. Block the bucket for everyone, with exponential backoff
+    # on the number of consecutive failures, and return the delay.
+    def record_failure(self, bucket, retry_after=None):
+        base_backoff = float(config.get('api_scheduler', 'base_backoff_seconds'))
+        max_backoff = float(config.get('api_scheduler', 'max_backoff_seconds'))
+        with self._transaction() as connection:
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated, blocked_until, n_failures FROM buckets WHERE bucket = ?', ( bucket, )).fetchone()
+            tokens, updated, blocked_until, n_failures = row if row else ( 0.0, now, 0.0, 0 )
+            # "Equal jitter": between half and all of the exponential backoff
+            delay = min(max_backoff, base_backoff * 2 ** n_failures) * random.uniform(0.5, 1.0)
+            if retry_after:
+                delay = max(delay, min(max_backoff, retry_after))
+            connection.execute('INSERT OR REPLACE INTO buckets VALUES ( ?, ?, ?, ?, ? )',
+                               ( bucket, tokens, updated, max(blocked_until, now + delay), n_failures + 1 ))
+        return delay
+
+    # Record a finished call. If it succeeded, the provider is accepting requests again, so reset the backoff.
+    def record_call(self, bucket, priority, wait, n_retries, succeeded):
+        with self._transaction() as connection:
+            if succeeded:
+                connection.execute('UPDATE buckets SET n_failures = 0 WHERE bucket = ? AND n_failures != 0', ( bucket, ))
+            connection.execute("""INSERT INTO stats VALUES ( ?, ?, 1, ?, ?, ? )
+                                  ON CONFLICT ( bucket, priority ) DO UPDATE SET
+                                      n_calls = n_calls + 1,
+                                      n_retries = n_retries + excluded.n_retries,
+                                      total_wait = total_wait + excluded.total_wait,
+                                      max_wait = MAX(max_wait, excluded.max_wait)""",
+                               ( bucket, priority, n_retries, wait, wait ))
+
+    # For each bucket, the calls currently waiting for it and the cumulative stats for each priority
+    def metrics(self):
+        with self._transaction() as connection:
+            now = time.time()
+            connection.execute('DELETE FROM waiting WHERE since < ?', ( now - _stale_waiting_seconds, ))
+            waiting = connection.execute('SELECT bucket, priority, COUNT(*), MIN(since) FROM waiting GROUP BY bucket, priority').fetchall()
+            stats = connection.execute('SELECT bucket, priority, n_calls, n_retries, total_wait, max_wait FROM stats').fetchall()
+            buckets = connection.execute('SELECT bucket, blocked_until, n_failures FROM buckets').fetchall()
+        metrics = { bucket: { 'blocked_for_seconds': max(0.0, blocked_until - now),
+                              'consecutive_failures': n_failures,
+                              'priorities': {} }
+                    for bucket, blocked_until, n_failures in buckets }
+        for bucket, priority, n_calls, n_retries, total_wait, max_wait in stats:
+            metrics.setdefault(bucket, { 'priorities': {} })['priorities'][priority] = \
+                { 'queue_depth': 0, 'longest_current_wait_seconds': 0.0,
+                  'n_calls': n_calls, 'n_retries': n_retries,
+                  'mean_wait_seconds': total_wait / n_calls if n_calls else 0.0, 'max_wait_seconds': max_wait }
+        for bucket, priority, n_waiting, since in waiting:
+            priority_metrics = metrics.setdefault(bucket, { 'priorities': {} })['priorities'].setdefault(priority, {})
+            priority_metrics['queue_depth'] = n_waiting
+            priority_metrics['longest_current_wait_seconds'] = now - since
+        return metrics
+
+# Allow short bursts, but always enough for an interactive call on top of the bulk reserve
+def bucket_capacity(requests_per_minute):
+    burst_seconds = float(config.get('api_scheduler', 'burst_seconds'))
+    return max(2.0, requests_per_minute * burst_seconds / 60.0)
+
+# Jitter, so that processes waiting on the same bucket don't all wake up together
+def jittered_wait(wait):
+    return min(wait, 5.0) * random.uniform(1.0, 1.2)
+
+def bucket_reserve(capacity):
+    return min(float(config.get('api_scheduler', 'interactive_reserve')) * capacity, capacity - 1.0)
+
+_api_scheduler = None
+_api_scheduler_lock = threading.Lock()
+
+def get_api_scheduler():
+    global _api_scheduler
+    with _api_scheduler_lock:
+        if _api_scheduler is None:
+            _api_scheduler = APIScheduler(absolute_local_file_name(config.get('api_scheduler', 'db')))
+        return _api_scheduler
+
+# The key only appears as a hash, so that it isn't stored in the database
+def bucket_name(provider, model, api_key=None):
+    key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12] if api_key else 'default'
+    return f'{provider}/{key_id}/{model}'
+
+def requests_per_minute_for(provider, model):
+    for key in ( f'{provider}.{model}', provider, 'default' ):
+        if config.has_option('api_rate_limits', key):
+            return float(config.get('api_rate_limits', key))
+
+def api_call_priority(config_info=None, priority=None):
+    config_info = config_info if config_info else {}
+    if not priority:
+        priority = config_info.get('api_priority', None) or 'interactive'
+    if not priority in api_priorities:
+        priority = 'interactive'
+    credit = config_info.get('credit', None)
+    own_key = config_info.get('open_ai_api_key', None) not in ( None, '', 'None' )
+    if credit is not None and not own_key and credit < float(config.get('api_scheduler', 'low_credit_threshold')):
+        priority = 'bulk'
+    return priority
+
+# Wait for a token for a call which will be made later with run_scheduled_api_call and the same arguments.
+# Return a copy of config_info which tells run_scheduled_api_call that its first attempt already has a token.
+# The wait is on the event loop, so coroutines waiting for tokens don't use up the executor threads
+# that the calls themselves run in.
+async def acquire_api_call_token_async(provider, model, api_key=None, config_info=None, priority=None):
+    config_info = dict(config_info) if config_info else {}
+    config_info['api_token_wait'] = await get_api_scheduler().acquire_async(bucket_name(provider, model, api_key),
+                                                                            api_call_priority(config_info, priority),
+                                                                            requests_per_minute_for(provider, model))
+    return config_info
+
+# Call function(), which sends one request to provider, when the bucket for provider, model and api_key allows it,
+# retrying rate limit and transient errors. function can either raise an exception or return a response with a status_code.
+def run_scheduled_api_call(provider, model, function, api_key=None, config_info=None, priority=None, callback=None):
+    scheduler = get_api_scheduler()
+    bucket = bucket_name(provider, model, api_key)
+    priority = api_call_priority(config_info, priority)
+    requests_per_minute = requests_per_minute_for(provider, model)
+    max_retries = int(config.get('api_scheduler', 'max_retries'))
+    # A token from acquire_api_call_token_async is only good for one attempt, so take it out of config_info
+    prepaid_wait = config_info.pop('api_token_wait', None) if config_info else None
+    total_wait = 0.0
+    n_retries = 0
+    while True:
+        if prepaid_wait is not None:
+            total_wait += prepaid_wait
+            prepaid_wait = None
+        else:
+            total_wait += scheduler.acquire(bucket, priority, requests_per_minute)
+        try:
+            result = function()
+        except Exception as e:
+            if n_retries >= max_retries or not is_retryable_error(e):
+                scheduler.record_call(bucket, priority, total_wait, n_retries, False)
+                raise
+            description = str(e)
+            retry_after = retry_after_seconds(getattr(e, 'response', None))
+        else:
+            status_code = getattr(result, 'status_code', None)
+            if n_retries >= max_retries or not status_code in _retryable_status_codes:
+                scheduler.record_call(bucket, priority, total_wait, n_retries, not status_code in _retryable_status_codes)
+                return result
+            description = f'status {status_code}'
+            retry_after = retry_after_seconds(result)
+            if hasattr(result, 'close'):
+                result.close()
+        n_retries += 1
+        delay = scheduler.record_failure(bucket, retry_after=retry_after)
+        post_task_update(callback, f'--- {provider} {model} call failed ({description}), retrying in {delay:.1f} secs ({n_retries}/{max_retries})')
+
+def is_retryable_error(e):
+    status_code = error_status_code(e)
+    if status_code is not None:
+        return status_code in _retryable_status_codes
+    return isinstance(e, ( ConnectionError, TimeoutError )) or type(e).__name__ in _retryable_exception_names
+
+# openai errors have status_code, requests errors have response.status_code, and google.api_core errors have code
+def error_status_code(e):
+    for status_code in ( getattr(e, 'status_code', None),
+                         getattr(getattr(e, 'response', None), 'status_code', None),
+                         getattr(e, 'code', None) ):
+        if isinstance(status_code, int):
+            return status_code
+    return None
+
+def retry_after_seconds(response):
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except ( TypeError, ValueError ):
+        return None
+
+def api_scheduler_metrics():
+    return get_api_scheduler().metrics()
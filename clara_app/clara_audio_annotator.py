@@ -17,12 +17,13 @@ It uses the audio repository to store and retrieve audio files.
 from .clara_classes import Text, InternalCLARAError
 #from .clara_utils import _use_orm_repositories
 from .clara_utils import get_config, absolute_local_file_name, basename, make_tmp_file, file_exists, remove_file, read_json_local_file, unzip_file, post_task_update
-from .clara_utils import canonical_word_for_audio, canonical_text_for_audio, remove_duplicates_general, absolute_file_name
+from .clara_utils import canonical_word_for_audio, canonical_text_for_audio, string_has_audio_content, remove_duplicates_general, absolute_file_name
 from .clara_tts_api import get_tts_engine, get_default_voice, get_language_id, create_tts_engine
 #from .clara_audio_repository import AudioRepository
 from .clara_audio_repository_orm import AudioRepositoryORM
 from .clara_ldt import convert_ldt_data_to_mp3
 from .clara_manual_audio_align import process_alignment_metadata
+from .clara_page_audio import page_audio_file_name, page_audio_is_current, build_page_audio_files
 
 import re
 import os
@@ -35,6 +36,8 @@ import regex
 import pprint
 import subprocess
 
+from collections import deque
+
 config = get_config()
 
 class AudioAnnotator:
@@ -135,7 +138,8 @@ class AudioAnnotator:
         self.audio_repository.delete_entries_for_language(self.engine_id, self.language_id, callback=callback)
 
     def annotate_text(self, text_obj, phonetic=False, callback=None):
-        words_data, segments_data = self._get_all_audio_data(text_obj, phonetic=phonetic, callback=callback)
+        audio_table = self._text_audio_table(text_obj, phonetic=phonetic)
+        words_data, segments_data = self._get_all_audio_data(text_obj, phonetic=phonetic, audio_table=audio_table, callback=callback)
         missing_words, missing_segments = self._get_missing_audio(words_data, segments_data, phonetic=phonetic, callback=callback)
 
         if self.audio_type_for_words == 'tts' and self.word_engine_id and missing_words and self.audio_type_for_words == 'tts':
@@ -157,34 +161,38 @@ class AudioAnnotator:
         updated_words_data = words_data + new_words_data
         updated_segments_data = segments_data + new_segments_data
 
+        self._add_file_paths_to_audio_table(audio_table, updated_words_data, updated_segments_data)
+
         if not phonetic: 
-            page_data = self._get_page_audio_data(text_obj, updated_segments_data, phonetic=False, callback=callback)
-            updated_page_data = self._generate_missing_page_audio(page_data, callback=None)
-        else:
-            updated_page_data = []
+            page_data = self._get_page_audio_data(audio_table, callback=callback)
+            self._generate_missing_page_audio(page_data, callback=None)
 
         post_task_update(callback, f"--- All TTS files should be there")
-        self._add_audio_annotations(text_obj, updated_words_data, updated_segments_data, updated_page_data, phonetic=phonetic, callback=callback)
+        self._add_audio_annotations(text_obj, audio_table, phonetic=phonetic, callback=callback)
+
+    # Go through the text once, collecting everything the later stages need, so that they don't have to
+    # compute plain and canonical texts and contexts again. The result is a list with a dict for each page, with keys
+    #   'page', 'text', 'canonical_text' (the last two only if phonetic=False), 'context' and 'segments'
+    # where each item in 'segments' is a dict with keys
+    #   'segment', 'text', 'canonical_text', 'context', 'has_audio' and 'words'
+    # and each item in 'words' is a dict with keys 'element', 'text', 'canonical_text' and 'has_audio'.
+    # _add_file_paths_to_audio_table later adds 'file_path' to the segment and word items.
+    def _text_audio_table(self, text_obj, phonetic=False):
+        audio_table = []
+        rolling_context = RollingContext(self.max_context_length) if self.use_context else None
 
-    def _get_all_audio_data(self, text_obj, phonetic=False, callback=None):
-        post_task_update(callback, f"--- Getting all audio data")
-        words_data = []
-        segments_data = []
-        previous_canonical_text = ''
-        previous_canonical_texts = []
         for page in text_obj.pages:
+            page_item = { 'page': page, 'context': rolling_context.get() if rolling_context else '', 'segments': [] }
+            if not phonetic:
+                page_item['text'] = page.to_text()
+                page_item['canonical_text'] = canonical_text_for_audio(page_item['text'], phonetic=False)
+            audio_table.append(page_item)
+
             for segment in page.segments:
                 segment_text_plain = segment.to_text()
                 segment_text_canonical = canonical_text_for_audio(segment_text_plain, phonetic=phonetic)
-                #print(f'--- _get_all_audio_data: max_context_length = {self.max_context_length}')
-                start_of_context = -1 * self.max_context_length
-                #print(f'--- _get_all_audio_data: start_of_context = {start_of_context}')
-                context = '' if not self.use_context else previous_canonical_text[start_of_context:]
-                if not string_has_no_audio_content(segment_text_canonical):
-                    segments_data.append({ 'text': segment_text_plain, 'canonical_text': segment_text_canonical, 'context': context })
-                    previous_canonical_texts.append(segment_text_canonical)
-                    previous_canonical_text = ' '.join(previous_canonical_texts) 
-                
+                segment_has_audio = string_has_audio_content(segment_text_canonical)
+                words = []
                 for content_element in segment.content_elements:
                     if content_element.type == 'Word':
                         if phonetic and 'phonetic' in content_element.annotations:
@@ -193,10 +201,45 @@ class AudioAnnotator:
                             audio_word_plain = content_element.content
                         else:
                             audio_word_plain = None
-                            
-                        if audio_word_plain and not string_has_no_audio_content(audio_word_plain):
-                            audio_word_canonical = canonical_word_for_audio(audio_word_plain)
-                            words_data.append({ 'text': audio_word_plain, 'canonical_text': audio_word_canonical, 'context': '' })    
+                        word_has_audio = bool(audio_word_plain) and string_has_audio_content(audio_word_plain)
+                        words.append({ 'element': content_element,
+                                       'text': audio_word_plain,
+                                       'canonical_text': canonical_word_for_audio(audio_word_plain) if word_has_audio else None,
+                                       'has_audio': word_has_audio })
+                page_item['segments'].append({ 'segment': segment,
+                                               'text': segment_text_plain,
+                                               'canonical_text': segment_text_canonical,
+                                               'context': rolling_context.get() if rolling_context else '',
+                                               'has_audio': segment_has_audio,
+                                               'words': words })
+                if segment_has_audio and rolling_context:
+                    rolling_context.add(segment_text_canonical)
+
+        return audio_table
+
+    # Add the 'file_path' for each segment and word in the table, as found in segments_data and words_data
+    def _add_file_paths_to_audio_table(self, audio_table, words_data, segments_data):
+        word_cache = { item['text']: item['file_path'] for item in words_data }
+        segment_cache = { ( item['text'], item['context'] ): item['file_path'] for item in segments_data }
+        for page_item in audio_table:
+            for segment_item in page_item['segments']:
+                segment_item['file_path'] = segment_cache.get(( segment_item['text'], segment_item['context'] ), 'placeholder.mp3')
+                for word_item in segment_item['words']:
+                    word_item['file_path'] = word_cache.get(word_item['text'], None) if word_item['text'] else None
+
+    def _get_all_audio_data(self, text_obj, phonetic=False, audio_table=None, callback=None):
+        post_task_update(callback, f"--- Getting all audio data")
+        if audio_table is None:
+            audio_table = self._text_audio_table(text_obj, phonetic=phonetic)
+        words_data = []
+        segments_data = []
+        for page_item in audio_table:
+            for segment_item in page_item['segments']:
+                if segment_item['has_audio']:
+                    segments_data.append({ 'text': segment_item['text'], 'canonical_text': segment_item['canonical_text'], 'context': segment_item['context'] })
+                for word_item in segment_item['words']:
+                    if word_item['has_audio']:
+                        words_data.append({ 'text': word_item['text'], 'canonical_text': word_item['canonical_text'], 'context': '' })
 
         segment_file_paths = self.audio_repository.get_entry_batch(self.segment_engine_id, self.segment_language_id, self.segment_voice_id,
                                                                    segments_data, callback=callback)
@@ -213,46 +256,27 @@ class AudioAnnotator:
         if phonetic:
             segments_data = remove_duplicates_general(segments_data)
 
-        #print(f'--- _get_all_audio_data output: words_data = {words_data}')
-        #print(f'--- _get_all_audio_data output: segments_data = {segments_data}')
-        
         return words_data, segments_data
 
-    def _get_page_audio_data(self, text_obj, segments_data, phonetic=False, callback=None):
+    def _get_page_audio_data(self, audio_table, callback=None):
         post_task_update(callback, f"--- Getting page audio data")
-        segment_cache = { ( item['text'], item['context'] ): item['file_path'] for item in segments_data }
-        
         page_data = []
-        previous_canonical_text = ''
-        previous_canonical_texts = []
-        
-        for page in text_obj.pages:
-            segment_audio_files = []
-            start_of_context = -1 * self.max_context_length
-            page_context = '' if not self.use_context else previous_canonical_text[start_of_context:]
-            for segment in page.segments:
-                segment_text_plain = segment.to_text()
-                segment_text_canonical = canonical_text_for_audio(segment_text_plain, phonetic=phonetic)
-                context = '' if not self.use_context else previous_canonical_text[(-1 * self.max_context_length):]
-                segment_file_path = segment_cache.get((segment_text_plain, context), None)
-                if segment_file_path and not string_has_no_audio_content(segment_text_plain):
-                    segment_audio_files.append(segment_file_path)
-                    previous_canonical_texts.append(segment_text_canonical)
-                    previous_canonical_text = ' '.join(previous_canonical_texts) 
-            
-            page_text = page.to_text()
-            page_text_canonical = canonical_text_for_audio(page_text, phonetic=phonetic)
-            page_audio_file = self.audio_repository.get_entry(self.segment_engine_id, self.segment_language_id, self.segment_voice_id,
-                                                              page_text_canonical, context=page_context, callback=callback)
-            
+        for page_item in audio_table:
+            segment_audio_files = [ segment_item['file_path'] for segment_item in page_item['segments']
+                                    if segment_item['has_audio'] and segment_item['file_path'] and segment_item['file_path'] != 'placeholder.mp3' ]
             page_data.append({
-                'text': page_text,
-                'canonical_text': page_text_canonical,
-                'context': page_context,
+                'text': page_item['text'],
+                'canonical_text': page_item['canonical_text'],
+                'context': page_item['context'],
                 'segment_audio_files': segment_audio_files,
-                'file_path': page_audio_file
+                'file_path': None
             })
-        
+            page_item['audio'] = page_data[-1]
+
+        page_file_paths = self.audio_repository.get_entry_batch(self.segment_engine_id, self.segment_language_id, self.segment_voice_id,
+                                                                page_data, callback=callback)
+        for item in page_data:
+            item['file_path'] = page_file_paths[( item['canonical_text'], item['context'] )]
         return page_data
 
 
@@ -304,14 +328,28 @@ class AudioAnnotator:
         temp_dir = tempfile.mkdtemp()
         text_file_paths = []
 
-        for i, text in enumerate(text_items, 1):
-            canonical_text = canonical_text_for_audio(text, phonetic=phonetic) if words_or_segments == 'segments' else canonical_word_for_audio(text)
-            post_task_update(callback, f"--- Creating mp3 for '{canonical_text}' ({i}/{len(text_items)})")
+        canonical_texts = [ canonical_text_for_audio(text, phonetic=phonetic) if words_or_segments == 'segments' else canonical_word_for_audio(text)
+                            for text in text_items ]
+        temp_files = [ os.path.join(temp_dir, f"{uuid.uuid4()}.mp3") for text in text_items ]
+
+        # If the engine can do it, create the mp3s in a few batch requests rather than one request per item
+        if tts_engine_to_use.supports_batch_synthesis:
             try:
-                unique_filename = f"{uuid.uuid4()}.mp3"
-                temp_file = os.path.join(temp_dir, unique_filename)
+                results = tts_engine_to_use.create_mp3s(language_id_to_use, voice_id_to_use, canonical_texts, temp_files, callback=callback)
+            except Exception as e:
+                post_task_update(callback, f"*** Error creating TTS files: '{str(e)}'\n{traceback.format_exc()}")
+                results = [ False ] * len(text_items)
+        else:
+            results = None
 
-                result = tts_engine_to_use.create_mp3(language_id_to_use, voice_id_to_use, canonical_text, temp_file, callback=callback)
+        for i, ( text, canonical_text, temp_file ) in enumerate(zip(text_items, canonical_texts, temp_files), 1):
+            if results is None:
+                post_task_update(callback, f"--- Creating mp3 for '{canonical_text}' ({i}/{len(text_items)})")
+            try:
+                if results is None:
+                    result = tts_engine_to_use.create_mp3(language_id_to_use, voice_id_to_use, canonical_text, temp_file, callback=callback)
+                else:
+                    result = results[i - 1]
                 if result:
                     file_path = self.audio_repository.store_mp3(engine_id_to_use, language_id_to_use, voice_id_to_use, temp_file, callback=callback)
                     # Context is irrelevant in TTS audio, since it currently can't affect the audio generated
@@ -326,35 +364,46 @@ class AudioAnnotator:
         shutil.rmtree(temp_dir)
         return text_file_paths
 
+    # Page audio is cached under a name made from the ordered list of segment files (see clara_page_audio),
+    # so a page whose segment audio hasn't changed reuses the existing file, and the others are built in parallel
     def _generate_missing_page_audio(self, page_audio_data, callback=None):
         engine_id = self.segment_engine_id
         language_id = self.segment_language_id
         voice_id = self.segment_voice_id
-
+        voice_dir = self.audio_repository.get_voice_directory(engine_id, language_id, voice_id)
+
+        pages_to_update = [ page_data for page_data in page_audio_data
+                            if page_data['segment_audio_files'] and not page_audio_is_current(page_data['file_path'], page_data['segment_audio_files']) ]
+        pages_to_build = []
+        for page_data in pages_to_update:
+            cached_file = os.path.join(voice_dir, page_audio_file_name(page_data['segment_audio_files']))
+            if file_exists(cached_file):
+                self._add_page_audio_entry(page_data, cached_file, callback=callback)
+            else:
+                pages_to_build.append(page_data)
+        if not pages_to_build:
+            return page_audio_data
+
+        post_task_update(callback, f"--- Creating audio for {len(pages_to_build)} pages ({len(pages_to_update) - len(pages_to_build)} found in cache)")
         temp_dir = tempfile.mkdtemp()
-            
-        for page_data in page_audio_data:
-            try:
-                if not page_data['file_path'] and page_data['segment_audio_files']:
-                    canonical_text = page_data['canonical_text']
-                    context = page_data['context']
-                    segment_audio_files = page_data['segment_audio_files']
-                    
-                    unique_mp3_filename = f"{uuid.uuid4()}.mp3"
-                    unique_txt_filename = f"{uuid.uuid4()}.txt"
-                    temp_page_mp3 = os.path.join(temp_dir, unique_mp3_filename)
-                    temp_page_txt = os.path.join(temp_dir, unique_txt_filename)
-                    concatenate_audio_files(segment_audio_files, temp_page_txt, temp_page_mp3)
-                    
-                    file_path = self.audio_repository.store_mp3(engine_id, language_id, voice_id, temp_page_mp3, callback=callback)
-                    self.audio_repository.add_or_update_entry(engine_id, language_id, voice_id, canonical_text, file_path, context=context)
-                    page_data['file_path'] = file_path      
-            except Exception as e:
-                post_task_update(callback, f"*** Error creating page file: '{str(e)}'\n{traceback.format_exc()}")
-
-        shutil.rmtree(temp_dir)
+        try:
+            temp_page_mp3s = build_page_audio_files([ page_data['segment_audio_files'] for page_data in pages_to_build ], temp_dir, callback=callback)
+            for page_data, temp_page_mp3 in zip(pages_to_build, temp_page_mp3s):
+                if temp_page_mp3:
+                    try:
+                        file_path = self.audio_repository.store_mp3(engine_id, language_id, voice_id, temp_page_mp3, keep_file_name=True, callback=callback)
+                        self._add_page_audio_entry(page_data, file_path, callback=callback)
+                    except Exception as e:
+                        post_task_update(callback, f"*** Error creating page file: '{str(e)}'\n{traceback.format_exc()}")
+        finally:
+            shutil.rmtree(temp_dir)
         return page_audio_data
 
+    def _add_page_audio_entry(self, page_data, file_path, callback=None):
+        self.audio_repository.add_or_update_entry(self.segment_engine_id, self.segment_language_id, self.segment_voice_id,
+                                                  page_data['canonical_text'], file_path, context=page_data['context'], callback=callback)
+        page_data['file_path'] = file_path
+
 
     # Process a zipfile received from LiteDevTools. This should contain .wav files and metadata
     def process_lite_dev_tools_zipfile(self, zipfile, callback=None):
@@ -411,8 +460,7 @@ class AudioAnnotator:
         post_task_update(callback, f'--- Calling _store_existing_human_audio_mp3s with {len(metadata)} metadata items and audio dir = {temp_dir}')
         #print(f'--- metadata:')
         #pprint.pprint(metadata)
-        previous_canonical_text = ''
-        previous_canonical_texts = []
+        rolling_context = RollingContext(self.max_context_length)
         #i = 0
          
         for i, metadata_item in enumerate(metadata, 1):
@@ -421,95 +469,72 @@ class AudioAnnotator:
                 text = metadata_item['text']
                 file = metadata_item['file']
                 text_canonical = canonical_text_for_audio(text)
-                start_of_context = -1 * self.max_context_length
-                context = '' if ( not self.use_context or words_or_segments == 'words' ) else previous_canonical_text[start_of_context:]
+                context = '' if ( not self.use_context or words_or_segments == 'words' ) else rolling_context.get()
                 if file:
                     post_task_update(callback, f"--- Adding mp3 to repository for '{text}', ({i}/{len(metadata)})")
                     temp_file = os.path.join(temp_dir, file)
                     file_path = self.audio_repository.store_mp3('human_voice', self.language, self.human_voice_id, temp_file, keep_file_name=False)
                     self.audio_repository.add_or_update_entry('human_voice', self.language, self.human_voice_id, text_canonical, file_path, context=context)
-                    previous_canonical_texts.append(text_canonical)
-                    previous_canonical_text = ' '.join(previous_canonical_texts) 
+                    rolling_context.add(text_canonical)
             except Exception as e:
                 post_task_update(callback, f"*** Error trying to process metadata item {metadata_item}: {str(e)}")
 
-    def _add_audio_annotations(self, text_obj, words_data, segments_data, page_data, phonetic=False, callback=None):
+    # Version of _store_existing_human_audio_mp3s for when the mp3s have already been copied into the repository,
+    # e.g. when importing a zipfile. Each metadata item is a dict with keys 'text' and 'file_path'.
+    def _add_stored_human_audio_entries(self, metadata, words_or_segments='segments', callback=None):
+        post_task_update(callback, f'--- Adding {len(metadata)} stored human audio entries to repository')
+        rolling_context = RollingContext(self.max_context_length)
+
+        for metadata_item in metadata:
+            try:
+                text_canonical = canonical_text_for_audio(metadata_item['text'])
+                context = '' if ( not self.use_context or words_or_segments == 'words' ) else rolling_context.get()
+                if metadata_item['file_path']:
+                    self.audio_repository.add_or_update_entry('human_voice', self.language, self.human_voice_id, text_canonical,
+                                                              metadata_item['file_path'], context=context)
+                    rolling_context.add(text_canonical)
+            except Exception as e:
+                post_task_update(callback, f"*** Error trying to process metadata item {metadata_item}: {str(e)}")
+
+    def _add_audio_annotations(self, text_obj, audio_table, phonetic=False, callback=None):
         post_task_update(callback, f"--- Adding audio annotations to internalised text")
         text_obj.voice = self.printname_for_voice()
 
-        previous_canonical_text = ''
-        previous_canonical_texts = []
-        
-        word_cache = { item['text']: item['file_path'] for item in words_data }
-        segment_cache = { ( item['text'], item['context'] ): item['file_path'] for item in segments_data }
-        page_cache = { ( item['text'], item['context'] ): item['file_path'] for item in page_data }
-        
-        for page in text_obj.pages:
-            if not phonetic:
-                page_text_plain = page.to_text()
-                page_text_canonical = canonical_text_for_audio(page_text_plain, phonetic=False)
-                start_of_context = -1 * self.max_context_length
-                page_context = '' if not self.use_context else previous_canonical_text[start_of_context:]
-
-                if ( page_text_plain, page_context ) in page_cache and page_cache[( page_text_plain, page_context )]:
-                    absolute_page_file_path = absolute_file_name(page_cache[( page_text_plain, page_context )])
-                    #google\en-GB\en-GB-News-J\en-GB-News-J_20240805_033226_a5c481e3-7641-408a-8541-c29e32467e28.mp3"
-                    absolute_page_file_path_components = absolute_page_file_path.split('/')
-                    base_name = absolute_page_file_path_components[-1]
-                    voice_id = absolute_page_file_path_components[-2]
-                    language_id = absolute_page_file_path_components[-3]
-                    engine_id = absolute_page_file_path_components[-4]
-                    page.annotations['tts'] = {
-                        "engine_id": engine_id,
-                        "language_id": language_id,
-                        "voice_id": voice_id,
-                        "file_path": base_name,
-                        }
-            
-            for segment in page.segments:
-                segment_text_plain = segment.to_text()
-                segment_text_canonical = canonical_text_for_audio(segment_text_plain, phonetic=phonetic)
-                context = '' if not self.use_context else previous_canonical_text[(-1 * self.max_context_length):]
-                
-                segment_file_path = segment_cache[( segment_text_plain, context )] if ( segment_text_plain, context ) in segment_cache else 'placeholder.mp3'
-                if segment_file_path and not string_has_no_audio_content(segment_text_plain):
-                    segment.annotations['tts'] = {
+        for page_item in audio_table:
+            page_audio = page_item.get('audio', None)
+            if page_audio and page_audio['file_path']:
+                absolute_page_file_path = absolute_file_name(page_audio['file_path'])
+                #google\en-GB\en-GB-News-J\en-GB-News-J_20240805_033226_a5c481e3-7641-408a-8541-c29e32467e28.mp3"
+                absolute_page_file_path_components = absolute_page_file_path.split('/')
+                base_name = absolute_page_file_path_components[-1]
+                voice_id = absolute_page_file_path_components[-2]
+                language_id = absolute_page_file_path_components[-3]
+                engine_id = absolute_page_file_path_components[-4]
+                page_item['page'].annotations['tts'] = {
+                    "engine_id": engine_id,
+                    "language_id": language_id,
+                    "voice_id": voice_id,
+                    "file_path": base_name,
+                    }
+
+            for segment_item in page_item['segments']:
+                if segment_item['file_path'] and segment_item['has_audio']:
+                    segment_item['segment'].annotations['tts'] = {
                         "engine_id": self.segment_engine_id,
                         "language_id": self.segment_language_id,
                         "voice_id": self.segment_voice_id,
-                        "file_path": segment_file_path,
+                        "file_path": segment_item['file_path'],
                     }
-                if not string_has_no_audio_content(segment_text_plain):
-                    previous_canonical_texts.append(segment_text_canonical)
-                    previous_canonical_text = ' '.join(previous_canonical_texts) 
 
-                for content_element in segment.content_elements:
-                    if content_element.type == 'Word':
-                        if phonetic and 'phonetic' in content_element.annotations:
-                            audio_word = content_element.annotations['phonetic']
-                        elif not phonetic:
-                            audio_word = content_element.content
-                        else:
-                            audio_word = None
-
-                        if not audio_word:
-                            file_path = None
-                        elif phonetic and audio_word == '(silent)':
-                            file_path = None
-                        elif audio_word in word_cache:
-                            file_path = word_cache[audio_word]
-                        else:
-                            file_path = None
-                            
-                        if not string_has_no_audio_content(audio_word):
-                            if not file_path:
-                                file_path = 'placeholder.mp3'
-                            content_element.annotations['tts'] = {
-                                "engine_id": self.word_engine_id,
-                                "language_id": self.word_language_id,
-                                "voice_id": self.word_voice_id,
-                                "file_path": file_path,
-                            }
+                for word_item in segment_item['words']:
+                    if word_item['has_audio']:
+                        file_path = None if phonetic and word_item['text'] == '(silent)' else word_item['file_path']
+                        word_item['element'].annotations['tts'] = {
+                            "engine_id": self.word_engine_id,
+                            "language_id": self.word_language_id,
+                            "voice_id": self.word_voice_id,
+                            "file_path": file_path if file_path else 'placeholder.mp3',
+                        }
         post_task_update(callback, f"--- Audio annotations added to internalised text")
 
     def printname_for_voice(self):
@@ -535,24 +560,25 @@ class AudioAnnotator:
         else:
             return 'No audio voice'
 
+# The last max_length characters of the canonical texts added so far, joined with spaces, as used for audio context.
+# Only the texts needed to make up max_length characters are kept, so adding a text and getting the context
+# take time proportional to max_length rather than to the length of the whole text.
+class RollingContext:
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.texts = deque()
+        # Length of ' '.join(self.texts)
+        self.length = -1
+
+    def add(self, text):
+        self.texts.append(text)
+        self.length += len(text) + 1
+        while len(self.texts) > 1 and self.length - len(self.texts[0]) - 1 >= self.max_length > 0:
+            self.length -= len(self.texts.popleft()) + 1
+
+    def get(self):
+        return ' '.join(self.texts)[-1 * self.max_length:]
+
 # String has no audio content if it's just HTML tags, punctuation marks and separators
 def string_has_no_audio_content(s):
-    s1 = regex.sub(r"<\/?\w+>", '', s)
-    return not s1 or all(regex.match(r"[\p{P} \n|]", c) for c in s1)
-
-def concatenate_audio_files(segment_audio_files, tmp_text_file, output_file):
-    # Create a temporary text file with the list of segment audio files
-    with open(tmp_text_file, 'w') as f:
-        for audio_file in segment_audio_files:
-            f.write(f"file '{audio_file}'\n")
-    
-    # Use ffmpeg to concatenate the audio files
-    command = [
-        'ffmpeg',
-        '-f', 'concat',
-        '-safe', '0',
-        '-i', tmp_text_file,
-        '-c', 'copy',
-        output_file
-    ]
-    subprocess.run(command)
+    return not string_has_audio_content(s)
@@ -0,0 +1,324 @@
+"""
+Local disk cache and warm-up for the audio in rendered content.
+
+Published content is read far more often than it is written, and every click on a word plays an mp3.
+With S3 storage, serving one of these means fetching the whole object from S3 through Django, so clicks
+are slow whenever the file isn't in any cache.
+
+This module provides
+
+- AudioDiskCache: a cache of storage files on the local disk of the web node, in [audio_cache] dir.
+  Files are kept in least-recently-used order, using their mtimes, which are updated on every hit,
+  and the oldest ones are removed when the total size goes over [audio_cache] max_bytes. Since the
+  recency information is on disk, the cache is shared by all the processes on the node.
+  Each process scans the directory in a background thread when it creates the cache, then adds the files
+  it fetches to its running total. It scans again, evicting if necessary, when the total goes over max_bytes
+  or [audio_cache] rescan_seconds have passed, which picks up the files fetched by the other processes.
+
+- Audio manifests: when a text is rendered, StaticHTMLRenderer writes audio_manifest.json next to the pages.
+  For each page, it lists the audio files the page refers to, both as they appear in the HTML and
+  as storage paths.
+
+- warm_up_rendered_audio: fetch all the audio in a manifest into the cache. The cache has to be on the web node,
+  and django-q workers may run on a different node with its own disk, so the web views call
+  warm_up_rendered_audio_in_background when a rendered text is read. The first page view for a text starts
+  fetching all of its audio, so that the clicks after it don't have to wait for S3.
+
+- audio_bundle_for_page: the word and segment audio for one page, base64-encoded, so that the rendered page
+  can fetch the rest of it in one request when the reader first interacts with the page, and play clicks from memory.
+  audio_bundle_etag identifies the bundle's contents, so that browsers can keep it and revalidate it cheaply.
+
+With local file storage the files are already on the local disk, so local_audio_file just returns
+the storage path and warming up does nothing.
+"""
+
+from .clara_utils import _s3_storage, get_config, absolute_file_name, absolute_local_file_name, copy_to_local_file
+from .clara_utils import file_exists, read_json_file, write_json_to_file, post_task_update
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+config = get_config()
+
+_audio_manifest_file_name = 'audio_manifest.json'
+
+class AudioDiskCache:
+    def __init__(self, cache_dir, max_bytes, rescan_seconds):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        # Estimate of the total size: the result of the last scan plus the files fetched since
+        self._total_bytes = 0
+        self._bytes_fetched_during_scan = 0
+        self._scanning = False
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+        self._start_scan()
+
+    # Path in the cache for a storage path. Audio files are never rewritten under the same name,
+    # so there's no need to check whether a cached copy is out of date.
+    def cache_path(self, file_path):
+        digest = hashlib.sha256(absolute_file_name(file_path).encode('utf-8')).hexdigest()
+        extension = os.path.splitext(str(file_path))[1]
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}{extension}')
+
+    # Return a local file with the contents of file_path, fetching it if necessary
+    def get(self, file_path):
+        cache_path = self.cache_path(file_path)
+        try:
+            # Mark it as recently used
+            os.utime(cache_path)
+            return cache_path
+        except FileNotFoundError:
+            pass
+        self._fetch(file_path, cache_path)
+        return cache_path
+
+    def contains(self, file_path):
+        return os.path.isfile(self.cache_path(file_path))
+
+    def _fetch(self, file_path, cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Download to a temporary file and rename, so that other processes never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.part')
+        os.close(fd)
+        try:
+            copy_to_local_file(file_path, temp_path)
+            os.replace(temp_path, cache_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        size = os.path.getsize(cache_path)
+        with self._lock:
+            self._total_bytes += size
+            if self._scanning:
+                self._bytes_fetched_during_scan += size
+            scan_due = self._total_bytes > self.max_bytes or time.time() - self._last_scan > self.rescan_seconds
+        if scan_due:
+            self._start_scan()
+
+    # Walking the directory can take a while for a large cache, so it's done in a background thread
+    # rather than by the request which notices that it's needed
+    def _start_scan(self):
+        with self._lock:
+            if self._scanning:
+                return
+            self._scanning = True
+            self._bytes_fetched_during_scan = 0
+            self._last_scan = time.time()
+        threading.Thread(target=self._scan_and_evict, daemon=True).start()
+
+    def _scan_and_evict(self):
+        try:
+            total_bytes = self._evict()
+            with self._lock:
+                # Files fetched during the scan may also have been counted by it, which just makes eviction a bit early
+                self._total_bytes = total_bytes + self._bytes_fetched_during_scan
+        except Exception as e:
+            print(f'*** Error when scanning audio cache {self.cache_dir}: {str(e)}\n{traceback.format_exc()}')
+        finally:
+            with self._lock:
+                self._scanning = False
+
+    # Remove the least recently used files until the cache is down to 90% of max_bytes. Return the resulting size.
+    def _evict(self):
+        entries = []
+        for directory, _subdirectories, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append(( stat.st_mtime, stat.st_size, path ))
+        total_bytes = sum(size for _mtime, size, _path in entries)
+        if total_bytes > self.max_bytes:
+            target_bytes = int(0.9 * self.max_bytes)
+            for _mtime, size, path in sorted(entries):
+                if total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total_bytes -= size
+                except FileNotFoundError:
+                    pass
+        return total_bytes
+
+_audio_disk_cache = None
+_audio_disk_cache_lock = threading.Lock()
+
+def get_audio_disk_cache():
+    global _audio_disk_cache
+    with _audio_disk_cache_lock:
+        if _audio_disk_cache is None:
+            _audio_disk_cache = AudioDiskCache(absolute_local_file_name(config.get('audio_cache', 'dir')),
+                                               int(config.get('audio_cache', 'max_bytes')),
+                                               float(config.get('audio_cache', 'rescan_seconds')))
+        return _audio_disk_cache
+
+# Return a local file with the contents of the storage file file_path
+def local_audio_file(file_path):
+    if _s3_storage:
+        return get_audio_disk_cache().get(file_path)
+    else:
+        return absolute_file_name(file_path)
+
+# -----------------------------------------
+# Manifests
+
+def audio_manifest_path(output_dir):
+    return Path(output_dir) / _audio_manifest_file_name
+
+# For each page, a dict with 'page': the storage path of the page audio or None, and 'items': a list of dicts
+# with 'src', the audio file as it appears in a data-audio or data-segment-audio attribute in the HTML,
+# and 'file', its storage path
+def make_audio_manifest(text, output_dir, audio_base_dir):
+    pages = []
+    for page in text.pages:
+        items = {}
+        add_segment_audio_to_manifest_items(page.segments, output_dir, items)
+        page_tts = page.annotations.get('tts', None)
+        if page_tts and page_tts.get('file_path', None):
+            page_file = absolute_file_name(Path(audio_base_dir) / page_tts['engine_id'] / page_tts['language_id'] / page_tts['voice_id'] / page_tts['file_path'])
+        else:
+            page_file = None
+        pages.append({ 'page': page_file, 'items': [ { 'src': src, 'file': file } for src, file in items.items() ] })
+    return { 'pages': pages }
+
+def add_segment_audio_to_manifest_items(segments, output_dir, items):
+    if not segments:
+        return
+    for segment in segments:
+        add_audio_src_to_manifest_items(segment.annotations.get('tts', None), output_dir, items)
+        for element in segment.content_elements:
+            if element.type == 'Word':
+                add_audio_src_to_manifest_items(element.annotations.get('tts', None), output_dir, items)
+            elif element.type == 'Image' and isinstance(element.content, dict):
+                add_segment_audio_to_manifest_items(element.content.get('transformed_segments', None), output_dir, items)
+
+def add_audio_src_to_manifest_items(tts_annotation, output_dir, items):
+    if not tts_annotation:
+        return
+    src = tts_annotation.get('file_path', None)
+    if not src or src == 'placeholder.mp3' or src in items:
+        return
+    # Self-contained rendering refers to copies in the multimedia directory, otherwise the paths are in the audio repository
+    if src.startswith('./'):
+        items[src] = absolute_file_name(Path(output_dir) / src[2:])
+    else:
+        items[src] = absolute_file_name(src)
+
+def write_audio_manifest(manifest, output_dir):
+    write_json_to_file(manifest, audio_manifest_path(output_dir))
+
+def read_audio_manifest(output_dir):
+    manifest_path = audio_manifest_path(output_dir)
+    return read_json_file(manifest_path) if file_exists(manifest_path) else None
+
+# -----------------------------------------
+# Warm-up and bundles
+
+# Fetch all the audio in the manifest for output_dir into the local disk cache. Return the number of files fetched.
+def warm_up_rendered_audio(output_dir, callback=None):
+    if not _s3_storage:
+        return 0
+    manifest = read_audio_manifest(output_dir)
+    if not manifest:
+        post_task_update(callback, f'--- No audio manifest in {output_dir}, not warming up audio cache')
+        return 0
+
+    cache = get_audio_disk_cache()
+    file_paths = []
+    for page in manifest['pages']:
+        file_paths += [ item['file'] for item in page['items'] ]
+        if page['page']:
+            file_paths.append(page['page'])
+    file_paths = [ file_path for file_path in dict.fromkeys(file_paths) if not cache.contains(file_path) ]
+    if not file_paths:
+        return 0
+
+    post_task_update(callback, f'--- Warming up audio cache with {len(file_paths)} files')
+    max_workers = int(config.get('audio_cache', 'warm_up_workers'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(cache.get, file_path) for file_path in file_paths ]
+    n_errors = 0
+    for file_path, future in zip(file_paths, futures):
+        if future.exception():
+            n_errors += 1
+            post_task_update(callback, f'*** Warning: unable to cache audio file {file_path}: "{str(future.exception())}"')
+    post_task_update(callback, f'--- Audio cache warmed up, {len(file_paths) - n_errors}/{len(file_paths)} files fetched')
+    return len(file_paths) - n_errors
+
+def warm_up_rendered_audio_task(output_dir, callback=None):
+    try:
+        warm_up_rendered_audio(output_dir, callback=callback)
+    except Exception as e:
+        post_task_update(callback, f'*** Warning: error when warming up audio cache for {output_dir}: "{str(e)}"\n{traceback.format_exc()}')
+
+# output_dir -> time of the last warm-up started for it in this process
+_warm_up_times = {}
+_warm_up_lock = threading.Lock()
+_warm_up_executor = None
+
+# Called by the views serving a rendered text. Start warming up the audio for output_dir in a background thread,
+# unless this process has already done so in the last [audio_cache] warm_up_recheck_seconds.
+# Files which are already in the cache aren't fetched again, so rechecking after a text is re-rendered is cheap.
+def warm_up_rendered_audio_in_background(output_dir):
+    global _warm_up_executor
+    if not _s3_storage:
+        return
+    recheck_seconds = float(config.get('audio_cache', 'warm_up_recheck_seconds'))
+    output_dir = str(output_dir)
+    now = time.time()
+    with _warm_up_lock:
+        if now - _warm_up_times.get(output_dir, 0.0) < recheck_seconds:
+            return
+        _warm_up_times[output_dir] = now
+        if _warm_up_executor is None:
+            # Each warm-up fetches files with warm_up_workers threads, so only run a couple at once
+            _warm_up_executor = ThreadPoolExecutor(max_workers=2)
+    _warm_up_executor.submit(warm_up_rendered_audio_task, output_dir)
+
+# Return the manifest entry for page page_number (counting from 1), or None if there is no manifest or no such page
+def audio_manifest_page(output_dir, page_number):
+    manifest = read_audio_manifest(output_dir)
+    if not manifest or not 1 <= page_number <= len(manifest['pages']):
+        return None
+    return manifest['pages'][page_number - 1]
+
+# Audio files are never rewritten under the same name, so the bundle for a page is determined by its manifest entry
+def audio_bundle_etag(manifest_page):
+    max_bundle_bytes = config.get('audio_cache', 'max_bundle_bytes')
+    items = json.dumps(manifest_page['items'], sort_keys=True)
+    return '"' + hashlib.sha256(f'{max_bundle_bytes}\n{items}'.encode('utf-8')).hexdigest()[:32] + '"'
+
+# Return a dict mapping the audio srcs in manifest_page to base64-encoded contents,
+# up to [audio_cache] max_bundle_bytes in total
+def audio_bundle_for_page(manifest_page):
+    max_bundle_bytes = int(config.get('audio_cache', 'max_bundle_bytes'))
+    bundle = {}
+    total_bytes = 0
+    for item in manifest_page['items']:
+        try:
+            local_file = local_audio_file(item['file'])
+            size = os.path.getsize(local_file)
+            if total_bytes + size > max_bundle_bytes:
+                # The page will fetch the rest one at a time, as before
+                break
+            with open(local_file, 'rb') as f:
+                bundle[item['src']] = base64.b64encode(f.read()).decode('ascii')
+            total_bytes += size
+        except Exception:
+            continue
+    return bundle
@@ -0,0 +1,275 @@
+"""
+Maintenance of the files under AudioRepositoryORM.base_dir.
+
+The audio repository accumulates files which are no longer needed. store_mp3 always creates a new file,
+and add_or_update_entry repoints an AudioMetadata row to it without removing the file it pointed to before,
+so the same audio is often stored several times and some files are no longer referenced by any row.
+
+scan_audio_repository walks the repository and
+
+- fingerprints every file with SHA-256, hashing it in chunks so that large files are never read into memory at once
+- finds groups of identical files, and if dedup is True, replaces all but one file in each group with hard links
+  to the remaining one. The AudioMetadata rows don't need to change, since every path still works. This relies on
+  files in the repository never being rewritten in place, which they aren't: new audio always goes in a new file.
+- finds orphans, i.e. files with no AudioMetadata row, and if delete_orphans is True, deletes the ones older than
+  min_orphan_age_hours. The age limit is there because store_mp3 creates the file before the row is added.
+- finds AudioMetadata rows whose file is missing, and if delete_missing_entries is True, deletes them
+- counts empty files, e.g. from TTS calls that failed part way through
+- reports the number of files and the space used for each engine, language and voice
+
+The fingerprints are kept in a SQLite database outside the repository, AudioFingerprintIndex. A file is only
+rehashed if its size or mtime has changed since the last scan, and the files in a directory are only restatted
+if the directory's mtime has changed, i.e. files have been added, removed or renamed. After the first scan,
+a nightly run on a large repository therefore does little more than list the directories.
+
+run_audio_repository_maintenance takes its options from the [audio_repository] section of config.ini and
+writes the report as JSON. It can be run with async_task, or every night with a django-q schedule, e.g.
+
+Schedule.objects.create(func='clara_app.clara_audio_repository_maintenance.run_audio_repository_maintenance',
+                        schedule_type=Schedule.DAILY)
+
+Only local file storage is supported, since hard links and mtimes don't mean anything on S3.
+"""
+
+from .clara_utils import _s3_storage, get_config, absolute_local_file_name, post_task_update, write_json_to_file
+
+from .models import AudioMetadata
+
+from contextlib import closing
+import hashlib
+import os
+import sqlite3
+import time
+
+config = get_config()
+
+_hash_chunk_size = 1024 * 1024
+
+_delete_chunk_size = 500
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_directory ON files ( directory );
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+file_columns = ( 'path', 'directory', 'size', 'mtime_ns', 'device', 'inode', 'sha256' )
+
+class AudioFingerprintIndex:
+    def __init__(self, db_file):
+        self.db_file = db_file
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        connection = sqlite3.connect(self.db_file)
+        connection.executescript(_schema)
+        return connection
+
+    # Return ( files, directories ), where files maps each path to a dict with the file_columns
+    # and directories maps each directory to its mtime at the last scan
+    def load(self):
+        with closing(self._connect()) as connection:
+            files = { row[0]: dict(zip(file_columns, row))
+                      for row in connection.execute(f'SELECT {", ".join(file_columns)} FROM files') }
+            directories = dict(connection.execute('SELECT path, mtime_ns FROM directories'))
+        return files, directories
+
+    def save(self, files, directories):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM files')
+            connection.execute('DELETE FROM directories')
+            connection.executemany(f'INSERT INTO files ( {", ".join(file_columns)} ) VALUES ( {", ".join("?" for column in file_columns)} )',
+                                   ( tuple(row[column] for column in file_columns) for row in files.values() ))
+            connection.executemany('INSERT INTO directories ( path, mtime_ns ) VALUES ( ?, ? )', directories.items())
+
+def run_audio_repository_maintenance(callback=None):
+    from .clara_audio_repository_orm import AudioRepositoryORM
+
+    if _s3_storage:
+        post_task_update(callback, f'*** Warning: audio repository maintenance is only supported for local file storage')
+        return None
+    report = scan_audio_repository(AudioRepositoryORM().base_dir,
+                                   absolute_local_file_name(config.get('audio_repository', 'fingerprint_db')),
+                                   dedup=config.getboolean('audio_repository', 'dedup_by_hard_linking'),
+                                   delete_orphans=config.getboolean('audio_repository', 'delete_orphans'),
+                                   delete_missing_entries=config.getboolean('audio_repository', 'delete_missing_entries'),
+                                   min_orphan_age_hours=float(config.get('audio_repository', 'min_orphan_age_hours')),
+                                   callback=callback)
+    write_json_to_file(report, config.get('audio_repository', 'maintenance_report'))
+    return report
+
+def scan_audio_repository(base_dir, fingerprint_db, dedup=True, delete_orphans=False, delete_missing_entries=False,
+                          min_orphan_age_hours=24, callback=None):
+    base_dir = absolute_local_file_name(base_dir)
+    index = AudioFingerprintIndex(fingerprint_db)
+    old_files, old_directories = index.load()
+
+    files, directories, n_hashed = fingerprint_files(base_dir, old_files, old_directories)
+    post_task_update(callback, f'--- Scanned {len(files)} files in {len(directories)} directories, {n_hashed} new or changed files hashed')
+
+    duplicate_groups = find_duplicate_groups(files)
+    n_linked, bytes_reclaimed = 0, 0
+    if dedup and duplicate_groups:
+        n_linked, bytes_reclaimed = hard_link_duplicates(duplicate_groups, files, directories, callback=callback)
+        post_task_update(callback, f'--- Replaced {n_linked} duplicate files with hard links, reclaiming {bytes_reclaimed} bytes')
+
+    # Only local paths under base_dir can be compared with the scanned files
+    referenced = set()
+    missing_entry_ids = []
+    for entry_id, file_path in AudioMetadata.objects.values_list('id', 'file_path').iterator():
+        path = absolute_local_file_name(file_path)
+        if path in files:
+            referenced.add(path)
+        elif not os.path.isfile(path):
+            missing_entry_ids.append(entry_id)
+    post_task_update(callback, f'--- {len(missing_entry_ids)} audio metadata entries refer to missing files')
+    if delete_missing_entries and missing_entry_ids:
+        # Delete in chunks to stay under the database's limit on query parameters
+        for start in range(0, len(missing_entry_ids), _delete_chunk_size):
+            AudioMetadata.objects.filter(id__in=missing_entry_ids[start:start + _delete_chunk_size]).delete()
+        post_task_update(callback, f'--- Deleted {len(missing_entry_ids)} audio metadata entries for missing files')
+
+    orphans = [ path for path in files if not path in referenced ]
+    post_task_update(callback, f'--- {len(orphans)} files have no audio metadata entry')
+    n_orphans_deleted = 0
+    if delete_orphans and orphans:
+        cutoff_ns = time.time_ns() - int(min_orphan_age_hours * 3600 * 1e9)
+        for path in orphans:
+            if files[path]['mtime_ns'] < cutoff_ns:
+                os.remove(path)
+                del files[path]
+                n_orphans_deleted += 1
+        post_task_update(callback, f'--- Deleted {n_orphans_deleted} orphan files older than {min_orphan_age_hours} hours')
+    # Deleting files changes the directory mtimes, so the directories will be restatted next time
+    index.save(files, directories)
+
+    return { 'base_dir': base_dir,
+             'n_files': len(files),
+             'n_hashed': n_hashed,
+             'n_duplicate_groups': len(duplicate_groups),
+             'n_linked': n_linked,
+             'bytes_reclaimed': bytes_reclaimed,
+             'n_empty_files': sum(1 for row in files.values() if row['size'] == 0),
+             'n_orphans': len(orphans),
+             'n_orphans_deleted': n_orphans_deleted,
+             'n_missing_entries': len(missing_entry_ids),
+             'n_missing_entries_deleted': len(missing_entry_ids) if delete_missing_entries else 0,
+             'voices': usage_by_voice(base_dir, files, set(orphans)) }
+
+# Walk base_dir, reusing the fingerprints in old_files for directories and files that haven't changed.
+# Return ( files, directories, number of files hashed ).
+def fingerprint_files(base_dir, old_files, old_directories):
+    old_files_by_directory = {}
+    for row in old_files.values():
+        old_files_by_directory.setdefault(row['directory'], []).append(row)
+
+    files = {}
+    directories = {}
+    n_hashed = 0
+    for directory, _subdirectories, file_names in os.walk(base_dir):
+        directory = absolute_local_file_name(directory)
+        directory_mtime_ns = os.stat(directory).st_mtime_ns
+        directories[directory] = directory_mtime_ns
+        if old_directories.get(directory, None) == directory_mtime_ns:
+            for row in old_files_by_directory.get(directory, []):
+                files[row['path']] = row
+            continue
+        for file_name in file_names:
+            path = f'{directory}/{file_name}'
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            old_row = old_files.get(path, None)
+            if old_row and old_row['size'] == stat.st_size and old_row['mtime_ns'] == stat.st_mtime_ns:
+                sha256 = old_row['sha256']
+            else:
+                sha256 = file_sha256(path)
+                n_hashed += 1
+            files[path] = { 'path': path, 'directory': directory, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                            'device': stat.st_dev, 'inode': stat.st_ino, 'sha256': sha256 }
+    return files, directories, n_hashed
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_hash_chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Groups of paths with the same content which aren't all hard links to the same file, biggest savings first.
+# Empty files are left alone.
+def find_duplicate_groups(files):
+    by_content = {}
+    for row in files.values():
+        if row['size'] > 0:
+            by_content.setdefault(( row['size'], row['sha256'] ), []).append(row['path'])
+    groups = [ sorted(paths) for paths in by_content.values()
+               if len(set( ( files[path]['device'], files[path]['inode'] ) for path in paths )) > 1 ]
+    return sorted(groups, key=lambda paths: -files[paths[0]]['size'] * ( len(paths) - 1 ))
+
+# In each group, link every file to the first one on the same device.
+# Both files are hashed again first, in case the fingerprints are out of date.
+# Return ( number of files replaced, number of bytes freed ).
+def hard_link_duplicates(duplicate_groups, files, directories, callback=None):
+    n_linked = 0
+    bytes_reclaimed = 0
+    for paths in duplicate_groups:
+        kept_by_device = {}
+        verified = set()
+        for path in paths:
+            row = files[path]
+            kept = kept_by_device.setdefault(row['device'], row)
+            if kept is row or row['inode'] == kept['inode']:
+                continue
+            try:
+                for checked_row in ( kept, row ):
+                    if not checked_row['path'] in verified:
+                        if file_sha256(checked_row['path']) != checked_row['sha256']:
+                            raise OSError('contents have changed since the file was fingerprinted')
+                        verified.add(checked_row['path'])
+                temp_path = f'{path}.dedup'
+                os.link(kept['path'], temp_path)
+                os.replace(temp_path, path)
+            except OSError as e:
+                post_task_update(callback, f'*** Warning: unable to replace {path} with a hard link to {kept["path"]}: "{str(e)}"')
+                continue
+            # The old file is only freed if nothing else linked to it
+            if not any( other['inode'] == row['inode'] and other['device'] == row['device'] for other in
+                        ( files[other_path] for other_path in paths if other_path != path ) ):
+                bytes_reclaimed += row['size']
+            row.update(mtime_ns=kept['mtime_ns'], inode=kept['inode'])
+            n_linked += 1
+    # Replacing files changed the directory mtimes
+    for directory in set( files[path]['directory'] for paths in duplicate_groups for path in paths ):
+        directories[directory] = os.stat(directory).st_mtime_ns
+    return n_linked, bytes_reclaimed
+
+# For each engine/language/voice directory, the number of files, the space they use, counting each set
+# of hard links once, and the number and size of the orphans
+def usage_by_voice(base_dir, files, orphans):
+    usage = {}
+    seen_inodes = set()
+    for path, row in sorted(files.items()):
+        voice = '/'.join(os.path.relpath(row['directory'], base_dir).replace('\\', '/').split('/')[:3])
+        voice_usage = usage.setdefault(voice, { 'n_files': 0, 'bytes': 0, 'n_orphans': 0, 'orphan_bytes': 0 })
+        voice_usage['n_files'] += 1
+        inode_key = ( row['device'], row['inode'] )
+        if not inode_key in seen_inodes:
+            seen_inodes.add(inode_key)
+            voice_usage['bytes'] += row['size']
+        if path in orphans:
+            voice_usage['n_orphans'] += 1
+            voice_usage['orphan_bytes'] += row['size']
+    return usage
@@ -0,0 +1,104 @@
+"""
+Splitting and converting audio files with ffmpeg, for manual audio/text alignment and LiteDevTools import.
+
+Cutting one segment at a time with "ffmpeg -i file -ss start" means ffmpeg decodes the file from the beginning
+up to each offset, so the cost grows quadratically with the length of the recording. split_audio_file instead
+decodes the source once and uses ffmpeg's segment muxer to write every piece in a single pass.
+
+The segment muxer produces contiguous pieces, which is what alignment metadata made from Audacity labels
+looks like: each segment ends where the next one starts. Intervals which don't correspond to a single piece,
+e.g. because they overlap, are cut separately, seeking in the input so that only the interval itself is decoded.
+
+Independent ffmpeg jobs, e.g. converting a directory of LDT .wav files, are run in parallel, up to
+max_parallel_ffmpeg_jobs at a time.
+"""
+
+from .clara_utils import get_config, post_task_update, make_local_directory, local_directory_exists
+from .clara_classes import InternalCLARAError
+
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+config = get_config()
+
+# Split audio_file into pieces, where the piece for intervals[i] = ( start_time, end_time ) is written to output_files[i].
+def split_audio_file(audio_file, intervals, output_files, callback=None):
+    if not intervals:
+        return
+    output_dir = os.path.dirname(output_files[0]) or '.'
+    if not local_directory_exists(output_dir):
+        make_local_directory(output_dir)
+
+    # Times which differ only by floating point rounding are the same cut point
+    intervals = [ ( round(start_time, 3), round(end_time, 3) ) for start_time, end_time in intervals ]
+    cut_points = sorted(set( time for interval in intervals for time in interval if time > 0 ))
+    # Piece k runs from piece_starts[k] to piece_starts[k + 1]
+    piece_starts = [ 0.0 ] + cut_points
+    piece_index = { start: index for index, start in enumerate(piece_starts) }
+
+    pieces_for_intervals = {}
+    separate_intervals = []
+    for i, ( start_time, end_time ) in enumerate(intervals):
+        index = piece_index.get(start_time if start_time > 0 else 0.0, None)
+        if end_time > start_time and index is not None and index + 1 < len(piece_starts) and piece_starts[index + 1] == end_time:
+            pieces_for_intervals[i] = index
+        else:
+            separate_intervals.append(i)
+
+    if pieces_for_intervals:
+        pieces_dir = tempfile.mkdtemp(dir=output_dir)
+        try:
+            cmd = [ 'ffmpeg', '-y', '-loglevel', 'error',
+                    '-i', audio_file,
+                    '-map', '0:a',
+                    '-q:a', '0',  # Best quality
+                    '-f', 'segment',
+                    '-segment_times', ','.join(f'{time:.6f}' for time in cut_points),
+                    '-reset_timestamps', '1',
+                    os.path.join(pieces_dir, 'piece_%06d.mp3') ]
+            run_ffmpeg(cmd, f'split {audio_file} into {len(piece_starts)} pieces')
+            for i, index in pieces_for_intervals.items():
+                os.replace(os.path.join(pieces_dir, f'piece_{index:06d}.mp3'), output_files[i])
+        finally:
+            shutil.rmtree(pieces_dir, ignore_errors=True)
+        post_task_update(callback, f'--- Split {audio_file} into {len(pieces_for_intervals)} segments in one pass')
+
+    if separate_intervals:
+        post_task_update(callback, f'--- Extracting {len(separate_intervals)} non-contiguous segments separately')
+        run_in_parallel(extract_audio_segment,
+                        [ ( audio_file, intervals[i][0], intervals[i][1] - intervals[i][0], output_files[i] ) for i in separate_intervals ])
+
+# Cut a single segment. With fast_seek=False, this is the old method, which decodes from the start of the file,
+# and is only kept to compare against in clara_test.test_audio_split_speed.
+def extract_audio_segment(audio_file, start_time, duration, segment_file, fast_seek=True):
+    if fast_seek:
+        cmd = [ 'ffmpeg', '-y', '-loglevel', 'error', '-ss', f'{start_time:.6f}', '-t', f'{duration:.6f}', '-i', audio_file, '-q:a', '0', segment_file ]
+    else:
+        cmd = [ 'ffmpeg', '-y', '-loglevel', 'error', '-i', audio_file, '-ss', str(start_time), '-t', str(duration), '-q:a', '0', segment_file ]
+    run_ffmpeg(cmd, f'extract audio from {audio_file} at {start_time:.2f}')
+
+def convert_audio_file(source_file, target_file):
+    run_ffmpeg([ 'ffmpeg', '-y', '-loglevel', 'error', '-i', source_file, target_file ], f'convert {source_file} to {target_file}')
+
+def run_ffmpeg(cmd, description):
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise InternalCLARAError(message=f'*** Error: ffmpeg failed to {description}: {result.stderr[-1000:]}')
+
+# Run function on each tuple of arguments in args_list, with at most max_parallel_ffmpeg_jobs running at once.
+# The work is done by ffmpeg subprocesses, so threads are enough to keep several cores busy.
+# Return a list with, for each tuple, either None or the exception raised.
+def run_in_parallel(function, args_list, raise_errors=True):
+    max_workers = int(config.get('audio_processing', 'max_parallel_ffmpeg_jobs'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(function, *args) for args in args_list ]
+    errors = [ future.exception() for future in futures ]
+    if raise_errors:
+        for error in errors:
+            if error:
+                raise error
+    return errors
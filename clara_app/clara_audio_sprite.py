@@ -0,0 +1,69 @@
+"""
+Packed per-page audio sprites for rendered texts.
+
+Without sprites, a rendered page refers to a separate mp3 file for each word and segment with audio, and the
+browser fetches each one when it's clicked. In sprite mode, StaticHTMLRenderer packs the word and segment audio
+for each page into a single file in the multimedia directory, so that the page needs one request for all of it.
+
+The sprite is put together the same way as page audio in clara_page_audio: the MPEG audio frames of each file,
+without tags or VBR header frames, are written out one after another. The bytes for each file are then a complete
+mp3 stream on their own. The page gets a table mapping each audio src to [ start byte, end byte, start time, duration ].
+It fetches the sprite once and turns each byte range into a blob URL, which plays exactly like the original file.
+The times are for players which would rather seek in the sprite, and are only meaningful if all the files have
+the same format.
+
+Files which aren't plain MPEG Layer III streams are left out of the sprite and played from their own files as before.
+"""
+
+from .clara_utils import post_task_update
+from .clara_page_audio import Mp3FormatError, mp3_audio_frames, mp3_frame_header
+
+import hashlib
+
+def audio_sprite_file_name(page_number, audio_files):
+    digest = hashlib.sha256('\n'.join(str(file) for file in audio_files).encode('utf-8')).hexdigest()
+    return f'audio_sprite_{page_number}_{digest[:16]}.mp3'
+
+# Write the audio sprite for src_to_local_file, a dict mapping audio srcs to local mp3 files, to output_file.
+# Return the table of offsets for the srcs included, or None if none of the files could be used.
+def build_audio_sprite(src_to_local_file, output_file, callback=None):
+    offsets = {}
+    # Several srcs may refer to the same file, e.g. after self-contained rendering, and we only want one copy
+    file_offsets = {}
+    chunks = []
+    position = 0
+    time = 0.0
+    for src, local_file in src_to_local_file.items():
+        if local_file not in file_offsets:
+            try:
+                with open(local_file, 'rb') as f:
+                    data = f.read()
+                frames_start, frames_end, _format = mp3_audio_frames(data)
+                duration = mp3_duration(data, frames_start, frames_end)
+            except ( OSError, Mp3FormatError ) as e:
+                post_task_update(callback, f'*** Warning: not putting {src} in audio sprite: "{str(e)}"')
+                file_offsets[local_file] = None
+                continue
+            chunks.append(memoryview(data)[frames_start:frames_end])
+            file_offsets[local_file] = [ position, position + frames_end - frames_start, round(time, 3), round(duration, 3) ]
+            position += frames_end - frames_start
+            time += duration
+        if file_offsets[local_file]:
+            offsets[src] = file_offsets[local_file]
+    if not chunks:
+        return None
+    with open(output_file, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return offsets
+
+# Duration in seconds of the MPEG Layer III frames in data[start:end]
+def mp3_duration(data, start, end):
+    duration = 0.0
+    position = start
+    while position < end:
+        ( version, sample_rate, _bitrate, _channels ), frame_length = mp3_frame_header(data, position)
+        samples_per_frame = 1152 if version == 3 else 576
+        duration += samples_per_frame / sample_rate
+        position += frame_length
+    return duration
@@ -15,11 +15,22 @@ Sends a prompt to DALL-E-3, saves the resulting image in image_file, and returns
 Sends a prompt to ChatGPT-4V asking to interpret the image in image_file according to the instructions
 in prompt, and returns an APICall object including the response
 
+- AsyncRateLimiter(max_concurrent, max_calls_per_minute)
+Async context manager for limiting the number and rate of concurrent calls to get_api_chatgpt4_response and similar
+
+- acquire_openai_api_token(config_info={})
+Waits for the API rate limit before entering an AsyncRateLimiter, and returns the config_info to use for the call
+
+The requests themselves are sent through clara_api_scheduler.run_scheduled_api_call, which applies the rate limits
+shared by all processes on the node and retries rate limit errors with backoff. The OpenAI clients are created with max_retries=0,
+so that they don't retry by themselves as well.
+
 """
 
 from .clara_classes import *
 from . import clara_openai
 from .clara_utils import get_config, post_task_update, post_task_update_async, print_and_flush, absolute_local_file_name
+from .clara_api_scheduler import run_scheduled_api_call, acquire_api_call_token_async
 
 import asyncio
 import os
@@ -34,6 +45,44 @@ from io import BytesIO
 
 config = get_config()
 
+# Limit on concurrent LLM calls, e.g. from concurrently running tic-tac-toe games or syntax corrections.
+# At most max_concurrent calls are in flight, and call start times are spaced so that
+# there are at most max_calls_per_minute of them in any minute.
+class AsyncRateLimiter:
+    def __init__(self, max_concurrent, max_calls_per_minute):
+        self.max_concurrent = max_concurrent
+        self.interval = 60.0 / max_calls_per_minute
+        self._loop = None
+        self._next_start_time = 0.0
+
+    # asyncio primitives are bound to an event loop, and callers typically use asyncio.run once per batch of calls
+    def _primitives_for_current_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._start_lock = asyncio.Lock()
+        return self._semaphore, self._start_lock
+
+    async def __aenter__(self):
+        semaphore, start_lock = self._primitives_for_current_loop()
+        await semaphore.acquire()
+        try:
+            async with start_lock:
+                now = time.monotonic()
+                wait = self._next_start_time - now
+                self._next_start_time = max(now, self._next_start_time) + self.interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
 def get_open_ai_api_key(config_info):
     if 'open_ai_api_key' in config_info and config_info['open_ai_api_key'] and config_info['open_ai_api_key'] != 'None':
         key = config_info['open_ai_api_key']
@@ -89,30 +138,34 @@ def call_chat_gpt4_interpret_image(prompt, image_file, config_info={}, callback=
 def call_openai_api(messages, config_info):
     gpt_model = config_info['gpt_model'] if 'gpt_model' in config_info else 'gpt-3.5-turbo' # change gpt model
     api_key = get_open_ai_api_key(config_info)
-    client = OpenAI(api_key=api_key)
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model=gpt_model
-        )
+    client = OpenAI(api_key=api_key, max_retries=0)
+    chat_completion = run_scheduled_api_call('openai', gpt_model,
+                                             lambda: client.chat.completions.create(
+                                                 messages=messages,
+                                                 model=gpt_model
+                                                 ),
+                                             api_key=api_key, config_info=config_info)
     return chat_completion
 
 def call_openai_api_image(prompt, gpt_model, size, config_info):
     api_key = get_open_ai_api_key(config_info)
-    client = OpenAI(api_key=api_key)
-    response = client.images.generate(
-        model=gpt_model,
-        prompt=prompt,
-        size=size,
-        quality="standard",
-        n=1,
-        )
+    client = OpenAI(api_key=api_key, max_retries=0)
+    response = run_scheduled_api_call('openai', gpt_model,
+                                      lambda: client.images.generate(
+                                          model=gpt_model,
+                                          prompt=prompt,
+                                          size=size,
+                                          quality="standard",
+                                          n=1,
+                                          ),
+                                      api_key=api_key, config_info=config_info)
     return response
 
 def call_openai_api_interpret_image_url(prompt, image_url, gpt_model, max_tokens, config_info):
     api_key = get_open_ai_api_key(config_info)
-    client = OpenAI(api_key=api_key)
+    client = OpenAI(api_key=api_key, max_retries=0)
 
-    response = client.chat.completions.create(
+    response = run_scheduled_api_call('openai', gpt_model, lambda: client.chat.completions.create(
       model=gpt_model,
       messages=[
         {
@@ -131,13 +184,12 @@ def call_openai_api_interpret_image_url(prompt, image_url, gpt_model, max_tokens
         }
       ],
       max_tokens=max_tokens,
-    )
+    ), api_key=api_key, config_info=config_info)
 
     return response
 
 def call_openai_api_interpret_image(prompt, image_path, gpt_model, max_tokens, config_info):
     api_key = get_open_ai_api_key(config_info)
-    client = OpenAI(api_key=api_key)
 
     # Function to encode the image
     def encode_image(image_path):
@@ -174,10 +226,18 @@ def call_openai_api_interpret_image(prompt, image_path, gpt_model, max_tokens, c
       "max_tokens": max_tokens
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+    response = run_scheduled_api_call('openai', gpt_model,
+                                      lambda: requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload),
+                                      api_key=api_key, config_info=config_info)
 
     return response
 
+# Take the token for a get_api_chatgpt4_response call in advance, see clara_api_scheduler.acquire_api_call_token_async
+async def acquire_openai_api_token(config_info={}):
+    gpt_model = config_info['gpt_model'] if 'gpt_model' in config_info else 'gpt-3.5-turbo'
+    api_key = get_open_ai_api_key(config_info)
+    return await acquire_api_call_token_async('openai', gpt_model, api_key=api_key, config_info=config_info)
+
 async def get_api_chatgpt4_response(prompt, config_info={}, callback=None):
     start_time = time.time()
     gpt_model = config_info['gpt_model'] if 'gpt_model' in config_info else 'gpt-3.5-turbo' # change gpt model
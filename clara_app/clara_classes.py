@@ -271,6 +271,14 @@ class Text:
                 return page
         return None
 
+    # Map each image name to the first page annotated with it, for use when there are many images to look up
+    def page_index_by_image(self):
+        index = {}
+        for page in self.pages:
+            if 'img' in page.annotations and not page.annotations['img'] in index:
+                index[page.annotations['img']] = page
+        return index
+
     @classmethod
     def from_json(cls, json_str):
         data = json.loads(json_str)
@@ -286,7 +294,10 @@ class Image:
                  request_type='image-generation',
                  description_variable=None,
                  description_variables=None,  # New field
-                 page_object=None):
+                 page_object=None,
+                 width=None, height=None,
+                 thumbnail_width=None, thumbnail_height=None,
+                 renditions=None):
         self.image_file_path = image_file_path
         self.thumbnail_file_path = thumbnail_file_path
         self.image_name = image_name
@@ -301,6 +312,12 @@ class Image:
         self.description_variable = description_variable
         self.description_variables = description_variables or []  # New field
         self.page_object = page_object
+        # Cached dimensions, which are None for images stored before we kept them
+        self.width = width
+        self.height = height
+        self.thumbnail_width = thumbnail_width
+        self.thumbnail_height = thumbnail_height
+        self.renditions = renditions or []
 
     def to_json(self):
         return {
@@ -316,7 +333,12 @@ class Image:
             'request_type': self.request_type,
             'description_variable': self.description_variable,
             'description_variables': self.description_variables,  # New field
-            'user_prompt': self.user_prompt
+            'user_prompt': self.user_prompt,
+            'width': self.width,
+            'height': self.height,
+            'thumbnail_width': self.thumbnail_width,
+            'thumbnail_height': self.thumbnail_height,
+            'renditions': self.renditions
         }
 
     def merge_page(self, page_object):
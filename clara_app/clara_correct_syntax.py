@@ -1,38 +1,86 @@
 """
 Call ChatGPT-4 to try to fix non-well-formed annotated text. Typically this will be a question of missing or superfluous
 hashtags or slashes in glossed or lemma-tagged text.
+
+correct_syntax_in_string first parses all the segments, using a process pool if the text is very long,
+to find the ones that are not well-formed. Usually there are only a few of these, and they are sent to ChatGPT-4
+concurrently, subject to the limits in the [chatgpt4_syntax_correction] section of the config file.
+The corrected segments are then put back in their original positions.
 """
 
-from .clara_chatgpt4 import call_chat_gpt4
+from .clara_chatgpt4 import get_api_chatgpt4_response, acquire_openai_api_token, AsyncRateLimiter
 from .clara_internalise import parse_content_elements
-from .clara_utils import get_config, post_task_update
+from .clara_utils import get_config, post_task_update, post_task_update_async
 from .clara_classes import InternalCLARAError, ChatGPTError
 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import asyncio
+import traceback
+
 config = get_config()
 
+syntax_correction_rate_limiter = AsyncRateLimiter(int(config.get('chatgpt4_syntax_correction', 'max_concurrent_requests')),
+                                                  float(config.get('chatgpt4_syntax_correction', 'max_requests_per_minute')))
+
 def correct_syntax_in_string(text, text_type, l2, l1=None, config_info={}, callback=None):
     if not text_type in ( 'segmented', 'gloss', 'lemma' ):
         raise InternalCLARAError(message = f'Unknown text_type "{text_type}" in correct_syntax_in_string' )
     segments = text.split('||')
-    segments_out = []
+    malformed_indices = malformed_segment_indices(segments, text_type, callback=callback)
+    post_task_update(callback, f'--- {len(malformed_indices)} of {len(segments)} segments are not well-formed')
+    if not malformed_indices:
+        return ( text, [] )
+    corrections = asyncio.run(correct_syntax_in_segments_async([ segments[index] for index in malformed_indices ], text_type, l2,
+                                                               l1=l1, config_info=config_info, callback=callback))
+    segments_out = list(segments)
     all_api_calls = []
-    for segment in segments:
-        segment_out, api_calls = correct_syntax_in_segment(segment, text_type, l2, l1=l1, config_info=config_info, callback=callback)
+    for index, ( segment_out, api_calls ) in zip(malformed_indices, corrections):
+        segments_out[index] = segment_out
         all_api_calls += api_calls
-        segments_out += [ segment_out ]
     return ( '||'.join(segments_out), all_api_calls )
 
-def correct_syntax_in_segment(segment_text, text_type, l2, l1=None, config_info={}, callback=None):
+# Return the indices of the segments which don't parse. Parsing is CPU-bound, so for long texts we use a process pool.
+def malformed_segment_indices(segments, text_type, callback=None):
+    well_formed = None
+    if len(segments) >= int(config.get('chatgpt4_syntax_correction', 'min_segments_for_parallel_parsing')):
+        max_workers = int(config.get('chatgpt4_syntax_correction', 'max_parsing_workers'))
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                well_formed = list(executor.map(segment_is_well_formed, segments, repeat(text_type),
+                                                chunksize=max(1, len(segments) // ( 4 * max_workers ))))
+        except Exception as e:
+            post_task_update(callback, f'*** Warning: unable to parse segments in parallel ("{str(e)}"), parsing them one at a time')
+    if well_formed is None:
+        well_formed = [ segment_is_well_formed(segment, text_type) for segment in segments ]
+    return [ index for index, ok in enumerate(well_formed) if not ok ]
+
+def segment_is_well_formed(segment_text, text_type):
     try:
         parse_content_elements(segment_text, text_type)
-        # We didn't raise an exception, so it's okay. Return the original text with null API calls
+        return True
+    except:
+        return False
+
+async def correct_syntax_in_segments_async(segments, text_type, l2, l1=None, config_info={}, callback=None):
+    return await asyncio.gather(*( call_chatgpt4_to_correct_syntax_in_segment_async(segment_text, text_type, l2, l1=l1,
+                                                                                     config_info=config_info, callback=callback)
+                                   for segment_text in segments ))
+
+def correct_syntax_in_segment(segment_text, text_type, l2, l1=None, config_info={}, callback=None):
+    if segment_is_well_formed(segment_text, text_type):
+        # It's okay. Return the original text with null API calls
         api_calls = []
         return ( segment_text, api_calls )
-    except:
-        # We did get an exception, so try to fix it
+    else:
+        # Try to fix it
         return call_chatgpt4_to_correct_syntax_in_segment(segment_text, text_type, l2, l1=l1, config_info=config_info, callback=callback)
 
 def call_chatgpt4_to_correct_syntax_in_segment(segment_text, text_type, l2, l1=None, config_info={}, callback=None):
+    return asyncio.run(call_chatgpt4_to_correct_syntax_in_segment_async(segment_text, text_type, l2, l1=l1, config_info=config_info, callback=callback))
+
+async def call_chatgpt4_to_correct_syntax_in_segment_async(segment_text, text_type, l2, l1=None, config_info={}, callback=None):
     prompt = prompt_to_correct_syntax_in_segment(segment_text, text_type, l2, l1=l1)
     n_attempts = 0
     api_calls = []
@@ -41,20 +89,23 @@ def call_chatgpt4_to_correct_syntax_in_segment(segment_text, text_type, l2, l1=N
         if n_attempts >= limit:
             raise ChatGPTError( message=f'*** Unable to correct text after {limit} attempts' )
         n_attempts += 1
-        post_task_update(callback, f'--- Calling ChatGPT-4 to try to correct syntax in "{segment_text}" considered as {text_type} text (attempt {n_attempts})')
+        await post_task_update_async(callback, f'--- Calling ChatGPT-4 to try to correct syntax in "{segment_text}" considered as {text_type} text (attempt {n_attempts})')
         try:
-            api_call = call_chat_gpt4(prompt, config_info=config_info, callback=callback)
+            # Wait for the API rate limit before taking a slot, so that waiting calls don't hold slots
+            call_config_info = await acquire_openai_api_token(config_info)
+            async with syntax_correction_rate_limiter:
+                api_call = await get_api_chatgpt4_response(prompt, config_info=call_config_info, callback=callback)
             api_calls += [ api_call ]
             corrected_segment_text = api_call.response
-            try:
-                post_task_update(callback, f'--- Corrected to "{corrected_segment_text}", now well-formed')
+            if segment_is_well_formed(corrected_segment_text, text_type):
+                await post_task_update_async(callback, f'--- Corrected to "{corrected_segment_text}", now well-formed')
                 return ( corrected_segment_text, api_calls )
-            except:
-                post_task_update(callback, f'--- Corrected to "{corrected_segment_text}", but this is still not well-formed')
+            else:
+                await post_task_update_async(callback, f'--- Corrected to "{corrected_segment_text}", but this is still not well-formed')
         except Exception as e:
-            post_task_update(callback, f'*** Warning: error when sending request to ChatGPT-4')
+            await post_task_update_async(callback, f'*** Warning: error when sending request to ChatGPT-4')
             error_message = f'"{str(e)}"\n{traceback.format_exc()}'
-            post_task_update(callback, error_message)
+            await post_task_update_async(callback, error_message)
 
 def prompt_to_correct_syntax_in_segment(segment_text, text_type, l2, l1=None):
     if text_type == 'segmented':
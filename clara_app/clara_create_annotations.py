@@ -543,8 +543,8 @@ def merge_elements_and_annotated_elements(elements, annotated_elements, processi
     return elements
 
 def segmentation_prompt(annotate_or_improve, text, l2_language):
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, 'segmented', l2_language)
-    examples = segmentation_examples_to_text(annotated_example_list)
+    template, examples = get_template_and_examples_text(annotate_or_improve, 'segmented', l2_language,
+                                                        segmentation_examples_to_text)
     return template.format( l2_language=l2_language,
                             examples=examples,
                             text=text )
@@ -560,11 +560,12 @@ def morphology_prompt(simplified_elements_json, l2_language):
                             )
 
 def translation_prompt(annotate_or_improve, simplified_elements_json, l1_language, l2_language):
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, 'translated', l2_language)
     if annotate_or_improve == 'annotate':
-        examples = translation_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = translation_examples_to_examples_text
     else:
-        examples = retranslation_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = retranslation_examples_to_examples_text
+    template, examples = get_template_and_examples_text(annotate_or_improve, 'translated', l2_language,
+                                                        examples_to_text, l1_language, l2_language)
     return template.format( l1_language=l1_language,
                             l2_language=l2_language,
                             examples=examples,
@@ -580,12 +581,16 @@ def glossing_prompt(annotate_or_improve, simplified_elements_json, l1_language,
         template_and_examples_version = 'gloss_with_mwe'
     else:
         template_and_examples_version = 'gloss'
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, template_and_examples_version, l2_language)
     if annotate_or_improve == 'annotate':
-        examples = glossing_examples_to_examples_text(annotated_example_list, l1_language, l2_language, previous_version=previous_version,
-                                                      mwe=mwe, mwes=mwes, translation=translation)
+        # Only the MWEs and the translation are specific to this chunk, so we cache the formatted examples and add them afterwards
+        template, examples_text = get_template_and_examples_text(annotate_or_improve, template_and_examples_version, l2_language,
+                                                                 glossing_examples_to_plain_examples_text, l1_language, l2_language,
+                                                                 previous_version=previous_version, mwe=mwe, has_mwes=bool(mwes))
+        examples = add_mwes_and_translation_to_glossing_examples_text(examples_text, previous_version=previous_version,
+                                                                      mwe=mwe, mwes=mwes, translation=translation)
     else:
-        examples = reglossing_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        template, examples = get_template_and_examples_text(annotate_or_improve, template_and_examples_version, l2_language,
+                                                            reglossing_examples_to_examples_text, l1_language, l2_language)
     return template.format( l1_language=l1_language,
                             l2_language=l2_language,
                             examples=examples,
@@ -594,8 +599,8 @@ def glossing_prompt(annotate_or_improve, simplified_elements_json, l1_language,
 
 # We only have 'improvement' for 'lemma_and_gloss'
 def joint_tagging_and_glossing_prompt(simplified_elements_json, l1_language, l2_language):
-    template, annotated_example_list = get_template_and_annotated_example_list('improve', 'lemma_and_gloss', l2_language)
-    examples = re_lemma_and_glossing_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+    template, examples = get_template_and_examples_text('improve', 'lemma_and_gloss', l2_language,
+                                                        re_lemma_and_glossing_examples_to_examples_text, l1_language, l2_language)
     return template.format( l1_language=l1_language,
                             l2_language=l2_language,
                             examples=examples,
@@ -604,13 +609,15 @@ def joint_tagging_and_glossing_prompt(simplified_elements_json, l1_language, l2_
 
 def tagging_prompt(annotate_or_improve, simplified_elements_json, l2_language, mwe=False, mwes=[]):
     l1_language = 'irrelevant'
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve,
-                                                                               ( 'lemma' if not mwe else 'lemma_with_mwe' ),
-                                                                               l2_language)
+    template_and_examples_version = 'lemma' if not mwe else 'lemma_with_mwe'
     if annotate_or_improve == 'annotate':
-        examples = tagging_examples_to_examples_text(annotated_example_list, l2_language, mwe=mwe, mwes=mwes)
+        template, examples_text = get_template_and_examples_text(annotate_or_improve, template_and_examples_version, l2_language,
+                                                                 tagging_examples_to_plain_examples_text, l2_language,
+                                                                 mwe=mwe, has_mwes=bool(mwes))
+        examples = add_mwes_to_tagging_examples_text(examples_text, mwe=mwe, mwes=mwes)
     else:
-        examples = retagging_examples_to_examples_text(annotated_example_list, l2_language, mwe=mwe, mwes=mwes)
+        template, examples = get_template_and_examples_text(annotate_or_improve, template_and_examples_version, l2_language,
+                                                            retagging_examples_to_examples_text, l2_language, l1_language)
     return template.format( l2_language=l2_language,
                             examples=examples,
                             simplified_elements_json=simplified_elements_json
@@ -618,11 +625,12 @@ def tagging_prompt(annotate_or_improve, simplified_elements_json, l2_language, m
 
 def mwe_tagging_prompt(annotate_or_improve, simplified_elements_json, l2_language):
     l1_language = 'irrelevant'
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, 'mwe', l2_language)
     if annotate_or_improve == 'annotate':
-        examples = mwe_tagging_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = mwe_tagging_examples_to_examples_text
     else:
-        examples = mwe_retagging_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = mwe_retagging_examples_to_examples_text
+    template, examples = get_template_and_examples_text(annotate_or_improve, 'mwe', l2_language,
+                                                        examples_to_text, l1_language, l2_language)
     return template.format( l2_language=l2_language,
                             examples=examples,
                             simplified_elements_json=simplified_elements_json
@@ -630,16 +638,28 @@ def mwe_tagging_prompt(annotate_or_improve, simplified_elements_json, l2_languag
 
 def pinyin_tagging_prompt(annotate_or_improve, simplified_elements_json, l2_language):
     l1_language = 'irrelevant'
-    template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, 'pinyin', l2_language)
     if annotate_or_improve == 'annotate':
-        examples = pinyin_tagging_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = pinyin_tagging_examples_to_examples_text
     else:
-        examples = pinyin_retagging_examples_to_examples_text(annotated_example_list, l1_language, l2_language)
+        examples_to_text = pinyin_retagging_examples_to_examples_text
+    template, examples = get_template_and_examples_text(annotate_or_improve, 'pinyin', l2_language,
+                                                        examples_to_text, l1_language, l2_language)
     return template.format( l2_language=l2_language,
                             examples=examples,
                             simplified_elements_json=simplified_elements_json
                             )
 
+# Return the template and the examples formatted by examples_to_text(annotated_example_list, *args, **kwargs).
+# The result is cached per process until the templates or examples are next saved, so building the
+# prompt for each chunk only needs string operations. All the arguments must be hashable.
+def get_template_and_examples_text(annotate_or_improve, annotation_type, l2_language, examples_to_text, *args, **kwargs):
+    key = ( 'examples_text', annotate_or_improve, annotation_type, l2_language.lower(),
+            examples_to_text.__name__, args, tuple(sorted(kwargs.items())) )
+    def compute():
+        template, annotated_example_list = get_template_and_annotated_example_list(annotate_or_improve, annotation_type, l2_language)
+        return ( template, examples_to_text(annotated_example_list, *args, **kwargs) )
+    return clara_prompt_templates.get_cached_prompt_data(key, compute)
+
 def get_template_and_annotated_example_list(annotate_or_improve, annotation_type, l2_language):
     l2_language = l2_language.lower()
     try:
@@ -652,11 +672,14 @@ def get_template_and_annotated_example_list(annotate_or_improve, annotation_type
             raise e
 
 def get_template_and_annotated_example_list_for_language(annotate_or_improve, annotation_type, l2_language):
-    prompt_repo = clara_prompt_templates.PromptTemplateRepository(l2_language)
-    template = prompt_repo.load_template_or_examples('template', annotation_type, annotate_or_improve)
-    annotated_example_list = prompt_repo.load_template_or_examples('examples', annotation_type, annotate_or_improve)
-    clara_prompt_templates.check_validity_of_template_and_annotated_example_list(template, annotated_example_list, annotation_type)
-    return ( template, annotated_example_list )
+    key = ( 'template_and_examples', annotate_or_improve, annotation_type, l2_language )
+    def compute():
+        prompt_repo = clara_prompt_templates.PromptTemplateRepository(l2_language)
+        template = prompt_repo.load_template_or_examples('template', annotation_type, annotate_or_improve)
+        annotated_example_list = prompt_repo.load_template_or_examples('examples', annotation_type, annotate_or_improve)
+        clara_prompt_templates.check_validity_of_template_and_annotated_example_list(template, annotated_example_list, annotation_type)
+        return ( template, annotated_example_list )
+    return clara_prompt_templates.get_cached_prompt_data(key, compute)
 
 def segmentation_examples_to_text(examples):
     return '\n\n'.join([ segmentation_example_to_text(example) for example in examples ])
@@ -680,32 +703,48 @@ def translation_example_to_text(example, l1_language, l2_language):
     return f'Input: {source_texts}\nOutput: {source_and_target_texts}'
 
 def glossing_examples_to_examples_text(examples_structure, l2_language, l1_language, previous_version='segmented_with_images', mwe=False, mwes=[], translation=None):
-    print(f'--- glossing_examples_to_examples_text({examples_structure}, {l2_language}, {l1_language}, mwe={mwe}, mwes={mwes}, translation={translation}')
+    examples_text = glossing_examples_to_plain_examples_text(examples_structure, l2_language, l1_language,
+                                                             previous_version=previous_version, mwe=mwe, has_mwes=bool(mwes))
+    return add_mwes_and_translation_to_glossing_examples_text(examples_text, previous_version=previous_version,
+                                                              mwe=mwe, mwes=mwes, translation=translation)
+
+# The part of the glossing examples text which doesn't depend on the actual MWEs or the translation, so that it can be cached
+def glossing_examples_to_plain_examples_text(examples_structure, l2_language, l1_language, previous_version='segmented_with_images', mwe=False, has_mwes=False):
+    print(f'--- glossing_examples_to_plain_examples_text({examples_structure}, {l2_language}, {l1_language}, mwe={mwe}, has_mwes={has_mwes}')
     # 1) We're using the lemma-tagged version as the input
     if previous_version == 'lemma':
         return '\n\n'.join([ glossing_example_to_example_text(example, l2_language, l1_language, previous_version='lemma') for example in examples_structure ])
     # 2) We aren't using MWEs at all
     elif not mwe:
         return '\n\n'.join([ glossing_example_to_example_text(example, l2_language, l1_language) for example in examples_structure ])
-    # 3) We are using MWEs, and we might add a translation to the end. Two subcases:
+    # 3) We are using MWEs. Two subcases:
     # 3a) This particular text doesn't have any MWEs, so we use only examples with no MWEs
-    elif not mwes:
+    elif not has_mwes:
         examples_to_use = [ example for example in examples_structure
                             if example[1].strip() == '' ]
-        intro = 'Here are some examples:'
-        examples_text = '\n\n'.join([ glossing_example_with_mwes_to_example_text(example, l2_language, l1_language) for example in examples_to_use ])
-        intro_and_examples_text = f'{intro}\n\n{examples_text}'
-    # W3b)e are using MWEs, and this particular text has MWEs, so we use only examples with MWEs
+    # 3b) This particular text has MWEs, so we use only examples with MWEs
     else:
         examples_to_use = [ example for example in examples_structure
                             if example[1].strip() != '' ]
+    return '\n\n'.join([ glossing_example_with_mwes_to_example_text(example, l2_language, l1_language) for example in examples_to_use ])
+
+def add_mwes_and_translation_to_glossing_examples_text(examples_text, previous_version='segmented_with_images', mwe=False, mwes=[], translation=None):
+    # 1) and 2) We're using the lemma-tagged version as the input, or we aren't using MWEs at all
+    if previous_version == 'lemma' or not mwe:
+        return examples_text
+    # 3) We are using MWEs, and we might add a translation to the end. Two subcases:
+    # 3a) This particular text doesn't have any MWEs
+    elif not mwes:
+        intro = 'Here are some examples:'
+        intro_and_examples_text = f'{intro}\n\n{examples_text}'
+    # 3b) This particular text has MWEs
+    else:
         mwes_text = mwes_to_json_string(mwes)
         if len(mwes) == 1:
             intro1 = f'The following sequence of words should be treated as a single multi-word expression (MWE)'
         else:
             intro1 = f'The following sequences of words should be treated as single multi-word expressions (MWEs)'
         intro2 = f'This means that each of the component words in the MWE should be glossed in the same way. Here are some examples of how to gloss:'
-        examples_text = '\n\n'.join([ glossing_example_with_mwes_to_example_text(example, l2_language, l1_language) for example in examples_to_use ])
         intro_and_examples_text = f'{intro1}\n\n{mwes_text}\n\n{intro2}\n\n{examples_text}'
 
     if not translation:
@@ -715,28 +754,38 @@ def glossing_examples_to_examples_text(examples_structure, l2_language, l1_langu
         return intro_and_examples_text + translations_text
 
 def tagging_examples_to_examples_text(examples_structure, l2_language, mwe=False, mwes=[]):
-    print(f'--- tagging_examples_to_examples_text({examples_structure}, {l2_language}, mwe={mwe}, mwes={mwes})')
+    examples_text = tagging_examples_to_plain_examples_text(examples_structure, l2_language, mwe=mwe, has_mwes=bool(mwes))
+    return add_mwes_to_tagging_examples_text(examples_text, mwe=mwe, mwes=mwes)
+
+# The part of the tagging examples text which doesn't depend on the actual MWEs, so that it can be cached
+def tagging_examples_to_plain_examples_text(examples_structure, l2_language, mwe=False, has_mwes=False):
+    print(f'--- tagging_examples_to_plain_examples_text({examples_structure}, {l2_language}, mwe={mwe}, has_mwes={has_mwes})')
     # We aren't using MWEs at all
     if not mwe:
         return '\n\n'.join([ tagging_example_to_example_text(example, l2_language) for example in examples_structure ])
     # We are using MWEs, but this particular text doesn't have any, so we use only examples with no MWEs
-    elif not mwes:
+    elif not has_mwes:
         examples_to_use = [ example for example in examples_structure
                             if example[1].strip() == '' ]
-        intro = 'Here are some examples:'
-        examples_text = '\n\n'.join([ tagging_example_with_mwes_to_example_text(example, l2_language) for example in examples_to_use ])
-        return f'{intro}\n\n{examples_text}'
     # We are using MWEs, and this particular text has MWEs, so we use only examples with MWEs
     else:
         examples_to_use = [ example for example in examples_structure
                             if example[1].strip() != '' ]
+    return '\n\n'.join([ tagging_example_with_mwes_to_example_text(example, l2_language) for example in examples_to_use ])
+
+def add_mwes_to_tagging_examples_text(examples_text, mwe=False, mwes=[]):
+    if not mwe:
+        return examples_text
+    elif not mwes:
+        intro = 'Here are some examples:'
+        return f'{intro}\n\n{examples_text}'
+    else:
         mwes_text = mwes_to_json_string(mwes)
         if len(mwes) == 1:
             intro1 = f'The following sequence of words should be treated as a single multi-word expression (MWE)'
         else:
             intro1 = f'The following sequences of words should be treated as single multi-word expressions (MWEs)'
         intro2 = f'This means that each of the component words in the MWE should be tagged in the same way. Here are some examples of how to gloss:'
-        examples_text = '\n\n'.join([ tagging_example_with_mwes_to_example_text(example, l2_language) for example in examples_to_use ])
         return f'{intro1}\n\n{mwes_text}\n\n{intro2}\n\n{examples_text}'
 
 ##def tagging_examples_to_examples_text(examples_structure, l2_language, l1_language):
@@ -10,21 +10,34 @@ Main function: diff_text_objects(internalised_text1, internalised_text2, version
   'details' gives a string with a formatted version of the text showing highlighted differences.
 
 Returns a dict indexed by the elements of "required"
+
+Long texts are diffed segment by segment. Each segment, and each page boundary, is a unit, and units are matched
+on the content of their elements using patience diff: units whose content occurs exactly once in each text anchor
+the alignment, and runs of identical units are extended from the anchors. Elements in matched units are paired
+one for one, so only the elements in unmatched stretches need an element-level diff, which uses Myers'
+linear-space algorithm. In the usual case, where most segments have the same words, the cost is close to linear
+in the length of the text, rather than quadratic as it is with difflib over the whole element list.
+
+diff_diff_elements is the earlier difflib-based version, kept for comparison (see clara_test.test_diff_speed).
 """
 
 from .clara_classes import *
 from typing import List, Dict, Tuple, Optional, Union
 
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+
 import difflib
 import re
 import regex
 import json
 
 def diff_text_objects(internalised_text1: Text, internalised_text2: Text, version: str, required: List[str]) -> Dict[str, Union[float, str]]:
-    diff_elements1 = text_to_diff_elements(internalised_text1, version)
-    diff_elements2 = text_to_diff_elements(internalised_text2, version)
+    diff_units1 = text_to_diff_units(internalised_text1, version)
+    diff_units2 = text_to_diff_units(internalised_text2, version)
 
-    diff_elements = diff_diff_elements(diff_elements1, diff_elements2)
+    diff_elements = diff_diff_units(diff_units1, diff_units2)
 
     response = {}
     if 'error_rate' in required:
@@ -39,14 +52,19 @@ def diff_text_objects(internalised_text1: Text, internalised_text2: Text, versio
 # Don't add boundaries if we have a "plain" version, since the text is meant to be unannotated.
 # In 'gloss' or 'lemma' mode, the # signs separate.
 def text_to_diff_elements(text: Text, version: str) -> List[DiffElement]:
+    return [ element for unit in text_to_diff_units(text, version) for element in unit ]
+
+# Same, but keep the DiffElements for each segment, and for each page boundary, as a separate list.
+def text_to_diff_units(text: Text, version: str) -> List[List[DiffElement]]:
     # Remove the POS information before diffing, since it's both unreliable and often irrelevant
     def remove_pos_from_annotations(annotations):
         return { key: annotations[key] for key in annotations if key != 'pos' }
     
-    diff_elements = []
+    diff_units = []
 
     for page in text.pages:
         for segment in page.segments:
+            diff_elements = []
             last_type = None
             for element in segment.content_elements:
                 this_type = element.type
@@ -58,21 +76,207 @@ def text_to_diff_elements(text: Text, version: str) -> List[DiffElement]:
                 last_type = this_type
             if version != 'plain':
                 diff_elements.append(DiffElement('ContentElement', '||', {}))
+            diff_units.append(diff_elements)
         if version != 'plain':
-            diff_elements.append(DiffElement('ContentElement', '\n[page]\n', {}))
+            diff_units.append([ DiffElement('ContentElement', '\n[page]\n', {}) ])
         
-    return diff_elements
+    return diff_units
 
 # Use difflib to create a diff of two DiffElement lists as a third DiffElement list.
 def diff_diff_elements(elements1: List[DiffElement], elements2: List[DiffElement]) -> List[DiffElement]:
-    diff_elements = []
-
     # Align on the content fields of the DiffElement objects
     content1 = [el.content for el in elements1]
     content2 = [el.content for el in elements2]
     matcher = difflib.SequenceMatcher(None, content1, content2, autojunk = False)
 
-    for operation, i1, i2, j1, j2 in matcher.get_opcodes():
+    return opcodes_to_diff_elements(elements1, elements2, matcher.get_opcodes())
+
+# Create a diff of two lists of diff units, as produced by text_to_diff_units, as a DiffElement list.
+# Units are matched on content, then the elements in the unmatched stretches between them are diffed using Myers.
+def diff_diff_units(units1: List[List[DiffElement]], units2: List[List[DiffElement]]) -> List[DiffElement]:
+    elements1 = [ element for unit in units1 for element in unit ]
+    elements2 = [ element for unit in units2 for element in unit ]
+    content1 = [ element.content for element in elements1 ]
+    content2 = [ element.content for element in elements2 ]
+    starts1 = unit_start_positions(units1)
+    starts2 = unit_start_positions(units2)
+
+    unit_matches = match_diff_units([ tuple(element.content for element in unit) for unit in units1 ],
+                                    [ tuple(element.content for element in unit) for unit in units2 ])
+
+    opcodes = []
+    next_unit1 = next_unit2 = 0
+    for unit1, unit2 in unit_matches + [ ( len(units1), len(units2) ) ]:
+        if unit1 > next_unit1 or unit2 > next_unit2:
+            opcodes += myers_opcodes(content1, starts1[next_unit1], starts1[unit1],
+                                     content2, starts2[next_unit2], starts2[unit2])
+        if unit1 < len(units1):
+            opcodes.append(( 'equal', starts1[unit1], starts1[unit1 + 1], starts2[unit2], starts2[unit2 + 1] ))
+        next_unit1, next_unit2 = unit1 + 1, unit2 + 1
+
+    return opcodes_to_diff_elements(elements1, elements2, opcodes)
+
+def unit_start_positions(units):
+    starts = [ 0 ]
+    for unit in units:
+        starts.append(starts[-1] + len(unit))
+    return starts
+
+# Patience diff over unit keys. Return a list of matched pairs ( i, j ), in increasing order of both i and j.
+def match_diff_units(keys1, keys2):
+    matches = []
+    stack = [ ( 0, len(keys1), 0, len(keys2) ) ]
+    while stack:
+        lo1, hi1, lo2, hi2 = stack.pop()
+        # Match any identical units at the start and end of the stretch
+        while lo1 < hi1 and lo2 < hi2 and keys1[lo1] == keys2[lo2]:
+            matches.append(( lo1, lo2 ))
+            lo1, lo2 = lo1 + 1, lo2 + 1
+        while lo1 < hi1 and lo2 < hi2 and keys1[hi1 - 1] == keys2[hi2 - 1]:
+            hi1, hi2 = hi1 - 1, hi2 - 1
+            matches.append(( hi1, hi2 ))
+        anchors = unique_common_anchors(keys1, lo1, hi1, keys2, lo2, hi2)
+        # If there are no anchors, the whole stretch is left to the element-level diff
+        if anchors:
+            previous1, previous2 = lo1, lo2
+            for i, j in anchors:
+                matches.append(( i, j ))
+                stack.append(( previous1, i, previous2, j ))
+                previous1, previous2 = i + 1, j + 1
+            stack.append(( previous1, hi1, previous2, hi2 ))
+    return sorted(matches)
+
+# Pairs ( i, j ) where keys1[i] == keys2[j] and the key occurs exactly once in each range,
+# taking the longest subsequence in which the j values increase.
+def unique_common_anchors(keys1, lo1, hi1, keys2, lo2, hi2):
+    counts1 = Counter(keys1[lo1:hi1])
+    counts2 = Counter(keys2[lo2:hi2])
+    positions2 = { keys2[j]: j for j in range(lo2, hi2) if counts2[keys2[j]] == 1 }
+    candidates = [ ( i, positions2[keys1[i]] ) for i in range(lo1, hi1)
+                   if counts1[keys1[i]] == 1 and keys1[i] in positions2 ]
+    return longest_increasing_subsequence(candidates)
+
+# Patience sorting on the second element of each pair
+def longest_increasing_subsequence(pairs):
+    pile_tops = []
+    pile_top_indexes = []
+    predecessors = []
+    for index, ( _i, j ) in enumerate(pairs):
+        pile = bisect_left(pile_tops, j)
+        predecessors.append(pile_top_indexes[pile - 1] if pile > 0 else None)
+        if pile == len(pile_tops):
+            pile_tops.append(j)
+            pile_top_indexes.append(index)
+        else:
+            pile_tops[pile] = j
+            pile_top_indexes[pile] = index
+    result = []
+    index = pile_top_indexes[-1] if pile_top_indexes else None
+    while index is not None:
+        result.append(pairs[index])
+        index = predecessors[index]
+    return result[::-1]
+
+# Diff a[a_lo:a_hi] against b[b_lo:b_hi] using Myers' linear-space algorithm.
+# Return difflib-style opcodes, with positions in a and b.
+def myers_opcodes(a, a_lo, a_hi, b, b_lo, b_hi):
+    matches = []
+    stack = [ ( a_lo, a_hi, b_lo, b_hi ) ]
+    while stack:
+        lo1, hi1, lo2, hi2 = stack.pop()
+        while lo1 < hi1 and lo2 < hi2 and a[lo1] == b[lo2]:
+            matches.append(( lo1, lo2 ))
+            lo1, lo2 = lo1 + 1, lo2 + 1
+        while lo1 < hi1 and lo2 < hi2 and a[hi1 - 1] == b[hi2 - 1]:
+            hi1, hi2 = hi1 - 1, hi2 - 1
+            matches.append(( hi1, hi2 ))
+        # Once common prefixes and suffixes are removed, there is nothing to match unless both sides are non-empty.
+        # Otherwise, split the problem at a point on an optimal path and diff the two halves.
+        if lo1 < hi1 and lo2 < hi2:
+            split_point = myers_split_point(a, lo1, hi1, b, lo2, hi2)
+            if split_point:
+                x, y = split_point
+                stack.append(( lo1, lo1 + x, lo2, lo2 + y ))
+                stack.append(( lo1 + x, hi1, lo2 + y, hi2 ))
+    matches.sort()
+
+    opcodes = []
+    i, j = a_lo, b_lo
+    for match_i, match_j in matches + [ ( a_hi, b_hi ) ]:
+        if match_i > i and match_j > j:
+            opcodes.append(( 'replace', i, match_i, j, match_j ))
+        elif match_i > i:
+            opcodes.append(( 'delete', i, match_i, j, j ))
+        elif match_j > j:
+            opcodes.append(( 'insert', i, i, j, match_j ))
+        if match_i < a_hi:
+            if opcodes and opcodes[-1][0] == 'equal' and opcodes[-1][2] == match_i:
+                opcodes[-1] = ( 'equal', opcodes[-1][1], match_i + 1, opcodes[-1][3], match_j + 1 )
+            else:
+                opcodes.append(( 'equal', match_i, match_i + 1, match_j, match_j + 1 ))
+        i, j = match_i + 1, match_j + 1
+    return opcodes
+
+# Find a point ( x, y ), relative to ( lo1, lo2 ), on an optimal edit path from ( 0, 0 ) to ( n, m ) in the edit graph
+# for a[lo1:hi1] and b[lo2:hi2], running forward and backward searches until they meet. Diagonals whose
+# furthest point has left the graph are trimmed from the search. Return None if the two sides have nothing in common.
+def myers_split_point(a, lo1, hi1, b, lo2, hi2):
+    n, m = hi1 - lo1, hi2 - lo2
+    delta = n - m
+    odd = delta % 2 != 0
+    max_d = ( n + m + 1 ) // 2
+    offset = max_d
+    # forward[offset + k] is the furthest x reached on diagonal k = x - y;
+    # backward[offset + k] is the same for the reversed sequences, so it measures distance back from ( n, m )
+    forward = [ -1 ] * ( 2 * max_d + 2 )
+    backward = [ -1 ] * ( 2 * max_d + 2 )
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    forward_start = forward_end = backward_start = backward_end = 0
+    for d in range(max_d):
+        for k in range(-d + forward_start, d + 1 - forward_end, 2):
+            if k == -d or ( k != d and forward[offset + k - 1] < forward[offset + k + 1] ):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[lo1 + x] == b[lo2 + y]:
+                x, y = x + 1, y + 1
+            forward[offset + k] = x
+            if x > n:
+                forward_end += 2
+            elif y > m:
+                forward_start += 2
+            elif odd:
+                backward_index = offset + delta - k
+                if 0 <= backward_index < len(backward) and backward[backward_index] != -1 and x >= n - backward[backward_index]:
+                    return ( x, y )
+        for k in range(-d + backward_start, d + 1 - backward_end, 2):
+            if k == -d or ( k != d and backward[offset + k - 1] < backward[offset + k + 1] ):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[hi1 - 1 - x] == b[hi2 - 1 - y]:
+                x, y = x + 1, y + 1
+            backward[offset + k] = x
+            if x > n:
+                backward_end += 2
+            elif y > m:
+                backward_start += 2
+            elif not odd:
+                forward_index = offset + delta - k
+                if 0 <= forward_index < len(forward) and forward[forward_index] != -1:
+                    forward_x = forward[forward_index]
+                    if forward_x >= n - x:
+                        return ( forward_x, forward_x - ( delta - k ) )
+    return None
+
+# Convert difflib-style opcodes over two DiffElement lists into a DiffElement list.
+def opcodes_to_diff_elements(elements1: List[DiffElement], elements2: List[DiffElement], opcodes) -> List[DiffElement]:
+    diff_elements = []
+
+    for operation, i1, i2, j1, j2 in opcodes:
         # We align just on the content field, so an 'equal' doesn't means
         # that the annotation fields are necessarily the same
         if operation == 'equal' or ( operation == 'replace' and i2 - i1 == j2 - j1 ):
@@ -116,18 +320,18 @@ def diff_element_for_replace(element1, element2):
         return DiffElement('SubstitutedElement', '', { 'element1': element1, 'element2': element2 })
 
 def diff_elements_to_error_rate(diff_elements: List[DiffElement], version: str) -> float:
-    # Ignore whitespaces when calculating error rate. 
-    diff_elements = [ e for e in diff_elements if not e.content.isspace() or e.type == 'SubstitutedElement' ]
-    # Except in 'segmented' mode, we also ignore layout and punctuation.
-    if version != 'segmented':
-        diff_elements = [ e for e in diff_elements if not diff_element_is_only_punctuation_spaces_and_separators(e) ]
-    error_diff_elements = [ e for e in diff_elements if e.type != 'ContentElement' ]
-    total_elements = len(diff_elements)
-    error_elements = len(error_diff_elements)
-
-    #print(f'# total elements: {total_elements}')
-    #print(f'# total elements: {[ e.content for e in diff_elements ]}')
-    #print(f'error elements: {[ e.content for e in error_diff_elements ]}')
+    total_elements = 0
+    error_elements = 0
+    for e in diff_elements:
+        # Ignore whitespaces when calculating error rate. 
+        if e.content.isspace() and e.type != 'SubstitutedElement':
+            continue
+        # Except in 'segmented' mode, we also ignore layout and punctuation.
+        if version != 'segmented' and diff_element_is_only_punctuation_spaces_and_separators(e):
+            continue
+        total_elements += 1
+        if e.type != 'ContentElement':
+            error_elements += 1
 
     if total_elements == 0:
         return 0.0
@@ -142,9 +346,13 @@ def diff_element_is_only_punctuation_spaces_and_separators(e):
     else:
         return string_is_only_punctuation_spaces_and_separators(e.content)
 
+_punctuation_spaces_and_separators_regex = regex.compile(r"[\p{P} \n|]*")
+
+# The same strings come up over and over again, so cache the results
+@lru_cache(maxsize=100000)
 def string_is_only_punctuation_spaces_and_separators(s):
     s = s.replace('[page]', '')
-    return all(regex.match(r"[\p{P} \n|]", c) for c in s)
+    return _punctuation_spaces_and_separators_regex.fullmatch(s) is not None
 
 def diff_elements_to_details(diff_elements: List[DiffElement]) -> str:
     details = []
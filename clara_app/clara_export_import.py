@@ -1,35 +1,60 @@
 from .clara_classes import InternalCLARAError
 #from .clara_utils import _use_orm_repositories
-from .clara_utils import absolute_local_file_name, pathname_parts, file_exists, local_file_exists, basename, copy_local_file, copy_to_local_file, remove_local_file
-from .clara_utils import make_local_directory, copy_directory_to_local_directory, local_directory_exists, remove_local_directory
-from .clara_utils import get_immediate_subdirectories_in_local_directory, get_files_in_local_directory, rename_file
-from .clara_utils import make_tmp_file, write_json_to_local_file, read_json_local_file, make_zipfile, unzip_file, post_task_update
+from .clara_utils import absolute_local_file_name, pathname_parts, file_exists, local_file_exists, basename, copy_local_file, remove_local_file
+from .clara_utils import extension_for_file_path, list_files_in_directory_recursively, open_file_for_binary_read, write_stream_to_file
+from .clara_utils import write_json_to_file, get_config, make_tmp_file, post_task_update
 from .clara_audio_annotator import AudioAnnotator
+from .clara_project_metadata import apply_metadata_log_records, metadata_log_text_to_records
 ##from .clara_audio_repository import AudioRepository
 ##from .clara_audio_repository_orm import AudioRepositoryORM
 ##from .clara_image_repository import ImageRepository
 ##from .clara_image_repository_orm import ImageRepositoryORM
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+import io
+import json
 import os
+import shutil
 import tempfile
+import threading
+import time
 import traceback
 
+config = get_config()
+
+# Files in these formats are already compressed, so we store them as they are
+_STORED_EXTENSIONS = ( 'mp3', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'zip' )
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Zipfile layout, which is the same as the one previously produced by zipping up a staging directory:
+#
+#   metadata.json                    Global metadata
+#   project_dir/...                  Contents of the project directory
+#   audio/metadata.json, audio/*.mp3 Normal audio
+#   phonetic_audio/...               Phonetic audio
+#   images/metadata.json, images/*   Images
+#   image_descriptions/metadata.json Image descriptions
+
+# Write the zipfile in a single pass, streaming each file into it straight from where it is stored (local or S3)
 def create_export_zipfile(global_metadata, project_directory, audio_metadata, audio_metadata_phonetic,
                           image_metadata, image_description_metadata,
                           zipfile, callback=None):
+    tmp_zipfile = make_tmp_file('project_zip', 'zip')
     try:
-        tmp_dir = tempfile.mkdtemp()
-        tmp_zipfile = make_tmp_file('project_zip', 'zip')
-
-        write_global_metadata_to_tmp_dir(global_metadata, tmp_dir, callback=callback)
-        copy_project_directory_to_tmp_dir(project_directory, tmp_dir, callback=callback)
-        copy_audio_data_to_tmp_dir(audio_metadata, tmp_dir, phonetic=False, callback=callback)
-        copy_audio_data_to_tmp_dir(audio_metadata_phonetic, tmp_dir, phonetic=True, callback=callback)
-        copy_image_data_to_tmp_dir(image_metadata, tmp_dir, callback=callback)
-        copy_image_description_data_to_tmp_dir(image_description_metadata, tmp_dir, callback=callback)
-        
-        make_zipfile(tmp_dir, tmp_zipfile, callback=callback)
+        with ZipFile(absolute_local_file_name(tmp_zipfile), 'w', allowZip64=True) as zip_ref:
+            names_in_zipfile = set()
+            write_global_metadata_to_zipfile(global_metadata, zip_ref, callback=callback)
+            add_project_directory_to_zipfile(project_directory, zip_ref, names_in_zipfile, callback=callback)
+            add_audio_data_to_zipfile(audio_metadata, zip_ref, names_in_zipfile, phonetic=False, callback=callback)
+            add_audio_data_to_zipfile(audio_metadata_phonetic, zip_ref, names_in_zipfile, phonetic=True, callback=callback)
+            add_image_data_to_zipfile(image_metadata, zip_ref, names_in_zipfile, callback=callback)
+            add_image_description_data_to_zipfile(image_description_metadata, zip_ref, callback=callback)
+
+        post_task_update(callback, f'--- Zipfile written')
         copy_local_file(tmp_zipfile, zipfile)
         post_task_update(callback, f'--- Zipfile created and copied to {zipfile}')
         return True
@@ -39,22 +64,31 @@ def create_export_zipfile(global_metadata, project_directory, audio_metadata, au
         post_task_update(callback, error_message)
         return False
     finally:
-        # Remove the tmp dir and tmp zipfile once we've used them
-        if local_directory_exists(tmp_dir):
-            remove_local_directory(tmp_dir)
+        # Remove the tmp zipfile once we've used it
         if local_file_exists(tmp_zipfile):
             remove_local_file(tmp_zipfile)
 
-def write_global_metadata_to_tmp_dir(global_metadata, tmp_dir, callback=None):
-    global_metadata_file = f'{tmp_dir}/metadata.json'
-    write_json_to_local_file(global_metadata, global_metadata_file)
-    post_task_update(callback, f'--- Written global metadata')
+# Copy a local or S3 file into the zipfile, without compressing formats that are already compressed
+def add_file_to_zipfile(pathname, zip_ref, name_in_zipfile):
+    zip_info = ZipInfo(name_in_zipfile, date_time=time.localtime()[:6])
+    zip_info.compress_type = ZIP_STORED if extension_for_file_path(pathname).lower() in _STORED_EXTENSIONS else ZIP_DEFLATED
+    with closing(open_file_for_binary_read(pathname)) as source:
+        with zip_ref.open(zip_info, 'w', force_zip64=True) as destination:
+            shutil.copyfileobj(source, destination, _COPY_BUFFER_SIZE)
 
-def copy_project_directory_to_tmp_dir(project_directory, tmp_dir, callback=None):
-    tmp_project_dir = os.path.join(tmp_dir, 'project_dir')
+def write_json_to_zipfile(data, zip_ref, name_in_zipfile):
+    zip_ref.writestr(name_in_zipfile, json.dumps(data, indent=4), compress_type=ZIP_DEFLATED)
 
+def write_global_metadata_to_zipfile(global_metadata, zip_ref, callback=None):
+    write_json_to_zipfile(global_metadata, zip_ref, 'metadata.json')
+    post_task_update(callback, f'--- Written global metadata')
+
+def add_project_directory_to_zipfile(project_directory, zip_ref, names_in_zipfile, callback=None):
     post_task_update(callback, f'--- Copying project directory')
-    copy_directory_to_local_directory(project_directory, tmp_project_dir)
+    for relative_pathname in list_files_in_directory_recursively(project_directory):
+        name_in_zipfile = f'project_dir/{relative_pathname}'
+        add_file_to_zipfile(os.path.join(project_directory, relative_pathname), zip_ref, name_in_zipfile)
+        names_in_zipfile.add(name_in_zipfile)
     post_task_update(callback, f'--- Project directory copied')
 
 ## Format looks like this:
@@ -73,12 +107,10 @@ def copy_project_directory_to_tmp_dir(project_directory, tmp_dir, callback=None)
 ##        },
 ##        ...
 
-def copy_audio_data_to_tmp_dir(audio_metadata, tmp_dir, phonetic=False, callback=None):
+def add_audio_data_to_zipfile(audio_metadata, zip_ref, names_in_zipfile, phonetic=False, callback=None):
     if not audio_metadata:
         return
-    tmp_audio_dir = os.path.join(tmp_dir, 'audio' if not phonetic else 'phonetic_audio') 
-    make_local_directory(tmp_audio_dir)
-    file = f'{tmp_audio_dir}/metadata.json'
+    audio_dir_in_zipfile = 'audio' if not phonetic else 'phonetic_audio'
 
     for words_or_segments in ( 'words', 'segments' ):
         if words_or_segments in audio_metadata:
@@ -93,14 +125,16 @@ def copy_audio_data_to_tmp_dir(audio_metadata, tmp_dir, phonetic=False, callback
                 for item in audio_metadata[words_or_segments]:
                     if 'file_path' in item and item['file_path'] and file_exists(item['file_path']):
                         pathname = item['file_path']
-                        zipfile_pathname = os.path.join(tmp_audio_dir, basename(pathname))
-                        copy_to_local_file(pathname, zipfile_pathname)
+                        name_in_zipfile = f'{audio_dir_in_zipfile}/{basename(pathname)}'
+                        if not name_in_zipfile in names_in_zipfile:
+                            add_file_to_zipfile(pathname, zip_ref, name_in_zipfile)
+                            names_in_zipfile.add(name_in_zipfile)
                         item['file'] = basename(pathname)
                         count += 1
                         if count % 10 == 0:
                             post_task_update(callback, f'--- Copied {count}/{len(sub_metadata)} files for {printform_for_words_or_segments}')
-    
-    write_json_to_local_file(audio_metadata, file)
+
+    write_json_to_zipfile(audio_metadata, zip_ref, f'{audio_dir_in_zipfile}/metadata.json')
     post_task_update(callback, f'--- Copied all audio files (phonetic = {phonetic})')
 
 ## Format looks like this:
@@ -115,117 +149,135 @@ def copy_audio_data_to_tmp_dir(audio_metadata, tmp_dir, phonetic=False, callback
 ##        "page": 1,
 ##        "position": "bottom"
 ##    },
-    
-def copy_image_data_to_tmp_dir(image_metadata, tmp_dir, callback=None):
-    tmp_image_dir = os.path.join(tmp_dir, 'images')
-    make_local_directory(tmp_image_dir)
-    file = f'{tmp_image_dir}/metadata.json'
-    
+
+def add_image_data_to_zipfile(image_metadata, zip_ref, names_in_zipfile, callback=None):
     image_metadata_as_json = [ image.to_json() for image in image_metadata  ]
 
     if len(image_metadata_as_json) != 0:
         count = 0
         post_task_update(callback, f'--- Copying {len(image_metadata_as_json)} image files')
-        
+
         for item in image_metadata_as_json:
             if item['request_type'] == 'image-generation':
                 for key in ( 'image_file_path', 'thumbnail_file_path' ):
                     if key in item:
                         pathname = item[key]
                         if pathname and file_exists(pathname):
-                            zipfile_pathname = os.path.join(tmp_image_dir, basename(pathname))
-                            copy_to_local_file(pathname, zipfile_pathname)
+                            name_in_zipfile = f'images/{basename(pathname)}'
+                            if not name_in_zipfile in names_in_zipfile:
+                                add_file_to_zipfile(pathname, zip_ref, name_in_zipfile)
+                                names_in_zipfile.add(name_in_zipfile)
                             item[key] = basename(pathname)
                             count += 1
                             if count % 10 == 0:
                                 post_task_update(callback, f'--- Copied {count}/{len(image_metadata_as_json)} image files')
-    
-    write_json_to_local_file(image_metadata_as_json, file)
+
+    write_json_to_zipfile(image_metadata_as_json, zip_ref, 'images/metadata.json')
     post_task_update(callback, f'--- Copied all image files')
 
-def copy_image_description_data_to_tmp_dir(image_description_metadata, tmp_dir, callback=None):
-    tmp_image_dir = os.path.join(tmp_dir, 'image_descriptions')
-    make_local_directory(tmp_image_dir)
-    file = f'{tmp_image_dir}/metadata.json'
-    
+def add_image_description_data_to_zipfile(image_description_metadata, zip_ref, callback=None):
     image_description_metadata_as_json = [ image.to_json() for image in image_description_metadata  ]
 
     if len(image_description_metadata_as_json) != 0:
-        write_json_to_local_file(image_description_metadata_as_json, file)
+        write_json_to_zipfile(image_description_metadata_as_json, zip_ref, 'image_descriptions/metadata.json')
     post_task_update(callback, f'--- Copied all image description data')
 
 # ===========================================
 
-def change_project_id_in_imported_directory(tmp_dir, new_id):
-    tmp_project_dir = os.path.join(tmp_dir, 'project_dir')
-    if not local_directory_exists(tmp_project_dir):
-        post_task_update(callback, f'--- Unable to find project_dir subdirectory in unzipped directory')
-        raise FileNotFoundError(f"project_dir not found in unzipped directory")
-    stored_data_file = os.path.join(tmp_project_dir, 'stored_data.json')
-    if not local_file_exists(stored_data_file):
-        post_task_update(callback, f'--- Unable to find stored_data file in unzipped directory')
-        raise FileNotFoundError(f"stored_data.json not found in unzipped directory")
-    stored_data = read_json_local_file(stored_data_file)
-    stored_data['id'] = new_id
-    write_json_to_local_file(stored_data, stored_data_file)
-
-# Go through the project dir and rename the text and annotated text files to be canonical wrt the new project id
-def rename_files_in_project_dir(tmp_project_dir, new_id):
-    abs_dir = absolute_local_file_name(tmp_project_dir)
-    subdirs = get_immediate_subdirectories_in_local_directory(abs_dir)
-    for subdir in subdirs:
-        files = get_files_in_local_directory(os.path.join(abs_dir, subdir))
-        for file in files:
-            if file.endswith(f'{subdir}.txt'):
-                rename_file(os.path.join(abs_dir, subdir, file),
-                            os.path.join(abs_dir, subdir, f'{new_id}_{subdir}.txt'))
-
-def update_metadata_file_paths(clara_project_internal, project_dir, callback=None):
+# Import works directly from the open zipfile: entries are streamed to their final locations,
+# and only individual media files are briefly staged as local tmp files for the repositories.
+
+def read_json_from_zipfile(zip_ref, name_in_zipfile):
     try:
-        # Read the existing metadata
-        metadata_file_path = os.path.join(project_dir, 'metadata.json')
-        if not local_file_exists(metadata_file_path):
-            post_task_update(callback, f"Warning: metadata file {metadata_file_path} not found, cannot update")
-            return False
-
-        project_id = clara_project_internal.id
-        metadata = read_json_local_file(metadata_file_path)
-
-        # Update the 'file' field in each metadata entry
-        for entry in metadata:
-            if 'file' in entry:
-                # Split the path
-                pathname = entry['file']
-                path_parts = pathname_parts(pathname)
-                if not 'clara_content' in path_parts:
-                    post_task_update(callback, f"Warning: 'clara_content' not found in metadata file pathname {pathname} (parts = {path_parts}), cannot update")
-                else:
-                    clara_project_index = path_parts.index('clara_content') + 1
-                    # Get the old project name
-                    old_project_id = path_parts[clara_project_index]
-                    # Replace old project id with new one
-                    pathname_with_project_id_fixed = pathname.replace(old_project_id, project_id)
-                    # Split again
-                    path_parts_with_project_id_fixed = Path(pathname_with_project_id_fixed).parts
-                    # Replace the beginning, up to 'clara_content', with the local values
-                    new_path_parts = ['$CLARA', 'clara_content'] + list(path_parts_with_project_id_fixed[clara_project_index:])
-                    new_path = str(Path(*new_path_parts))
-                    entry['file'] = new_path
-
-        # Write the updated metadata back to the file
-        write_json_to_local_file(metadata, metadata_file_path)
-        post_task_update(callback, f"Updated metadata file for project '{clara_project_internal.id}': {metadata_file_path}")
+        with zip_ref.open(name_in_zipfile) as f:
+            return json.load(io.TextIOWrapper(f, encoding='utf-8'))
+    except KeyError:
+        return None
 
-        return True
-    except Exception as e:
-        post_task_update(callback, f"Error updating metadata file paths: {str(e)}\n{traceback.format_exc()}")
-        return False
+def get_global_metadata_from_zipfile(zip_ref, callback=None):
+    return read_json_from_zipfile(zip_ref, 'metadata.json')
 
-def update_multimedia_from_imported_directory(project, temp_dir, callback=None):
-    update_images_from_imported_directory(project, temp_dir, callback=callback)
-    update_image_descriptions_from_imported_directory(project, temp_dir, callback=callback)
-    update_regular_audio_from_imported_directory(project, temp_dir, callback=callback)
-    update_phonetic_audio_from_imported_directory(project, temp_dir, callback=callback)
+# Copy the contents of project_dir in the zipfile to the directory for the new project, making the files canonical wrt the new project id.
+# Returns the stored data for the imported project.
+def import_project_directory_from_zipfile(zip_ref, project_dir, new_id, callback=None):
+    stored_data = read_json_from_zipfile(zip_ref, 'project_dir/stored_data.json')
+    if not stored_data:
+        post_task_update(callback, f'--- Unable to find stored_data file in zipfile')
+        raise FileNotFoundError(f"stored_data.json not found in zipfile")
+    stored_data['id'] = new_id
+
+    metadata = None
+    metadata_log_records = []
+    for name_in_zipfile in zip_ref.namelist():
+        if not name_in_zipfile.startswith('project_dir/') or name_in_zipfile.endswith('/'):
+            continue
+        relative_pathname = name_in_zipfile[len('project_dir/'):]
+        if relative_pathname == 'stored_data.json':
+            write_json_to_file(stored_data, os.path.join(project_dir, relative_pathname))
+        # Fold any metadata log into the metadata snapshot, so that we only need to fix the file paths in one place
+        elif relative_pathname == 'metadata.json':
+            metadata = read_json_from_zipfile(zip_ref, name_in_zipfile)
+        elif relative_pathname == 'metadata_log.jsonl':
+            metadata_log_records = metadata_log_text_to_records(zip_ref.read(name_in_zipfile).decode('utf-8'))
+        else:
+            with zip_ref.open(name_in_zipfile) as source:
+                write_stream_to_file(source, os.path.join(project_dir, canonical_project_file_name(relative_pathname, new_id)))
+
+    if metadata is not None or metadata_log_records:
+        metadata = apply_metadata_log_records(metadata if metadata is not None else [], metadata_log_records)
+        update_metadata_file_paths(metadata, new_id, callback=callback)
+        write_json_to_file(metadata, os.path.join(project_dir, 'metadata.json'))
+
+    post_task_update(callback, f'--- Imported project directory')
+    return stored_data
+
+# Rename the text and annotated text files to be canonical wrt the new project id
+def canonical_project_file_name(relative_pathname, new_id):
+    parts = relative_pathname.split('/')
+    if len(parts) == 2:
+        subdir, file = parts
+        if file.endswith(f'{subdir}.txt'):
+            return f'{subdir}/{new_id}_{subdir}.txt'
+    return relative_pathname
+
+# Update the 'file' field in each metadata entry so that it refers to the new project
+def update_metadata_file_paths(metadata, project_id, callback=None):
+    for entry in metadata:
+        if 'file' in entry:
+            # Split the path
+            pathname = entry['file']
+            path_parts = pathname_parts(pathname)
+            if not 'clara_content' in path_parts:
+                post_task_update(callback, f"Warning: 'clara_content' not found in metadata file pathname {pathname} (parts = {path_parts}), cannot update")
+            else:
+                clara_project_index = path_parts.index('clara_content') + 1
+                # Get the old project name
+                old_project_id = path_parts[clara_project_index]
+                # Replace old project id with new one
+                pathname_with_project_id_fixed = pathname.replace(old_project_id, project_id)
+                # Split again
+                path_parts_with_project_id_fixed = Path(pathname_with_project_id_fixed).parts
+                # Replace the beginning, up to 'clara_content', with the local values
+                new_path_parts = ['$CLARA', 'clara_content'] + list(path_parts_with_project_id_fixed[clara_project_index:])
+                new_path = str(Path(*new_path_parts))
+                entry['file'] = new_path
+
+    post_task_update(callback, f"Updated metadata file paths for project '{project_id}'")
+    return metadata
+
+def update_multimedia_from_zipfile(project, zip_ref, global_metadata, callback=None):
+    update_images_from_zipfile(project, zip_ref, callback=callback)
+    update_image_descriptions_from_zipfile(project, zip_ref, callback=callback)
+    update_regular_audio_from_zipfile(project, zip_ref, global_metadata, callback=callback)
+    update_phonetic_audio_from_zipfile(project, zip_ref, global_metadata, callback=callback)
+
+# Extract a single entry to a tmp directory, keeping its base name, and return the local pathname
+def extract_zipfile_entry_to_tmp_dir(zip_ref, name_in_zipfile, tmp_dir):
+    local_pathname = os.path.join(tmp_dir, basename(name_in_zipfile))
+    with zip_ref.open(name_in_zipfile) as source:
+        with open(local_pathname, 'wb') as destination:
+            shutil.copyfileobj(source, destination, _COPY_BUFFER_SIZE)
+    return local_pathname
 
 ## Typical items in image metadata look like this:
 ##
@@ -239,38 +291,35 @@ def update_multimedia_from_imported_directory(project, temp_dir, callback=None):
 ##        "position": "bottom"
 ##    },
 
-def update_images_from_imported_directory(project, tmp_dir, callback=None):
-    image_dir = absolute_local_file_name(os.path.join(tmp_dir, 'images'))
-    metadata_file = os.path.join(image_dir, 'metadata.json')
-    if not local_file_exists(metadata_file):
-        # There are no image_descriptions in this zipfile
-        return
-    metadata = read_json_local_file(metadata_file)
-    for item in metadata:
-        project.add_project_image(item['image_name'],
-                                  os.path.join(image_dir, item['image_file_path']) if item['image_file_path'] else '',
-                                  associated_text=item['associated_text'],
-                                  associated_areas=item['associated_areas'],
-                                  page=item['page'],
-                                  position=item['position'],
-                                  style_description=item['style_description'],
-                                  content_description=item['content_description'],
-                                  user_prompt=item['user_prompt'],
-                                  request_type=item['request_type'],
-                                  description_variable=item['description_variable'],
-                                  description_variables=item['description_variables'],
-                                  callback=callback)
-
-    
-def update_image_descriptions_from_imported_directory(project, tmp_dir, callback=None):
-    image_dir = absolute_local_file_name(os.path.join(tmp_dir, 'image_descriptions'))
-    metadata_file = os.path.join(image_dir, 'metadata.json')
-    if not local_file_exists(metadata_file):
+def update_images_from_zipfile(project, zip_ref, callback=None):
+    metadata = read_json_from_zipfile(zip_ref, 'images/metadata.json')
+    if not metadata:
         # There are no images in this zipfile
         return
-    metadata = read_json_local_file(metadata_file)
     for item in metadata:
         # Note that we don't use "thumbnail_file_path", add_project_image generates the thumbnail on the fly.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_file_path = extract_zipfile_entry_to_tmp_dir(zip_ref, f"images/{item['image_file_path']}", tmp_dir) if item['image_file_path'] else ''
+            project.add_project_image(item['image_name'],
+                                      image_file_path,
+                                      associated_text=item['associated_text'],
+                                      associated_areas=item['associated_areas'],
+                                      page=item['page'],
+                                      position=item['position'],
+                                      style_description=item['style_description'],
+                                      content_description=item['content_description'],
+                                      user_prompt=item['user_prompt'],
+                                      request_type=item['request_type'],
+                                      description_variable=item['description_variable'],
+                                      description_variables=item['description_variables'],
+                                      callback=callback)
+
+def update_image_descriptions_from_zipfile(project, zip_ref, callback=None):
+    metadata = read_json_from_zipfile(zip_ref, 'image_descriptions/metadata.json')
+    if not metadata:
+        # There are no image_descriptions in this zipfile
+        return
+    for item in metadata:
         project.add_project_image_description(item['description_variable'],
                                               item['explanation'],
                                               callback=callback)
@@ -307,10 +356,11 @@ def update_image_descriptions_from_imported_directory(project, tmp_dir, callback
 
 ## Only import human audio, we can recreate TTS audio
 
-def update_regular_audio_from_imported_directory(project, tmp_dir, callback=None):
-    audio_dir = absolute_local_file_name(os.path.join(tmp_dir, 'audio'))
-    global_metadata = get_global_metadata(tmp_dir)
-    if not local_directory_exists(audio_dir) or not global_metadata or not global_metadata['human_voice_id']:
+def update_regular_audio_from_zipfile(project, zip_ref, global_metadata, callback=None):
+    if not global_metadata or not global_metadata['human_voice_id']:
+        return
+    audio_metadata = get_normal_audio_metadata_from_zipfile(zip_ref, callback=callback)
+    if not audio_metadata or not isinstance(audio_metadata, (dict)) or not 'words' in audio_metadata or not 'segments' in audio_metadata:
         return
     language = project.l2_language
     annotator = AudioAnnotator(language,
@@ -319,27 +369,25 @@ def update_regular_audio_from_imported_directory(project, tmp_dir, callback=None
                                audio_type_for_words=global_metadata['audio_type_for_words'],
                                audio_type_for_segments=global_metadata['audio_type_for_segments'],
                                callback=callback)
-    audio_metadata = get_normal_audio_metadata(tmp_dir, callback=callback)
-    if not audio_metadata or not isinstance(audio_metadata, (dict)) or not 'words' in audio_metadata or not 'segments' in audio_metadata:
-        return
-    
+
     if global_metadata['audio_type_for_words'] == 'human':
         words_metadata_for_update = [ { 'text': item['text'], 'file': item['file'] }
                                       for item in audio_metadata['words']
                                       if 'file' in item and item['file'] ]
-        post_task_update(callback, 'Storing human audio for words ({len(words_metadata_for_update)} items)')
-        annotator._store_existing_human_audio_mp3s(words_metadata_for_update, audio_dir, words_or_segments='words', callback=callback)
+        post_task_update(callback, f'Storing human audio for words ({len(words_metadata_for_update)} items)')
+        store_human_audio_from_zipfile(annotator, zip_ref, 'audio', words_metadata_for_update, words_or_segments='words', callback=callback)
     if global_metadata['audio_type_for_segments'] == 'human':
         segments_metadata_for_update = [ { 'text': item['text'], 'file': item['file'] }
                                          for item in audio_metadata['segments']
                                          if 'file' in item and item['file'] ]
-        post_task_update(callback, 'Storing human audio for segments ({len(segments_metadata_for_update)} items)')
-        annotator._store_existing_human_audio_mp3s(segments_metadata_for_update, audio_dir, words_or_segments='segments', callback=callback)
-                                         
-def update_phonetic_audio_from_imported_directory(project, tmp_dir, callback=None):
-    audio_dir = absolute_local_file_name(os.path.join(tmp_dir, 'phonetic_audio'))
-    global_metadata = get_global_metadata(tmp_dir)
-    if not local_directory_exists(audio_dir) or not global_metadata or not global_metadata['human_voice_id_phonetic']:
+        post_task_update(callback, f'Storing human audio for segments ({len(segments_metadata_for_update)} items)')
+        store_human_audio_from_zipfile(annotator, zip_ref, 'audio', segments_metadata_for_update, words_or_segments='segments', callback=callback)
+
+def update_phonetic_audio_from_zipfile(project, zip_ref, global_metadata, callback=None):
+    if not global_metadata or not global_metadata['human_voice_id_phonetic']:
+        return
+    audio_metadata = get_phonetic_audio_metadata_from_zipfile(zip_ref, callback=callback)
+    if not audio_metadata or not isinstance(audio_metadata, (dict)) or not 'words' in audio_metadata:
         return
     language = project.l2_language
     annotator = AudioAnnotator(language,
@@ -348,36 +396,67 @@ def update_phonetic_audio_from_imported_directory(project, tmp_dir, callback=Non
                                audio_type_for_words='human',
                                audio_type_for_segments='tts',
                                callback=callback)
-    audio_metadata = get_phonetic_audio_metadata(tmp_dir, callback=callback)
-    if not audio_metadata or not isinstance(audio_metadata, (dict)) or not 'words' in audio_metadata:
-        return
 
     phonemes_metadata_for_update = [ { 'text': item['word'], 'file': item['file'] }
                                      for item in audio_metadata['words'] ]
-    post_task_update(callback, 'Storing human audio for phonemes ({len(phonemes_metadata_for_update)} items)')
-    annotator._store_existing_human_audio_mp3s(phonemes_metadata_for_update, audio_dir, callback=callback)
-
-def get_global_metadata(tmp_dir, callback=None):
-    metadata_file = absolute_local_file_name(os.path.join(tmp_dir, 'metadata.json'))
-    if not local_file_exists(metadata_file):
-        return None
+    post_task_update(callback, f'Storing human audio for phonemes ({len(phonemes_metadata_for_update)} items)')
+    store_human_audio_from_zipfile(annotator, zip_ref, 'phonetic_audio', phonemes_metadata_for_update, callback=callback)
+
+# Copy the mp3s into the audio repository using a pool of threads, since on S3 each copy is a separate upload.
+# Entries are extracted one at a time on this thread, and at most a few are waiting in the tmp dir at any moment.
+# The repository entries are then added in order, since the context for each segment depends on the previous ones.
+def store_human_audio_from_zipfile(annotator, zip_ref, audio_dir_in_zipfile, metadata, words_or_segments='segments', callback=None):
+    max_workers = int(config.get('export_import', 'max_workers'))
+    slots = threading.BoundedSemaphore(2 * max_workers)
+
+    def store_mp3_and_remove_tmp_file(tmp_file):
+        try:
+            return annotator.audio_repository.store_mp3('human_voice', annotator.language, annotator.human_voice_id, tmp_file, keep_file_name=False)
+        finally:
+            remove_local_file(tmp_file)
+            slots.release()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for i, item in enumerate(metadata):
+                slots.acquire()
+                try:
+                    # Prefix with the index, in case different directories in the exporting system had files with the same name
+                    tmp_item_dir = os.path.join(tmp_dir, str(i))
+                    os.makedirs(tmp_item_dir)
+                    tmp_file = extract_zipfile_entry_to_tmp_dir(zip_ref, f"{audio_dir_in_zipfile}/{item['file']}", tmp_item_dir)
+                except Exception as e:
+                    slots.release()
+                    post_task_update(callback, f"*** Error trying to extract audio file for metadata item {item}: {str(e)}")
+                    futures.append(None)
+                    continue
+                futures.append(executor.submit(store_mp3_and_remove_tmp_file, tmp_file))
+
+        stored_metadata = []
+        for item, future in zip(metadata, futures):
+            try:
+                file_path = future.result() if future else None
+            except Exception as e:
+                post_task_update(callback, f"*** Error trying to store audio file for metadata item {item}: {str(e)}")
+                file_path = None
+            stored_metadata.append({ 'text': item['text'], 'file_path': file_path })
+
+    post_task_update(callback, f'--- Copied {len([ item for item in stored_metadata if item["file_path"] ])}/{len(metadata)} mp3s to audio repository')
+    annotator._add_stored_human_audio_entries(stored_metadata, words_or_segments=words_or_segments, callback=callback)
+
+def get_normal_audio_metadata_from_zipfile(zip_ref, callback=None):
+    metadata = read_json_from_zipfile(zip_ref, 'audio/metadata.json')
+    if metadata is None:
+        post_task_update(callback, f'--- Normal audio metadata file not found')
     else:
-        return read_json_local_file(metadata_file)
+        post_task_update(callback, f'--- Normal audio metadata file found')
+    return metadata
 
-def get_normal_audio_metadata(tmp_dir, callback=None):
-    metadata_file = absolute_local_file_name(os.path.join(tmp_dir, 'audio', 'metadata.json'))
-    if not local_file_exists(metadata_file):
-        post_task_update(callback, f'--- Normal audio metadata file {metadata_file} not found')
-        return None
-    else:
-        post_task_update(callback, f'--- Normal audio metadata file {metadata_file} found')
-        return read_json_local_file(metadata_file)
-
-def get_phonetic_audio_metadata(tmp_dir, callback=None):
-    metadata_file = absolute_local_file_name(os.path.join(tmp_dir, 'phonetic_audio', 'metadata.json'))
-    if not local_file_exists(metadata_file):
-        post_task_update(callback, f'--- Phonetic audio metadata file {metadata_file} not found')
-        return None
+def get_phonetic_audio_metadata_from_zipfile(zip_ref, callback=None):
+    metadata = read_json_from_zipfile(zip_ref, 'phonetic_audio/metadata.json')
+    if metadata is None:
+        post_task_update(callback, f'--- Phonetic audio metadata file not found')
     else:
-        post_task_update(callback, f'--- Phonetic audio metadata file {metadata_file} found')
-        return read_json_local_file(metadata_file)
+        post_task_update(callback, f'--- Phonetic audio metadata file found')
+    return metadata
@@ -0,0 +1,125 @@
+"""
+Thumbnails and resized renditions of the images in the image repository.
+
+DALL-E-3 images are large PNGs, but pages usually show them at a few hundred pixels wide. When an image is stored,
+we make the thumbnail and note the dimensions of the image and the thumbnail straight away, since both are cheap
+once the image is open. The dimensions are kept in ImageMetadata, so rendering doesn't need to open the image again.
+
+The renditions, WebP and JPEG versions at each of the widths in the config file, take longer, and are made
+on a background worker pool. They are stored next to the original in the project's image directory, with names
+like <name>_w640.webp, and listed in ImageMetadata.renditions when they are ready. Until then, and for images
+smaller than a rendition width, pages just use the original image.
+
+All reading and writing goes through the clara_utils storage functions, so this works with S3 as well:
+the original is copied to a local temporary directory, and the renditions are made there and then uploaded.
+When an image file is replaced, its old renditions are removed, see remove_renditions.
+"""
+
+from django.db import connections
+
+from .models import ImageMetadata
+
+from .clara_utils import get_config, generate_thumbnail_name, get_image_dimensions, basename
+from .clara_utils import copy_to_local_file, copy_local_file, file_exists, remove_file
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image as PILImage
+
+import os
+import tempfile
+import threading
+import traceback
+
+config = get_config()
+
+_rendition_format_extensions = { 'webp': 'webp', 'jpeg': 'jpg' }
+
+def rendition_widths():
+    return [ int(width.strip()) for width in config.get('image_repository', 'rendition_widths').split(',') ]
+
+def rendition_formats():
+    return [ image_format.strip() for image_format in config.get('image_repository', 'rendition_formats').split(',') ]
+
+def rendition_file_name(file_path, width, image_format):
+    name, _ext = os.path.splitext(file_path)
+    return f'{name}_w{width}.{_rendition_format_extensions[image_format]}'
+
+# Make the thumbnail for an image being stored at destination_path
+def make_thumbnail(source_file, destination_path):
+    with PILImage.open(source_file) as original_image:
+        original_image.thumbnail(( 100, 100 ))
+        thumbnail_destination_path = generate_thumbnail_name(destination_path)
+        original_image.save(thumbnail_destination_path)
+    return thumbnail_destination_path
+
+# Return a dict with the dimensions of an image and its thumbnail. Dimensions which can't be found are left out.
+def image_and_thumbnail_dimensions(file_path):
+    dimensions = {}
+    for prefix, path in ( ( '', file_path ), ( 'thumbnail_', generate_thumbnail_name(file_path) ) ):
+        width, height = get_image_dimensions(path)
+        if width and height:
+            dimensions[f'{prefix}width'], dimensions[f'{prefix}height'] = width, height
+    return dimensions
+
+# Make the renditions for an image, returning a list of dicts with keys 'width', 'height', 'format' and 'file'
+def make_renditions(file_path):
+    renditions = []
+    quality = int(config.get('image_repository', 'rendition_quality'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_file = os.path.join(temp_dir, basename(file_path))
+        copy_to_local_file(file_path, local_file)
+        with PILImage.open(local_file) as original_image:
+            original_width, original_height = original_image.size
+            # JPEG has no alpha channel, and DALL-E-3 PNGs are RGB anyway
+            rgb_image = original_image.convert('RGB')
+        for width in rendition_widths():
+            if width >= original_width:
+                continue
+            height = max(1, round(original_height * width / original_width))
+            resized_image = rgb_image.resize(( width, height ), PILImage.LANCZOS)
+            for image_format in rendition_formats():
+                rendition_file = rendition_file_name(file_path, width, image_format)
+                local_rendition_file = os.path.join(temp_dir, basename(rendition_file))
+                resized_image.save(local_rendition_file, format=image_format.upper(), quality=quality)
+                copy_local_file(local_rendition_file, rendition_file)
+                renditions.append({ 'width': width, 'height': height, 'format': image_format, 'file': rendition_file })
+    return renditions
+
+# Remove any renditions of the image file_path, e.g. because the file has been replaced
+def remove_renditions(file_path):
+    for width in rendition_widths():
+        for image_format in rendition_formats():
+            rendition_file = rendition_file_name(file_path, width, image_format)
+            try:
+                if file_exists(rendition_file):
+                    remove_file(rendition_file)
+            except Exception as e:
+                print(f'*** Warning: unable to remove old rendition {rendition_file}: {str(e)}')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_derivative_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(config.get('image_repository', 'max_derivative_workers')),
+                                           thread_name_prefix='image_derivatives')
+        return _executor
+
+# Make the renditions for an image entry in the background, and record them in its ImageMetadata entry.
+# If the entry has been given a different file in the meantime, the renditions are not recorded.
+def schedule_renditions(project_id, image_name, file_path):
+    return get_derivative_executor().submit(make_and_record_renditions, project_id, image_name, file_path)
+
+def make_and_record_renditions(project_id, image_name, file_path):
+    try:
+        renditions = make_renditions(file_path)
+        ImageMetadata.objects.filter(project_id=project_id, image_name=image_name, file_path=file_path).update(renditions=renditions)
+        return renditions
+    except Exception as e:
+        print(f'*** Error when making renditions for {file_path}: {str(e)}\n{traceback.format_exc()}')
+        return []
+    finally:
+        # Django database connections belong to the thread that opened them
+        connections.close_all()
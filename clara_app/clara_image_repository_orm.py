@@ -9,9 +9,13 @@ Classes:
 
 The ImageRepositoryORM class provides methods for adding entries, retrieving entries,
 getting the image directory, and storing image files.
+
+- ProjectImageData: all the image entries and descriptions for a project, fetched together
+and indexed in memory, for code like the coherent image pipeline that would otherwise look them up one at a time.
 """
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
 from .models import ImageMetadata, ImageDescription
 
@@ -24,9 +28,9 @@ from .clara_utils import adjust_file_path_for_imported_data, generate_thumbnail_
 
 from .clara_classes import Image, ImageDescriptionObject, InternalCLARAError
 
-from pathlib import Path
+from .clara_image_derivatives import make_thumbnail, image_and_thumbnail_dimensions, schedule_renditions, remove_renditions
 
-from PIL import Image as PILImage
+from pathlib import Path
 
 import os
 import traceback
@@ -71,24 +75,43 @@ class ImageRepositoryORM:
             project_id = str(project_id)
             page = int(page)
 
+            defaults={
+                'file_path': file_path,
+                'associated_text': associated_text,
+                'associated_areas': associated_areas,
+                'page': page,
+                'position': position,
+                'style_description': style_description,
+                'content_description': content_description,
+                'request_type': request_type,
+                'description_variable': description_variable,
+                'description_variables': description_variables,  
+                'user_prompt': user_prompt
+            }
+
+            # Most updates only change the text or descriptions. If the image file is new, or we don't have
+            # its dimensions yet, get them and replace the renditions, which are made in the background.
+            # store_image clears the dimensions when it overwrites a file, so that case is included.
+            previous = ImageMetadata.objects.filter(project_id=project_id, image_name=image_name).values('file_path', 'width').first()
+            new_file = not previous or previous['file_path'] != file_path or previous['width'] is None
+            if new_file:
+                dimensions = image_and_thumbnail_dimensions(file_path)
+                defaults.update(dimensions)
+                defaults['renditions'] = []
+                if previous and previous['file_path'] and previous['file_path'] != file_path:
+                    remove_renditions(previous['file_path'])
+
             obj, created = ImageMetadata.objects.update_or_create(
                 project_id=project_id, 
                 image_name=image_name,
-                defaults={
-                    'file_path': file_path,
-                    'associated_text': associated_text,
-                    'associated_areas': associated_areas,
-                    'page': page,
-                    'position': position,
-                    'style_description': style_description,
-                    'content_description': content_description,
-                    'request_type': request_type,
-                    'description_variable': description_variable,
-                    'description_variables': description_variables,  
-                    'user_prompt': user_prompt
-                }
+                defaults=defaults
             )
 
+            # If we can't read the image, we wouldn't be able to make renditions either
+            if new_file and file_path and 'width' in dimensions:
+                # Start after the transaction commits, so that the worker can find the entry
+                transaction.on_commit(lambda: schedule_renditions(project_id, image_name, file_path))
+
             if created:
                 post_task_update(callback, f'--- Created new image entry for project_id={project_id} and image_name={image_name}')
             else:
@@ -175,25 +198,7 @@ class ImageRepositoryORM:
             project_id = str(project_id)
             
             entry = ImageMetadata.objects.get(project_id=project_id, image_name=image_name)
-            thumbnail = generate_thumbnail_name(entry.file_path)
-            
-            image = Image(
-                entry.file_path,
-                thumbnail,
-                entry.image_name,
-                entry.associated_text,
-                entry.associated_areas,
-                entry.page,
-                entry.position,
-                style_description=entry.style_description,
-                content_description=entry.content_description,
-                request_type=entry.request_type,
-                description_variable=entry.description_variable,
-                description_variables=entry.description_variables,
-                user_prompt=entry.user_prompt
-            )
-
-            return image
+            return image_metadata_entry_to_image(entry)
 
         except ObjectDoesNotExist:
             post_task_update(callback, f'*** No entry found for "{image_name}" in Image database.')
@@ -211,25 +216,7 @@ class ImageRepositoryORM:
                                               page=page,
                                               position=position,
                                               request_type='image-generation')
-            thumbnail = generate_thumbnail_name(entry.file_path)
-            
-            image = Image(
-                entry.file_path,
-                thumbnail,
-                entry.image_name,
-                entry.associated_text,
-                entry.associated_areas,
-                entry.page,
-                entry.position,
-                style_description=entry.style_description,
-                content_description=entry.content_description,
-                request_type=entry.request_type,
-                description_variable=entry.description_variable,
-                description_variables=entry.description_variables, 
-                user_prompt=entry.user_prompt
-            )
-
-            return image
+            return image_metadata_entry_to_image(entry)
                     
         except ObjectDoesNotExist:
             post_task_update(callback, f'*** No entry found for page={page}, position={position}, request_type=image-generation in Image database.')
@@ -247,26 +234,7 @@ class ImageRepositoryORM:
             # Fetch all entries for the given project_id from the ORM
             entries = ImageMetadata.objects.filter(project_id=project_id)
 
-            images = []
-            for entry in entries:
-                # Generate thumbnail name
-                thumbnail = generate_thumbnail_name(entry.file_path)
-                
-                # Construct an Image object for each entry
-                image = Image(entry.file_path,
-                              thumbnail,
-                              entry.image_name,
-                              entry.associated_text,
-                              entry.associated_areas,
-                              entry.page,
-                              entry.position,
-                              style_description=entry.style_description,
-                              content_description=entry.content_description,
-                              request_type=entry.request_type,
-                              description_variable=entry.description_variable,
-                              description_variables=entry.description_variables,
-                              user_prompt=entry.user_prompt)
-                images.append(image)
+            images = [ image_metadata_entry_to_image(entry) for entry in entries ]
 
             post_task_update(callback, f'--- Retrieved {len(images)} images for project {project_id}')
             return images
@@ -276,6 +244,25 @@ class ImageRepositoryORM:
             post_task_update(callback, error_message)
             raise InternalCLARAError(message='Image database inconsistency')
 
+    # Get all the image entries and descriptions for a project, using one query for each table
+    def get_project_image_data(self, project_id, callback=None):
+        try:
+            project_id = str(project_id)
+            post_task_update(callback, f'--- Retrieving all image data for project {project_id}')
+
+            images = [ image_metadata_entry_to_image(entry)
+                       for entry in ImageMetadata.objects.filter(project_id=project_id) ]
+            descriptions = [ ImageDescriptionObject(entry.project_id, entry.description_variable, entry.explanation)
+                             for entry in ImageDescription.objects.filter(project_id=project_id) ]
+
+            post_task_update(callback, f'--- Retrieved {len(images)} images and {len(descriptions)} descriptions for project {project_id}')
+            return ProjectImageData(project_id, images, descriptions)
+                
+        except Exception as e:
+            error_message = f'*** Error when retrieving image data for project {project_id}: {str(e)}\n{traceback.format_exc()}'
+            post_task_update(callback, error_message)
+            raise InternalCLARAError(message='Image database inconsistency')
+
     def store_image(self, project_id, source_file, keep_file_name=True, callback=None):
         try:
             project_id = str(project_id)
@@ -287,13 +274,15 @@ class ImageRepositoryORM:
             destination_path = str(Path(project_dir) / file_name)
             copy_local_file(source_file, destination_path)
 
-            # Generate and store thumbnail
+            # If this replaces an existing file, its renditions and dimensions are out of date.
+            # Clearing the dimensions makes add_entry treat the file as new.
+            remove_renditions(destination_path)
+            ImageMetadata.objects.filter(project_id=project_id, file_path=destination_path).update(
+                renditions=[], width=None, height=None, thumbnail_width=None, thumbnail_height=None)
+
+            # Generate and store thumbnail. The other renditions are made in the background when the entry is added.
             try:
-                original_image = PILImage.open(source_file)
-                thumbnail_size = (100, 100)  # Example size, adjust as needed
-                original_image.thumbnail(thumbnail_size)
-                thumbnail_destination_path = generate_thumbnail_name(destination_path)
-                original_image.save(thumbnail_destination_path)
+                thumbnail_destination_path = make_thumbnail(source_file, destination_path)
 
                 post_task_update(callback, f'--- Image and thumbnail stored at {destination_path} and {thumbnail_destination_path}')
             except Exception as e:
@@ -432,6 +421,26 @@ class ImageRepositoryORM:
             post_task_update(callback, error_message)
             raise InternalCLARAError(message='Image description database inconsistency')
 
+    # Replace all the descriptions for a project with a list of ( description_variable, explanation ) pairs,
+    # in one transaction and one insert
+    def replace_all_descriptions(self, project_id, descriptions, callback=None):
+        try:
+            project_id = str(project_id)
+            # Later values for the same variable override earlier ones, as they would with add_description
+            explanations = { str(description_variable): explanation for description_variable, explanation in descriptions }
+            with transaction.atomic():
+                ImageDescription.objects.filter(project_id=project_id).delete()
+                ImageDescription.objects.bulk_create([ ImageDescription(project_id=project_id,
+                                                                        description_variable=description_variable,
+                                                                        explanation=explanation)
+                                                       for description_variable, explanation in explanations.items() ])
+            post_task_update(callback, f'--- Stored {len(explanations)} descriptions for project {project_id}')
+
+        except Exception as e:
+            error_message = f'*** Error when replacing descriptions for project {project_id}: "{str(e)}"\n{traceback.format_exc()}'
+            post_task_update(callback, error_message)
+            raise InternalCLARAError(message='Image description database inconsistency')
+
     # Remove a single description
     def remove_description(self, project_id, description_variable, callback=None):
         try:
@@ -469,4 +478,68 @@ class ImageRepositoryORM:
         # Returns the directory path where images for a specific project are stored
         return absolute_file_name(Path(self.base_dir) / str(project_id))
 
-
+def image_metadata_entry_to_image(entry):
+    thumbnail = generate_thumbnail_name(entry.file_path)
+    return Image(entry.file_path,
+                 thumbnail,
+                 entry.image_name,
+                 entry.associated_text,
+                 entry.associated_areas,
+                 entry.page,
+                 entry.position,
+                 style_description=entry.style_description,
+                 content_description=entry.content_description,
+                 request_type=entry.request_type,
+                 description_variable=entry.description_variable,
+                 description_variables=entry.description_variables,
+                 user_prompt=entry.user_prompt,
+                 width=entry.width,
+                 height=entry.height,
+                 thumbnail_width=entry.thumbnail_width,
+                 thumbnail_height=entry.thumbnail_height,
+                 renditions=entry.renditions)
+
+# The image entries and descriptions for a project, indexed so that lookups don't need to go back to the database.
+# Code which updates the database through the repository while using one of these should also call
+# the corresponding update method, so that later lookups see the new values.
+class ProjectImageData:
+    def __init__(self, project_id, images, descriptions):
+        self.project_id = str(project_id)
+        self.images = []
+        self.images_by_name = {}
+        self.generated_images_by_position = {}
+        self.understanding_results = {}
+        for image in images:
+            self.update_image(image)
+        self.descriptions = { description.description_variable: description for description in descriptions }
+
+    def get_image(self, image_name):
+        return self.images_by_name.get(image_name, None)
+
+    def get_generated_image_by_position(self, page, position):
+        return self.generated_images_by_position.get(( int(page), position ), None)
+
+    def get_description(self, description_variable):
+        return self.descriptions.get(str(description_variable), None)
+
+    def get_understanding_result(self, description_variable):
+        return self.understanding_results.get(description_variable, None)
+
+    # Mirror ImageRepositoryORM.add_entry
+    def update_image(self, image):
+        old_image = self.images_by_name.get(image.image_name, None)
+        if old_image:
+            self.images.remove(old_image)
+        self.images.append(image)
+        self.images_by_name[image.image_name] = image
+        if image.request_type == 'image-generation':
+            self.generated_images_by_position[( int(image.page), image.position )] = image
+        if image.description_variable:
+            self.understanding_results[image.description_variable] = image.content_description
+
+    # Mirror ImageRepositoryORM.store_understanding_result
+    def update_understanding_result(self, description_variable, result):
+        self.understanding_results[description_variable] = result
+        for image in self.images:
+            if image.description_variable == description_variable:
+                image.content_description = result
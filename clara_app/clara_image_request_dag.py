@@ -0,0 +1,108 @@
+"""
+Dependency graph for the coherent image request sequences produced by create_image_request_sequence.
+
+A sequence mixes two kinds of request:
+
+- 'image-generation' requests create the image for a page and position, using the descriptions
+  held in their "description_variables"
+- 'image-understanding' requests read the image for a page and position, and store a description
+  in their "description_variable"
+
+Processed strictly in order, every request waits for all the ones before it, though most of them only
+need a few earlier results. Here we treat each image and each description variable as a resource that
+requests read and write. A request depends on the last earlier request writing anything it reads or writes,
+and, if it writes a resource, on the earlier requests reading the previous value. Running the requests in any
+order consistent with these dependencies gives the same results as running them in sequence.
+
+run_image_request_dag runs the requests in a thread pool, starting each one as soon as everything it depends on
+has finished. The caller can pass in the requests already completed in a previous run, and is told
+each time another one completes, so that a failed run can be resumed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
+import traceback
+
+# Return ( reads, writes ), the sets of resources read and written by a request
+def image_request_reads_and_writes(request):
+    image = ( 'image', request['page'], request.get('position', 0) )
+    if request['request_type'] == 'image-generation':
+        reads = set( ( 'description', variable ) for variable in request.get('description_variables', None) or [] )
+        writes = { image }
+    else:
+        reads = { image }
+        writes = { ( 'description', request['description_variable'] ) }
+    return reads, writes
+
+# Return a list with one set per request, holding the indices of the earlier requests it depends on
+def image_request_dependencies(requests):
+    last_writer = {}
+    readers_since_last_write = {}
+    dependencies = []
+    for index, request in enumerate(requests):
+        reads, writes = image_request_reads_and_writes(request)
+        request_dependencies = set()
+        for resource in reads | writes:
+            if resource in last_writer:
+                request_dependencies.add(last_writer[resource])
+        for resource in writes:
+            request_dependencies.update(readers_since_last_write.get(resource, []))
+        for resource in reads:
+            readers_since_last_write.setdefault(resource, []).append(index)
+        for resource in writes:
+            last_writer[resource] = index
+            readers_since_last_write[resource] = []
+        request_dependencies.discard(index)
+        dependencies.append(request_dependencies)
+    return dependencies
+
+# Hash identifying a request sequence, so that we only resume a run for the same sequence
+def image_request_sequence_hash(requests):
+    keys = ( 'request_type', 'image_name', 'page', 'position', 'user_prompt', 'content_description', 'style_description',
+             'description_variable', 'description_variables' )
+    key_material = [ { key: request.get(key, None) for key in keys } for request in requests ]
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Run the requests, calling run_request(index) for each one not in 'completed'. run_request should return True if it succeeded.
+# on_completed(index) is called, on this thread, each time a request succeeds.
+# When a request fails, no more requests are started, and we return after the running ones have finished.
+# Returns the list of indices of the requests which failed.
+def run_image_request_dag(requests, run_request, max_workers, completed=None, on_completed=None):
+    dependencies = image_request_dependencies(requests)
+    completed = set(completed) if completed else set()
+    pending = [ index for index in range(len(requests)) if not index in completed ]
+    failed = []
+    running = {}
+
+    def safe_run_request(index):
+        try:
+            return run_request(index)
+        except Exception as e:
+            print(f'*** Error in image request {index}: "{str(e)}"\n{traceback.format_exc()}')
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if not failed:
+                ready = [ index for index in pending if dependencies[index] <= completed ]
+                for index in ready:
+                    pending.remove(index)
+                    running[executor.submit(safe_run_request, index)] = index
+            if not running:
+                break
+            done, _not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                if future.result():
+                    completed.add(index)
+                    if on_completed:
+                        on_completed(index)
+                else:
+                    failed.append(index)
+
+    # If nothing failed, everything should have run. Anything left means the dependencies were circular, which can't happen
+    # for dependencies computed from a sequence, but we check anyway
+    if not failed and pending:
+        failed = pending
+    return failed
@@ -4,8 +4,8 @@ Converts LDT output into a suitable form, converting the .wav files to .mp3
 """
 
 from .clara_utils import post_task_update, file_exists, directory_exists, local_file_exists
+from .clara_audio_splitter import convert_audio_file, run_in_parallel
 
-import subprocess
 import os
 import traceback
 
@@ -17,6 +17,22 @@ def convert_ldt_data_to_mp3(ldt_metadata, temp_ldt_dir, temp_mp3_dir, callback=N
         if not directory_exists(temp_mp3_dir):
             post_task_update(callback, f'*** Error in wav to mp3 conversion: mp3 directory {temp_mp3_dir} not found')
             return []
+
+        # The conversions are independent, so do them in parallel before going through the metadata
+        conversions = []
+        for entry in ldt_metadata:
+            if entry["file"]:
+                base_name = os.path.splitext(entry["file"])[0]
+                source_wav_path = os.path.join(temp_ldt_dir, entry["file"])
+                dest_mp3_path = os.path.join(temp_mp3_dir, f"{base_name}.mp3")
+                if local_file_exists(source_wav_path) and not local_file_exists(dest_mp3_path) and \
+                   not ( source_wav_path, dest_mp3_path ) in conversions:
+                    conversions.append(( source_wav_path, dest_mp3_path ))
+        post_task_update(callback, f'--- Converting {len(conversions)} .wav files to .mp3')
+        # Failed conversions are reported below, when we find the .mp3 file is missing
+        run_in_parallel(convert_audio_file, conversions, raise_errors=False)
+        converted = set( dest_mp3_path for ( source_wav_path, dest_mp3_path ) in conversions )
+
         for entry in ldt_metadata:
             if not entry["file"]:
                 continue
@@ -33,25 +49,15 @@ def convert_ldt_data_to_mp3(ldt_metadata, temp_ldt_dir, temp_mp3_dir, callback=N
                 post_task_update(callback, f'*** Error in wav to mp3 conversion: Source .wav file not found: {source_wav_path}')
                 continue
 
-            post_task_update(callback, f'--- Converting {source_wav_path} to {dest_mp3_path}')
-            
-            # Use ffmpeg to convert .wav to .mp3 and capture its output
-
-            if local_file_exists(dest_mp3_path):
+            if not dest_mp3_path in converted:
                 post_task_update(callback, f'--- target .mp3 file already exists: {dest_mp3_path}')
             else:
-                result = subprocess.run(["ffmpeg", "-i", source_wav_path, dest_mp3_path], capture_output=True, text=True)
-
                 if not local_file_exists(dest_mp3_path):
                     post_task_update(callback, f'*** Error in wav to mp3 conversion: Target .mp3 file not found: {dest_mp3_path}')
                     continue
                 else:
                     post_task_update(callback, f'--- Created {dest_mp3_path}')
             
-            # Log ffmpeg output for diagnostics
-            #post_task_update(callback, f'--- ffmpeg stdout: {result.stdout}')
-            #post_task_update(callback, f'--- ffmpeg stderr: {result.stderr}')
-            
             # Update the metadata entry to refer to the .mp3 file
             entry["file"] = f"{base_name}.mp3"
 
@@ -157,8 +157,9 @@ from .clara_renderer import StaticHTMLRenderer
 from .clara_annotated_images import add_image_to_text
 from .clara_phonetic_text import segmented_text_to_phonetic_text
 from .clara_acknowledgements import add_acknowledgements_to_text_object
-from .clara_export_import import create_export_zipfile, change_project_id_in_imported_directory, update_multimedia_from_imported_directory
-from .clara_export_import import get_global_metadata, rename_files_in_project_dir, update_metadata_file_paths
+from .clara_export_import import create_export_zipfile, import_project_directory_from_zipfile, update_multimedia_from_zipfile
+from .clara_export_import import get_global_metadata_from_zipfile
+from .clara_project_metadata import ProjectMetadataStore, metadata_entry_description
 #from .clara_utils import _use_orm_repositories
 from .clara_utils import absolute_file_name, absolute_local_file_name
 from .clara_utils import read_json_file, write_json_to_file, read_txt_file, write_txt_file, read_local_txt_file, robust_read_local_txt_file
@@ -166,9 +167,10 @@ from .clara_utils import rename_file, remove_file, get_file_time, file_exists, l
 from .clara_utils import make_directory, remove_directory, directory_exists, copy_directory, list_files_in_directory
 from .clara_utils import local_directory_exists, remove_local_directory
 from .clara_utils import get_config, make_line_breaks_canonical_n, make_line_breaks_canonical_linesep, format_timestamp, get_file_time
-from .clara_utils import unzip_file, post_task_update, convert_to_timezone_aware
+from .clara_utils import post_task_update, convert_to_timezone_aware
 
 from pathlib import Path
+from zipfile import ZipFile
 from typing import List, Dict, Tuple, Optional, Union
 
 import re
@@ -210,6 +212,7 @@ class CLARAProjectInternal:
         }
         self.internalised_and_annotated_text_path = self.project_dir / 'internalised_and_annotated_text.pickle'
         self.internalised_and_annotated_text_path_phonetic = self.project_dir / 'internalised_and_annotated_text_phonetic.pickle'
+        self.metadata_store = ProjectMetadataStore(self.project_dir)
         self.image_repository = ImageRepositoryORM()
         #self.image_repository = ImageRepositoryORM() if _use_orm_repositories else ImageRepository()
         self._ensure_directories()
@@ -256,30 +259,23 @@ class CLARAProjectInternal:
         project._load_existing_text_versions()
         return project
 
-    # Reconstitute a CLARAProjectInternal from an export zipfile
+    # Reconstitute a CLARAProjectInternal from an export zipfile.
+    # We read the entries straight from the zipfile rather than unpacking it to a tmp dir first.
     @classmethod
     def create_CLARAProjectInternal_from_zipfile(cls, zipfile: str, new_id: str, callback=None) -> 'CLARAProjectInternal':
         try:
-            tmp_dir = tempfile.mkdtemp()
-            unzip_file(zipfile, tmp_dir)
-            post_task_update(callback, '--- Unzipped import file')
-            change_project_id_in_imported_directory(tmp_dir, new_id)
-            tmp_project_dir = os.path.join(tmp_dir, 'project_dir')
-            rename_files_in_project_dir(tmp_project_dir, new_id)
-            project = cls.from_directory(tmp_project_dir)
-            update_metadata_file_paths(project, project.project_dir, callback=callback)
-            update_multimedia_from_imported_directory(project, tmp_dir, callback=callback)
-            global_metadata = get_global_metadata(tmp_dir)
+            with ZipFile(absolute_local_file_name(zipfile), 'r') as zip_ref:
+                post_task_update(callback, '--- Opened import file')
+                global_metadata = get_global_metadata_from_zipfile(zip_ref)
+                stored_data = import_project_directory_from_zipfile(zip_ref, str(cls.BASE_DIR / new_id), new_id, callback=callback)
+                project = cls(new_id, stored_data['l2_language'], stored_data['l1_language'])
+                update_multimedia_from_zipfile(project, zip_ref, global_metadata, callback=callback)
             return ( project, global_metadata )
         except Exception as e:
             post_task_update(callback, f'*** Error when trying to import zipfile {zipfile}')
             error_message = f'"{str(e)}"\n{traceback.format_exc()}'
             post_task_update(callback, error_message)
             return ( None, None )
-        finally:
-            # Remove the tmp dir once we've used it
-            if local_directory_exists(tmp_dir):
-                remove_local_directory(tmp_dir)
             
     # If there are already files in the associated directory, update self.text_versions
     def _load_existing_text_versions(self) -> None:
@@ -348,7 +344,8 @@ class CLARAProjectInternal:
         file_path = self._file_path_for_version(version)
 
         # For downward compatibility, guess metadata for existing files if necessary, assuming they were created by this user.
-        self._create_metadata_file_if_missing(user)
+        if self.metadata_store.is_missing():
+            self._create_metadata_file_if_missing(user)
         
         # Archive the old version, if it exists
         if file_exists(file_path):
@@ -370,36 +367,24 @@ class CLARAProjectInternal:
         self.text_versions[version] = str(file_path)
 
     def get_file_description(self, version, file):
-        metadata = self.get_metadata()
-        relevant_metadata = [ item for item in metadata if item['version'] == version ]
+        relevant_metadata = self.metadata_store.get_entries_for_version(version)
         if relevant_metadata == []:
             result = ""
         elif file == 'current':
-            result = relevant_metadata[-1]['description']
+            result = metadata_entry_description(relevant_metadata[-1])
         else:
-            metadata_for_file = [ item for item in metadata if item['file'] == file ]
-            if metadata_for_file == []:
+            metadata_for_file = self.metadata_store.get_entry_for_file(file)
+            if metadata_for_file is None:
                 result = ""
             else:
-                result = metadata_for_file[0]['description']
+                result = metadata_entry_description(metadata_for_file)
         return result
 
     def get_metadata(self):
-        metadata_file = self._get_metadata_file()
-        if not file_exists(metadata_file):
-            return []
-        else:
-            metadata = read_json_file(metadata_file)
-            for item in metadata:
-                provenance = item['source'] if item['source'] != "human_revised" else item['source']
-                timestamp = format_timestamp(item['timestamp'])
-                gold_standard = ' (gold standard)' if item['gold_standard'] else ''
-                label = f' {item["label"]} ' if 'label' in item and item["label"] else ''
-                item['description'] = f'{provenance} {timestamp}{label}{gold_standard}'
-            return metadata
-
-    def _get_metadata_file(self):
-        return self.project_dir / 'metadata.json'
+        metadata = [ dict(item) for item in self.metadata_store.get_entries() ]
+        for item in metadata:
+            item['description'] = metadata_entry_description(item)
+        return metadata
 
     def _get_archive_dir(self):
         return self.project_dir / 'archive'
@@ -414,7 +399,8 @@ class CLARAProjectInternal:
     #   - timestamp: time when file was posted, in format '%Y%m%d%H%M%S'
     #   - whether or not file should be considered gold standard. One of ( True, False )
 
-    # For downward compatibility, guess metadata based on existing files where necessary.
+    # For downward compatibility, guess metadata based on existing files.
+    # This is only needed once, for projects created before we kept metadata.
     # Files referenced:
     #   - self._file_path_for_version(version) for version in
     #     ( "prompt", "plain", "segmented_title", "title", "summary", "cefr_level", "segmented", "gloss", "lemma", "pinyin" )
@@ -425,8 +411,7 @@ class CLARAProjectInternal:
     # Assume that earliest file for a given version is source=ai_generated and others are source=human_revised.
     # Assume that all files are gold_standard=False
     def _create_metadata_file_if_missing(self, user):
-        metadata_file = self._get_metadata_file()
-        metadata = self.get_metadata()
+        metadata = [ dict(item) for item in self.metadata_store.get_entries() ]
 
         versions = ["prompt", "plain", "title", "segmented_title", "summary", "cefr_level", "segmented", "translated", "phonetic", "gloss", "lemma",
                     "pinyin", "mwe", "image_request_sequence"]
@@ -481,18 +466,14 @@ class CLARAProjectInternal:
                 versions_processed.add(version)
 
         # Write the updated metadata to the file
-        write_json_to_file(metadata, metadata_file)
+        self.metadata_store.write_entries(metadata)
 
-    # Update the metadata file, transferring the entry for 'file_path' to 'archive_path' and creating a new entry for 'file_path'
+    # Update the metadata, transferring the entry for 'file_path' to 'archive_path' and creating a new entry for 'file_path'.
+    # These are appends to the metadata log, so the cost doesn't depend on how many versions the project has.
     def _update_metadata_file(self, file_path, archive_path, version, source, user, label, gold_standard):
-        metadata_file = self._get_metadata_file()
-        metadata = self.get_metadata()
-
         # Find the entry for the file_path, if it exists, and update it to be the archive_path
-        for entry in metadata:
-            if entry['file'] == str(file_path):
-                entry['file'] = str(archive_path)  # Transfer the entry to the archive path
-                break
+        if archive_path:
+            self.metadata_store.archive_entry(file_path, archive_path)
 
         # Create a new entry for the file_path with the updated information
         new_entry = {
@@ -500,15 +481,12 @@ class CLARAProjectInternal:
             "version": version,
             "source": source,
             "user": user,
-            # Use file modification timestamp as the timestamp and convert to the right format
-            "timestamp": datetime.datetime.fromtimestamp(get_file_time(file_path)).strftime('%Y%m%d%H%M%S'),
+            # We have just written the file, so the current time is its modification time
+            "timestamp": datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
             "label": label,
             "gold_standard": gold_standard
         }
-        metadata.append(new_entry)
-
-        # Write the updated metadata to the file
-        write_json_to_file(metadata, metadata_file)
+        self.metadata_store.add_entry(new_entry)
 
     # Delete one of the text files associated with the object
     def delete_text_version(self, version: str) -> None:
@@ -970,10 +948,11 @@ class CLARAProjectInternal:
 
         images = self.get_all_project_images()
         post_task_update(callback, f"--- Found {len(images)} images")
+        pages_by_image = text_object.page_index_by_image()
         for image in images:
             if image.request_type != 'image-understanding' and image.page != 0:
                 # Find the corresponding Page object, if there is one.
-                page_object = text_object.find_page_by_image(image)
+                page_object = pages_by_image.get(image.image_name, None)
                 if page_object:
                     # Merge the Page object into the Image object
                     image.merge_page(page_object)
@@ -1227,6 +1206,22 @@ class CLARAProjectInternal:
             # Handle the exception as needed
             return None
 
+    # Retrieves all the images and image descriptions for the project as a ProjectImageData object,
+    # for code that needs to look up many of them
+    def get_project_image_data(self, callback=None):
+        try:
+            project_id = self.id
+            
+            post_task_update(callback, f"--- Retrieving all image data for project {project_id}")
+
+            image_data = self.image_repository.get_project_image_data(project_id, callback=callback)
+
+            post_task_update(callback, f"--- All image data retrieved successfully")
+            return image_data
+        except Exception as e:
+            post_task_update(callback, f"*** Error when retrieving image data: {str(e)}")
+            return None
+
     def add_project_image_description(self, description_variable, explanation, callback=None):
         try:
             project_id = self.id
@@ -1279,6 +1274,21 @@ class CLARAProjectInternal:
         except Exception as e:
             post_task_update(callback, f"*** Error when removing image descriptions: {str(e)}")
 
+    # Replaces all the image descriptions with a list of ( description_variable, explanation ) pairs
+    def replace_all_project_image_descriptions(self, descriptions, callback=None):
+        try:
+            project_id = self.id
+
+            post_task_update(callback, f"--- Replacing image descriptions for project {project_id}")
+
+            self.image_repository.replace_all_descriptions(project_id, descriptions, callback=callback)
+
+            post_task_update(callback, f"--- Image descriptions for {project_id} replaced successfully")
+            return True
+        except Exception as e:
+            post_task_update(callback, f"*** Error when replacing image descriptions: {str(e)}")
+            return False
+
     def get_all_project_image_descriptions(self, formatting='objects', callback=None):
         try:
             project_id = self.id
@@ -1331,6 +1341,24 @@ class CLARAProjectInternal:
             error_message = f'"{str(e)}"\n{traceback.format_exc()}'
             post_task_update(callback, error_message)
 
+    # Progress record for a coherent image request sequence, so that a failed run can be resumed.
+    # Returns the list of indices of the requests already completed, or [] if the record is for a different sequence
+    def get_coherent_image_request_progress(self, requests_hash):
+        progress_file = self.project_dir / 'coherent_image_request_progress.json'
+        if not file_exists(progress_file):
+            return []
+        progress = read_json_file(progress_file)
+        return progress['completed'] if progress['requests_hash'] == requests_hash else []
+
+    def save_coherent_image_request_progress(self, requests_hash, completed):
+        progress_file = self.project_dir / 'coherent_image_request_progress.json'
+        write_json_to_file({ 'requests_hash': requests_hash, 'completed': completed }, progress_file)
+
+    def remove_coherent_image_request_progress(self):
+        progress_file = self.project_dir / 'coherent_image_request_progress.json'
+        if file_exists(progress_file):
+            remove_file(progress_file)
+
     def get_image_understanding_result(self, description_variable, callback=None):
         try:
             project_id = self.id
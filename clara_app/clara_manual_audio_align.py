@@ -6,9 +6,9 @@ Code to support the manual audio/text alignment functionality.
 from .clara_utils import local_directory_exists, make_local_directory, read_local_json_file, post_task_update, absolute_local_file_name
 from .clara_utils import canonical_word_for_audio, canonical_text_for_audio, read_json_or_txt_file, write_json_to_file_plain_utf8
 from .clara_classes import InternalCLARAError
+from .clara_audio_splitter import split_audio_file
 
 import os
-import subprocess
 import traceback
 import re
 import requests
@@ -48,40 +48,33 @@ def process_alignment_metadata(metadata, audio_file, output_dir, callback=None):
         make_local_directory(output_dir)
 
     new_metadata = []
+    intervals = []
 
     for idx, entry in enumerate(metadata):
-        # Extract the audio segment using ffmpeg
         segment_file = os.path.join(output_dir, f"segment_{idx}.mp3")
         try:
             text = entry['text']
-            start_time = entry["start_time"]
-            end_time = entry["end_time"]
-            duration = float(end_time) - float(start_time)
+            start_time = float(entry["start_time"])
+            end_time = float(entry["end_time"])
         except Exception as e:
             raise InternalCLARAError( message=f'*** Error: bad entry in alignment metadata file: {entry}: {str(e)}')
 
-        cmd = [
-            "ffmpeg",
-            "-i", audio_file,
-            "-ss", str(start_time),
-            "-t", str(duration),
-            "-q:a", "0",  # Best quality
-            segment_file
-        ]
-        
-        try:
-            subprocess.run(cmd, check=True)
-            post_task_update(callback, f'--- Extracted audio for "{text}, start_time = {start_time:.2f}, duration = {duration:.2f}"')
-        except Exception as e:
-            post_task_update(callback, f'--- Error when trying to extract audio for "{text}": {str(e)}')
-            raise InternalCLARAError( message=f'*** Error: something went wrong when trying to extract audio for "{text}"') 
-            
-        # Add to the new metadata
+        intervals.append(( start_time, end_time ))
         new_metadata.append({
             'text': text,
             'file': segment_file
         })
 
+    # Extract all the audio segments using ffmpeg, decoding the audio file only once
+    try:
+        split_audio_file(audio_file, intervals, [ item['file'] for item in new_metadata ], callback=callback)
+    except Exception as e:
+        post_task_update(callback, f'--- Error when trying to extract audio segments from {audio_file}: {str(e)}')
+        raise InternalCLARAError( message=f'*** Error: something went wrong when trying to extract audio segments from {audio_file}')
+
+    for item, ( start_time, end_time ) in zip(new_metadata, intervals):
+        post_task_update(callback, f'--- Extracted audio for "{item["text"]}, start_time = {start_time:.2f}, duration = {end_time - start_time:.2f}"')
+
     #print(f'--- Output from process_alignment_metadata:')
     #pprint.pprint(new_metadata)
     return new_metadata
@@ -0,0 +1,166 @@
+"""
+Building page audio out of segment audio files.
+
+A page audio file is the concatenation of the mp3 files for the segments on the page. Since all the segment
+files for a page come from the same voice, they normally have the same MPEG format, and can be joined at the
+frame level without decoding anything: join_mp3_files strips any ID3 tags and Xing/Info/VBRI header frames from
+each file and writes out the remaining MPEG audio frames. This is done in-process, so there is no need to start
+ffmpeg once per page. Files which can't be joined this way, e.g. because they have different sample rates or are
+VBR, are concatenated with ffmpeg as before.
+
+The page audio file is named after a hash of the ordered list of segment files, page_<hash>.mp3, and stored in the
+voice directory. Segment files are never overwritten, since new segment audio always gets a new file name, so if
+a file with that name is already there, it is the right audio for the page and doesn't need to be rebuilt.
+Conversely, a page file built from a different list of segment files is out of date.
+"""
+
+from .clara_utils import basename, post_task_update
+from .clara_audio_splitter import run_ffmpeg, run_in_parallel
+
+import hashlib
+import os
+import tempfile
+
+# Bitrates in kbps for MPEG audio Layer III, indexed by the bitrate field of the frame header
+_bitrates_mpeg1 = [ None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None ]
+_bitrates_mpeg2 = [ None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None ]
+
+# Sample rates indexed by the version field and then the sample rate field of the frame header
+_sample_rates = { 3: [ 44100, 48000, 32000 ],  # MPEG 1
+                  2: [ 22050, 24000, 16000 ],  # MPEG 2
+                  0: [ 11025, 12000, 8000 ] }  # MPEG 2.5
+
+class Mp3FormatError(Exception):
+    pass
+
+def page_audio_file_name(segment_audio_files):
+    digest = hashlib.sha256('\n'.join(str(file) for file in segment_audio_files).encode('utf-8')).hexdigest()
+    return f'page_{digest}.mp3'
+
+# An existing page audio file is out of date if it's a cached file built from a different list of segment files.
+# Page audio files created before we cached them have other names, and we can't tell, so we keep them.
+def page_audio_is_current(file_path, segment_audio_files):
+    if not file_path:
+        return False
+    file_name = basename(file_path)
+    return not file_name.startswith('page_') or file_name == page_audio_file_name(segment_audio_files)
+
+# Build the page audio for each list of segment files in segment_audio_file_lists, in output_dir.
+# Return a list with, for each page, either the file created or None if it failed.
+def build_page_audio_files(segment_audio_file_lists, output_dir, callback=None):
+    output_files = [ os.path.join(output_dir, page_audio_file_name(segment_audio_files))
+                     for segment_audio_files in segment_audio_file_lists ]
+    errors = run_in_parallel(build_page_audio_file, list(zip(segment_audio_file_lists, output_files)), raise_errors=False)
+    for output_file, error in zip(output_files, errors):
+        if error:
+            post_task_update(callback, f'*** Error creating page audio file {basename(output_file)}: "{str(error)}"')
+    return [ None if error else output_file for output_file, error in zip(output_files, errors) ]
+
+def build_page_audio_file(segment_audio_files, output_file):
+    try:
+        join_mp3_files(segment_audio_files, output_file)
+    except Mp3FormatError:
+        concatenate_audio_files(segment_audio_files, output_file)
+
+def concatenate_audio_files(segment_audio_files, output_file):
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        list_file = f.name
+        for audio_file in segment_audio_files:
+            f.write(f"file '{audio_file}'\n")
+    try:
+        run_ffmpeg([ 'ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', output_file ],
+                   f'concatenate {len(segment_audio_files)} audio files')
+    finally:
+        os.remove(list_file)
+
+# -----------------------------------------
+# Frame-level joining
+
+# Concatenate the MPEG audio frames in the mp3 files, without re-encoding.
+# Raise Mp3FormatError if the files can't be joined safely this way.
+def join_mp3_files(input_files, output_file):
+    stream_format = None
+    chunks = []
+    for input_file in input_files:
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        frames_start, frames_end, file_format = mp3_audio_frames(data)
+        if stream_format is None:
+            stream_format = file_format
+        elif file_format != stream_format:
+            raise Mp3FormatError(f'{input_file} has format {file_format}, expected {stream_format}')
+        chunks.append(memoryview(data)[frames_start:frames_end])
+    if not chunks:
+        raise Mp3FormatError('No input files')
+    with open(output_file, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+# Return ( start, end, format ), where data[start:end] is the sequence of MPEG Layer III audio frames in the mp3 data,
+# without tags or a VBR header frame, and format is ( version, sample rate, bitrate, number of channels ).
+# Raise Mp3FormatError unless the data is a clean CBR stream.
+def mp3_audio_frames(data):
+    start = id3v2_tag_size(data)
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+
+    stream_format = None
+    frames_start = start
+    position = start
+    while position < end:
+        if end - position < 4:
+            raise Mp3FormatError(f'Junk after last frame at byte {position}')
+        frame_format, frame_length = mp3_frame_header(data, position)
+        # Drop a truncated final frame, which is what an encoder writes if it's interrupted
+        if position + frame_length > end:
+            break
+        if position == start and is_vbr_header_frame(data, position, frame_format):
+            frames_start = position + frame_length
+        elif stream_format is None:
+            stream_format = frame_format
+        elif frame_format != stream_format:
+            raise Mp3FormatError(f'Frame at byte {position} has format {frame_format}, expected {stream_format}')
+        position += frame_length
+    if stream_format is None:
+        raise Mp3FormatError('No audio frames')
+    return frames_start, position, stream_format
+
+def id3v2_tag_size(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = ( data[6] << 21 ) | ( data[7] << 14 ) | ( data[8] << 7 ) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+# Return ( ( version, sample rate, bitrate, number of channels ), frame length ) for the frame header at data[position]
+def mp3_frame_header(data, position):
+    b1, b2, b3 = data[position + 1], data[position + 2], data[position + 3]
+    if data[position] != 0xFF or b1 & 0xE0 != 0xE0:
+        raise Mp3FormatError(f'No frame sync at byte {position}')
+    version = ( b1 >> 3 ) & 3
+    layer = ( b1 >> 1 ) & 3
+    if version == 1 or layer != 1:
+        raise Mp3FormatError(f'Frame at byte {position} is not MPEG audio Layer III')
+    bitrate = ( _bitrates_mpeg1 if version == 3 else _bitrates_mpeg2 )[b2 >> 4]
+    sample_rate_index = ( b2 >> 2 ) & 3
+    if bitrate is None or sample_rate_index == 3:
+        raise Mp3FormatError(f'Unsupported bitrate or sample rate in frame at byte {position}')
+    sample_rate = _sample_rates[version][sample_rate_index]
+    padding = ( b2 >> 1 ) & 1
+    # Stereo, joint stereo and dual channel can be mixed, mono can't
+    channels = 1 if b3 >> 6 == 3 else 2
+    samples_factor = 144 if version == 3 else 72
+    frame_length = samples_factor * bitrate * 1000 // sample_rate + padding
+    return ( version, sample_rate, bitrate, channels ), frame_length
+
+# The first frame may be a Xing/Info or VBRI header describing the whole file, which would be wrong for the joined file
+def is_vbr_header_frame(data, position, frame_format):
+    version, _sample_rate, _bitrate, channels = frame_format
+    if version == 3:
+        side_info_size = 17 if channels == 1 else 32
+    else:
+        side_info_size = 9 if channels == 1 else 17
+    xing_position = position + 4 + side_info_size
+    return ( data[xing_position:xing_position + 4] in ( b'Xing', b'Info' ) or
+             data[position + 36:position + 40] == b'VBRI' )
@@ -0,0 +1,142 @@
+"""
+Metadata store for the text versions in a CLARAProjectInternal directory.
+
+The metadata is a list of references to the files holding different updates of text versions,
+each one a dict with keys ( "file", "version", "source", "user", "timestamp", "label", "gold_standard" ).
+
+It is kept in two files:
+
+- metadata.json: a snapshot of the list, in the same format used by earlier versions of C-LARA.
+- metadata_log.jsonl: an append-only log of the changes made since the snapshot was written,
+one JSON record per line. A record is either
+
+  { "op": "add", "entry": <metadata reference> }
+  { "op": "archive", "file": <current file>, "archive_file": <archive file> }
+
+Saving a new text version appends two lines to the log, instead of rewriting the whole metadata file.
+When the log gets long, it is folded back into the snapshot.
+
+The store keeps the metadata in memory, indexed by file and by version, so repeated lookups
+like get_file_description don't need to reread anything.
+"""
+
+from .clara_utils import file_exists, read_json_file, write_json_to_file, read_txt_file, append_txt_file, remove_file
+from .clara_utils import get_config, format_timestamp
+
+import json
+
+config = get_config()
+
+class ProjectMetadataStore:
+    def __init__(self, project_dir):
+        self.metadata_file = project_dir / 'metadata.json'
+        self.log_file = project_dir / 'metadata_log.jsonl'
+        self.max_log_records = int(config.get('CLARA_projects', 'max_metadata_log_records'))
+        self._entries = None
+
+    # True if there is no stored metadata at all, i.e. this is a project created before we kept metadata
+    def is_missing(self):
+        self._load_if_necessary()
+        return self._missing
+
+    def get_entries(self):
+        self._load_if_necessary()
+        return self._entries
+
+    def get_entry_for_file(self, file):
+        self._load_if_necessary()
+        return self._by_file.get(str(file), None)
+
+    def get_entries_for_version(self, version):
+        self._load_if_necessary()
+        return self._by_version.get(version, [])
+
+    # Replace the whole list, e.g. after guessing metadata for legacy files
+    def write_entries(self, entries):
+        write_json_to_file(entries, self.metadata_file)
+        if file_exists(self.log_file):
+            remove_file(self.log_file)
+        self._set_entries(entries)
+
+    # Transfer the entry for 'file_path', if there is one, to 'archive_path'
+    def archive_entry(self, file_path, archive_path):
+        self._append_record({ 'op': 'archive', 'file': str(file_path), 'archive_file': str(archive_path) })
+
+    def add_entry(self, entry):
+        self._append_record({ 'op': 'add', 'entry': entry })
+
+    def _append_record(self, record):
+        self._load_if_necessary()
+        append_txt_file(json.dumps(record) + '\n', self.log_file)
+        apply_metadata_log_record(self._entries, self._by_file, self._by_version, record)
+        self._n_log_records += 1
+        if self._n_log_records >= self.max_log_records:
+            self.write_entries(self._entries)
+
+    def _load_if_necessary(self):
+        if self._entries is not None:
+            return
+        metadata_file_exists = file_exists(self.metadata_file)
+        log_file_exists = file_exists(self.log_file)
+        entries = read_json_file(self.metadata_file) if metadata_file_exists else []
+        records = read_metadata_log_records(self.log_file) if log_file_exists else []
+        self._set_entries(entries)
+        self._missing = not metadata_file_exists and not log_file_exists
+        for record in records:
+            apply_metadata_log_record(self._entries, self._by_file, self._by_version, record)
+        self._n_log_records = len(records)
+
+    def _set_entries(self, entries):
+        self._entries = entries
+        self._by_file = {}
+        self._by_version = {}
+        for entry in entries:
+            index_metadata_entry(entry, self._by_file, self._by_version)
+        self._n_log_records = 0
+        self._missing = False
+
+def metadata_entry_description(item):
+    provenance = item['source']
+    timestamp = format_timestamp(item['timestamp'])
+    gold_standard = ' (gold standard)' if item['gold_standard'] else ''
+    label = f' {item["label"]} ' if 'label' in item and item["label"] else ''
+    return f'{provenance} {timestamp}{label}{gold_standard}'
+
+def read_metadata_log_records(log_file):
+    return metadata_log_text_to_records(read_txt_file(log_file))
+
+def metadata_log_text_to_records(text):
+    return [ json.loads(line) for line in text.split('\n') if line.strip() ]
+
+def index_metadata_entry(entry, by_file, by_version):
+    # If there are several entries for the same file, the earliest one is the one that counts
+    if not entry['file'] in by_file:
+        by_file[entry['file']] = entry
+    by_version.setdefault(entry['version'], []).append(entry)
+
+# Apply a log record to a metadata list and its indexes.
+# Records are idempotent, so it doesn't matter if one of them has already been folded into the snapshot.
+def apply_metadata_log_record(entries, by_file, by_version, record):
+    if record['op'] == 'add':
+        entry = record['entry']
+        if by_file.get(entry['file'], None) == entry:
+            return
+        entries.append(entry)
+        index_metadata_entry(entry, by_file, by_version)
+    elif record['op'] == 'archive':
+        if record['archive_file'] in by_file:
+            return
+        entry = by_file.pop(record['file'], None)
+        if entry:
+            entry['file'] = record['archive_file']
+            by_file[entry['file']] = entry
+
+# Fold the records in a metadata log into a metadata list, e.g. when importing a project
+def apply_metadata_log_records(entries, records):
+    by_file = {}
+    by_version = {}
+    for entry in entries:
+        index_metadata_entry(entry, by_file, by_version)
+    for record in records:
+        apply_metadata_log_record(entries, by_file, by_version, record)
+    return entries
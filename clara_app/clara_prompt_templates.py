@@ -8,12 +8,22 @@ from .clara_utils import get_config
 
 import os
 import json
+import threading
+import time
 from typing import Union
 import datetime
 from pathlib import Path
 
 config = get_config()
 
+# Per-process cache for data derived from the prompt templates and examples, e.g. the loaded template
+# and the formatted examples text used when annotating. Annotation calls the same prompt construction
+# for every chunk, so without the cache we reread and reformat the same files many times per text.
+# The cache is cleared when anything is saved through save_template_or_examples.
+# Entries also expire after cache_ttl_seconds, so that saves made in other worker processes are picked up.
+_prompt_cache = {}
+_prompt_cache_lock = threading.Lock()
+
 class PromptTemplateRepository:
 
     # Get the prompt repository for the language in question, creating it if necessary.
@@ -104,6 +114,9 @@ class PromptTemplateRepository:
 
         # Update the metadata file
         self._update_metadata_file(file_path, archive_path, template_or_examples, annotation_type, operation, user)
+
+        # Anything we've cached may depend on the old version
+        clear_prompt_cache()
         
     def _update_metadata_file(self, file_path, archive_path, template_or_examples, annotation_type, operation, user):
         metadata_file = self._get_metadata_file()
@@ -138,6 +151,31 @@ class PromptTemplateRepository:
             metadata = []
         return metadata
 
+# Return the cached value for 'key', calling 'compute' if there is none.
+# A TemplateError raised by 'compute' is cached too, since a missing template normally means we fall back to 'default'
+# and we don't want to look for the missing files again for every chunk.
+def get_cached_prompt_data(key, compute):
+    ttl = float(config.get('prompt_template_repository', 'cache_ttl_seconds'))
+    now = time.time()
+    with _prompt_cache_lock:
+        cached = _prompt_cache.get(key, None)
+    if cached and now - cached[0] < ttl:
+        ( cache_time, value, error ) = cached
+    else:
+        try:
+            ( value, error ) = ( compute(), None )
+        except TemplateError as e:
+            ( value, error ) = ( None, e )
+        with _prompt_cache_lock:
+            _prompt_cache[key] = ( now, value, error )
+    if error:
+        raise error
+    return value
+
+def clear_prompt_cache():
+    with _prompt_cache_lock:
+        _prompt_cache.clear()
+
 # When we're loading, we only check that the data has the right shape that we can display it,
 # e.g. that a template is a string or that gloss examples are a list of pairs of strings.
 # If there are other problems, we're probably going to want to fix them by loading the
@@ -8,19 +8,24 @@ Classes:
 
 The StaticHTMLRenderer class provides methods for rendering pages, concordance pages, and vocabulary lists.
 The renderer also supports self-contained rendering, which means that all multimedia assets are copied to the output directory.
+In audio sprite mode, the word and segment audio for each page is also packed into a single file, see clara_audio_sprite.
 """
 
 from .clara_inflection_tables import get_inflection_table_url
 
 from .clara_utils import _s3_storage, absolute_file_name
 from .clara_utils import remove_directory, make_directory, copy_directory, copy_directory_to_s3, directory_exists
-from .clara_utils import copy_file, basename, read_txt_file, write_txt_file, output_dir_for_project_id
+from .clara_utils import copy_file, copy_local_file, basename, read_txt_file, write_txt_file, output_dir_for_project_id
 from .clara_utils import get_config, is_rtl_language, replace_punctuation_with_underscores, post_task_update 
+from .clara_audio_cache import make_audio_manifest, write_audio_manifest
+from .clara_audio_cache import add_segment_audio_to_manifest_items, local_audio_file
+from .clara_audio_sprite import audio_sprite_file_name, build_audio_sprite
 
 from pathlib import Path
 import os
 from jinja2 import Environment, FileSystemLoader
 import shutil
+import tempfile
 import traceback
 
 config = get_config()
@@ -118,7 +123,7 @@ class StaticHTMLRenderer:
         write_txt_file(css_content_concordance, static_dst / 'clara_styles_concordance.css')
 
 
-    def render_page(self, page, page_number, total_pages, l2_language, l1_language):
+    def render_page(self, page, page_number, total_pages, l2_language, l1_language, audio_sprite=None):
         is_rtl = is_rtl_language(l2_language)
         template = self.template_env.get_template('clara_page.html')
         rendered_page = template.render(page=page,
@@ -133,7 +138,8 @@ class StaticHTMLRenderer:
                                         page_number_str=str(page_number),
                                         phonetic=self.phonetic,
                                         normal_html_exists=self.normal_html_exists,
-                                        phonetic_html_exists=self.phonetic_html_exists)
+                                        phonetic_html_exists=self.phonetic_html_exists,
+                                        audio_sprite=audio_sprite)
         return rendered_page 
 
     def render_concordance_page(self, lemma, concordance_segments, l2_language):
@@ -160,8 +166,42 @@ class StaticHTMLRenderer:
                                         l2_language=l2_language)
         return rendered_page 
  
-    def render_text(self, text, self_contained=False, callback=None):
+    # Pack the word and segment audio for each page into an audio sprite in the multimedia directory.
+    # Return a dict mapping page numbers to dicts with the src of the sprite and its table of offsets, for the page template.
+    def make_audio_sprites(self, text, callback=None):
+        multimedia_dir = self.output_dir / 'multimedia'
+        make_directory(multimedia_dir, exist_ok=True)
+        audio_sprites = {}
+        post_task_update(callback, f"--- Creating audio sprites")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for index, page in enumerate(text.pages):
+                page_number = index + 1
+                items = {}
+                add_segment_audio_to_manifest_items(page.segments, self.output_dir, items)
+                if not items:
+                    continue
+                src_to_local_file = {}
+                for src, file_path in items.items():
+                    try:
+                        # On S3, this goes through the local audio cache
+                        src_to_local_file[src] = local_audio_file(file_path)
+                    except Exception as e:
+                        post_task_update(callback, f'*** Warning: unable to get {file_path} for audio sprite: "{str(e)}"')
+                sprite_file_name = audio_sprite_file_name(page_number, list(items.values()))
+                local_sprite_file = os.path.join(temp_dir, sprite_file_name)
+                offsets = build_audio_sprite(src_to_local_file, local_sprite_file, callback=callback)
+                if offsets:
+                    copy_local_file(local_sprite_file, multimedia_dir / sprite_file_name)
+                    audio_sprites[page_number] = { 'file': f'./multimedia/{sprite_file_name}', 'offsets': offsets }
+                    post_task_update(callback, f"--- Written audio sprite for page {page_number}, {len(offsets)}/{len(items)} files")
+        post_task_update(callback, f"--- Audio sprites created for {len(audio_sprites)} pages")
+        return audio_sprites
+
+    # If audio_sprites is None, use the value in the config file
+    def render_text(self, text, self_contained=False, audio_sprites=None, callback=None):
         post_task_update(callback, f"--- Rendering_text") 
+        if audio_sprites is None:
+            audio_sprites = config.getboolean('renderer', 'audio_sprites')
         # Create multimedia directory if self-contained is True
         if self_contained:
             multimedia_dir = self.output_dir / 'multimedia'
@@ -187,11 +227,20 @@ class StaticHTMLRenderer:
                     error_message = f'"{str(e)}"\n{traceback.format_exc()}'
                     post_task_update(callback, error_message)
             post_task_update(callback, f"--- Done. {n_files_copied}/{n_files_to_copy} files successfully copied")
+
+        page_audio_sprites = {}
+        if audio_sprites:
+            # The pages still work without sprites, so just warn if something goes wrong
+            try:
+                page_audio_sprites = self.make_audio_sprites(text, callback=callback)
+            except Exception as e:
+                post_task_update(callback, f'*** Warning: error when creating audio sprites: "{str(e)}"\n{traceback.format_exc()}')
                         
         total_pages = len(text.pages)
         post_task_update(callback, f"--- Creating text pages")
         for index, page in enumerate(text.pages):
-            rendered_page = self.render_page(page, index + 1, total_pages, text.l2_language, text.l1_language)
+            rendered_page = self.render_page(page, index + 1, total_pages, text.l2_language, text.l1_language,
+                                             audio_sprite=page_audio_sprites.get(index + 1, None))
             output_file_path = self.output_dir / f'page_{index + 1}.html'
             write_txt_file(rendered_page, output_file_path)
             post_task_update(callback, f"--- Written page {index}")
@@ -223,6 +272,14 @@ class StaticHTMLRenderer:
         output_file_path = self.output_dir / "vocab_list_frequency.html"
         write_txt_file(rendered_page, output_file_path)
         post_task_update(callback, f"--- Vocabulary lists created")
+
+        # The audio isn't essential, so just warn if something goes wrong
+        try:
+            manifest = make_audio_manifest(text, self.output_dir, config.get('audio_repository', 'base_dir_orm'))
+            write_audio_manifest(manifest, self.output_dir)
+            post_task_update(callback, f"--- Audio manifest created")
+        except Exception as e:
+            post_task_update(callback, f'*** Warning: error when creating audio manifest: "{str(e)}"\n{traceback.format_exc()}')
         
 def adjust_audio_file_paths_in_segment_list(segments, copy_operations, multimedia_dir):
     if not segments:
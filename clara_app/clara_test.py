@@ -7,9 +7,23 @@ from . import clara_concordance_annotator
 from . import clara_audio_annotator
 from .clara_classes import *
 from .clara_renderer import StaticHTMLRenderer
+from .clara_diff import text_to_diff_elements, text_to_diff_units, diff_diff_elements, diff_diff_units, diff_elements_to_error_rate
+from .clara_audio_splitter import split_audio_file, extract_audio_segment, run_ffmpeg, convert_audio_file
+from .clara_tts_api import TTSEngine
+from .clara_page_audio import build_page_audio_files, concatenate_audio_files
 from . import clara_utils
 
+import math
+import os
+import random
+import re
+import regex
+import shutil
+import struct
+import subprocess
+import tempfile
 import time
+import wave
 
 test_inputs_small = {
     1: ( "@Bien sûr@#of course#",
@@ -254,3 +268,227 @@ def prettyprint_internalised_text(internalized_text):
                 clara_utils.print_and_flush(f"      Element {element_number}: Type: '{element.type}', Content: {content_to_print}, Annotations: {element.annotations}")
         
         clara_utils.print_and_flush("===")
+
+# Benchmark the segment-anchored diff in clara_diff against the earlier difflib version on long synthetic glossed texts,
+# where a proportion of the segments have a changed word and a further proportion have a changed gloss.
+# e.g. test_diff_speed(n_pages=100, segments_per_page=10)
+def test_diff_speed(n_pages=100, segments_per_page=10, words_per_segment=12, changed_word_rate=0.05, changed_gloss_rate=0.2, seed=0):
+    random.seed(seed)
+    vocabulary = [ f'word{i}' for i in range(2000) ]
+
+    def random_segment():
+        elements = []
+        for word in random.sample(vocabulary, words_per_segment):
+            elements += [ ContentElement('Word', word, { 'gloss': f'{word}-gloss' }), ContentElement('NonWordText', ' ', {}) ]
+        return Segment(elements + [ ContentElement('NonWordText', '.', {}) ])
+
+    def changed_segment(segment):
+        elements = [ ContentElement(element.type, element.content, dict(element.annotations)) for element in segment.content_elements ]
+        if random.random() < changed_word_rate:
+            elements[2 * random.randrange(words_per_segment)] = ContentElement('Word', random.choice(vocabulary), { 'gloss': 'new-gloss' })
+        if random.random() < changed_gloss_rate:
+            elements[2 * random.randrange(words_per_segment)].annotations['gloss'] = 'other-gloss'
+        return Segment(elements)
+
+    pages1 = [ Page([ random_segment() for j in range(segments_per_page) ]) for i in range(n_pages) ]
+    pages2 = [ Page([ changed_segment(segment) for segment in page.segments ]) for page in pages1 ]
+    text1 = Text(pages1, 'english', 'english')
+    text2 = Text(pages2, 'english', 'english')
+
+    start_time = time.time()
+    diff_elements_difflib = diff_diff_elements(text_to_diff_elements(text1, 'gloss'), text_to_diff_elements(text2, 'gloss'))
+    error_rate_difflib = diff_elements_to_error_rate(diff_elements_difflib, 'gloss')
+    difflib_time = time.time() - start_time
+
+    start_time = time.time()
+    diff_elements_anchored = diff_diff_units(text_to_diff_units(text1, 'gloss'), text_to_diff_units(text2, 'gloss'))
+    error_rate_anchored = diff_elements_to_error_rate(diff_elements_anchored, 'gloss')
+    anchored_time = time.time() - start_time
+
+    n_elements = len(text_to_diff_elements(text1, 'gloss'))
+    clara_utils.print_and_flush(f'--- {n_elements} diff elements in each text')
+    clara_utils.print_and_flush(f'--- difflib:          {difflib_time:.3f} secs, error rate {error_rate_difflib:.2f}%')
+    clara_utils.print_and_flush(f'--- segment-anchored: {anchored_time:.3f} secs, error rate {error_rate_anchored:.2f}%')
+
+# Compare canonical_text_for_audio and string_has_no_audio_content with the regex versions they replaced,
+# calling them on each word and segment of a long text three times, as rendering does
+def test_audio_text_normalisation_speed(n_segments=20000, words_per_segment=12, seed=0):
+    random.seed(seed)
+    vocabulary = [ f'word{i}' for i in range(5000) ] + [ ',', '.', '«', '»', '—', '!', '|' ]
+    segments = [ ' '.join(random.choice(vocabulary) for j in range(words_per_segment)) + ( ' <b>bold</b>\n' if i % 10 == 0 else ' .' )
+                 for i in range(n_segments) ]
+    words = [ word for segment in segments for word in segment.split() ]
+
+    def old_canonical_text_for_audio(text):
+        text = re.sub(r'<[^>]*>', '', text)
+        text = re.sub(r'\s+', ' ', text)
+        return text.strip()
+
+    def old_string_has_no_audio_content(s):
+        s1 = regex.sub(r"<\/?\w+>", '', s)
+        return not s1 or all(regex.match(r"[\p{P} \n|]", c) for c in s1)
+
+    def run(canonical_text_function, no_audio_content_function):
+        results = []
+        for i in range(3):
+            results.append([ ( canonical_text_function(segment), no_audio_content_function(segment) ) for segment in segments ] +
+                           [ no_audio_content_function(word) for word in words ])
+        return results
+
+    start_time = time.time()
+    old_results = run(old_canonical_text_for_audio, old_string_has_no_audio_content)
+    old_time = time.time() - start_time
+
+    clara_utils.canonical_text_and_audio_content.cache_clear()
+    start_time = time.time()
+    new_results = run(clara_utils.canonical_text_for_audio, clara_audio_annotator.string_has_no_audio_content)
+    new_time = time.time() - start_time
+
+    clara_utils.print_and_flush(f'--- {n_segments} segments, {len(words)} words, three passes')
+    clara_utils.print_and_flush(f'--- regex per character: {old_time:.2f} secs')
+    clara_utils.print_and_flush(f'--- table-driven, cached: {new_time:.2f} secs')
+    clara_utils.print_and_flush(f'--- same results: {old_results == new_results}')
+
+# Benchmark the single-pass audio splitter against cutting one segment at a time with "-ss" after "-i",
+# on a synthetic recording split into contiguous segments of random length. The old method is timed on
+# n_old_method_segments segments spread through the recording, and the time for all of them is estimated from that.
+# e.g. test_audio_split_speed(duration_minutes=30, n_segments=400)
+def test_audio_split_speed(duration_minutes=30, n_segments=400, n_old_method_segments=20, seed=0):
+    random.seed(seed)
+    duration = 60.0 * duration_minutes
+    cut_points = sorted(random.sample(range(1, int(duration * 10)), n_segments - 1))
+    times = [ 0.0 ] + [ point / 10.0 for point in cut_points ] + [ duration ]
+    intervals = list(zip(times[:-1], times[1:]))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        audio_file = os.path.join(tmp_dir, 'recording.mp3')
+        run_ffmpeg([ 'ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                     '-q:a', '0', audio_file ], 'make synthetic recording')
+
+        output_files = [ os.path.join(tmp_dir, 'new', f'segment_{i}.mp3') for i in range(n_segments) ]
+        start_time = time.time()
+        split_audio_file(audio_file, intervals, output_files)
+        new_time = time.time() - start_time
+
+        os.makedirs(os.path.join(tmp_dir, 'old'))
+        sample = sorted(random.sample(range(n_segments), min(n_old_method_segments, n_segments)))
+        start_time = time.time()
+        for i in sample:
+            start, end = intervals[i]
+            extract_audio_segment(audio_file, start, end - start, os.path.join(tmp_dir, 'old', f'segment_{i}.mp3'), fast_seek=False)
+        old_time = ( time.time() - start_time ) * n_segments / len(sample)
+
+        clara_utils.print_and_flush(f'--- {n_segments} segments from a {duration_minutes} minute recording')
+        clara_utils.print_and_flush(f'--- one ffmpeg call per segment: {old_time:.1f} secs (estimated from {len(sample)} segments)')
+        clara_utils.print_and_flush(f'--- single pass:                 {new_time:.1f} secs')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Compare building page audio by frame-level joining with one ffmpeg concat call per page,
+# and check that the two give pages of the same length
+def test_page_audio_speed(n_pages=50, n_segments_per_page=12):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        segment_files = []
+        for i in range(n_segments_per_page):
+            segment_file = os.path.join(tmp_dir, f'segment_{i}.mp3')
+            run_ffmpeg([ 'ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency={300 + 20 * i}:duration={1 + 0.25 * i}',
+                         '-ac', '1', '-ar', '24000', '-b:a', '32k', segment_file ], 'make synthetic segment')
+            segment_files.append(segment_file)
+        # Each page uses the segments in a different order
+        pages = [ segment_files[i % n_segments_per_page:] + segment_files[:i % n_segments_per_page] for i in range(n_pages) ]
+
+        os.makedirs(os.path.join(tmp_dir, 'old'))
+        start_time = time.time()
+        for i, page in enumerate(pages):
+            concatenate_audio_files(page, os.path.join(tmp_dir, 'old', f'page_{i}.mp3'))
+        old_time = time.time() - start_time
+
+        os.makedirs(os.path.join(tmp_dir, 'new'))
+        start_time = time.time()
+        new_files = build_page_audio_files(pages, os.path.join(tmp_dir, 'new'))
+        new_time = time.time() - start_time
+
+        old_duration = audio_file_duration(os.path.join(tmp_dir, 'old', 'page_0.mp3'))
+        new_duration = audio_file_duration(new_files[0])
+        clara_utils.print_and_flush(f'--- {n_pages} pages of {n_segments_per_page} segments')
+        clara_utils.print_and_flush(f'--- one ffmpeg call per page: {old_time:.2f} secs')
+        clara_utils.print_and_flush(f'--- frame-level joining:      {new_time:.2f} secs')
+        clara_utils.print_and_flush(f'--- page length: {old_duration:.2f} secs with ffmpeg, {new_duration:.2f} secs joined')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Local TTS engine for testing batch synthesis. Each text is rendered as a tone lasting 0.2 secs plus 0.02 secs per character,
+# and a batch is rendered as the tones separated by pauses, with the start and end of each one returned as its timing.
+class FakeBatchTTSEngine(TTSEngine):
+    supports_batch_synthesis = True
+
+    def __init__(self):
+        self.tts_engine_type = 'fake'
+        self.n_requests = 0
+
+    def create_mp3(self, language_id, voice_id, text, output_file, callback=None):
+        self.n_requests += 1
+        self._write_mp3([ ( fake_tts_duration(text), 0.0 ) ], output_file)
+        return True
+
+    def synthesize_with_timings(self, language_id, voice_id, texts, output_file, callback=None):
+        self.n_requests += 1
+        pause = 0.3
+        self._write_mp3([ ( fake_tts_duration(text), pause ) for text in texts ], output_file)
+        intervals = []
+        start_time = 0.0
+        for text in texts:
+            intervals.append(( start_time, start_time + fake_tts_duration(text) + pause ))
+            start_time += fake_tts_duration(text) + pause
+        return intervals
+
+    # Write tones and pauses, given as a list of ( tone_duration, pause_duration )
+    def _write_mp3(self, tones_and_pauses, output_file):
+        sample_rate = 16000
+        wav_file = output_file + '.wav'
+        with wave.open(wav_file, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            for tone_duration, pause_duration in tones_and_pauses:
+                samples = [ int(10000 * math.sin(2 * math.pi * 440 * n / sample_rate)) for n in range(int(tone_duration * sample_rate)) ]
+                samples += [ 0 ] * int(pause_duration * sample_rate)
+                f.writeframes(struct.pack(f'<{len(samples)}h', *samples))
+        convert_audio_file(wav_file, output_file)
+        os.remove(wav_file)
+
+def fake_tts_duration(text):
+    return 0.2 + 0.02 * len(text)
+
+def audio_file_duration(audio_file):
+    result = subprocess.run([ 'ffmpeg', '-i', audio_file ], capture_output=True, text=True)
+    hours, minutes, seconds = re.search(r'Duration: (\d+):(\d+):([\d.]+)', result.stderr).groups()
+    return 3600 * int(hours) + 60 * int(minutes) + float(seconds)
+
+# Check that batch synthesis with FakeBatchTTSEngine produces one mp3 of the right length for each text,
+# using far fewer requests than there are texts.
+# e.g. test_batch_tts(n_texts=300)
+def test_batch_tts(n_texts=300, seed=0):
+    random.seed(seed)
+    texts = [ ''.join(random.choice('abcdefghij') for j in range(random.randint(2, 10))) for i in range(n_texts) ]
+    engine = FakeBatchTTSEngine()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        output_files = [ os.path.join(tmp_dir, f'{i}.mp3') for i in range(n_texts) ]
+        start_time = time.time()
+        results = engine.create_mp3s('fake', 'default', texts, output_files)
+        elapsed_time = time.time() - start_time
+
+        # Each file has the tone for its text followed by a pause; allow for mp3 frame boundaries
+        bad_files = [ i for i, output_file in enumerate(output_files)
+                      if not results[i] or abs(audio_file_duration(output_file) - ( fake_tts_duration(texts[i]) + 0.3 )) > 0.1 ]
+        clara_utils.print_and_flush(f'--- {n_texts} texts, {engine.n_requests} requests, {elapsed_time:.1f} secs')
+        if bad_files:
+            clara_utils.print_and_flush(f'*** Error: wrong or missing audio for texts {bad_files}')
+        else:
+            clara_utils.print_and_flush(f'--- All mp3s have the expected durations')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
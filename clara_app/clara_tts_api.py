@@ -19,16 +19,34 @@ Returns the first available TTS engine that supports the given language.
 Returns the default voice for the given language in the specified TTS engine or the first available engine if not specified.
 - get_language_id(language: str, tts_engine: Optional[TTSEngine]=None) -> Optional[str]:
 Returns the language ID for the given language in the specified TTS engine or the first available engine if not specified.
+
+Clients: each engine makes its requests through a client or HTTP session which is created the first time it is needed
+and then shared by all engine instances and threads in the process, so that connections are kept alive and pooled
+and credentials are only loaded once. See shared_client.
+
+Batch synthesis: TTSEngine.create_mp3s creates mp3s for a list of texts. Engines which can say where each part of a longer
+input starts in the audio (Google, using SSML marks, and ElevenLabs, using character alignments) set supports_batch_synthesis
+and implement synthesize_with_timings. create_mp3s then sends the texts in batches, one request per batch, and splits the
+audio at the returned times. Other engines, and batches which fail, get one request per text.
+
+Rate limits: every request goes through TTSEngine.scheduled_request, which uses the token bucket for the engine
+in clara_api_scheduler and retries rate limit errors with backoff. TTS requests have bulk priority.
 """
 
 from .clara_utils import get_config, post_task_update, os_environ_or_none
 from .clara_utils import absolute_file_name, absolute_local_file_name, local_file_exists, write_local_txt_file
+from .clara_audio_splitter import split_audio_file
+from .clara_api_scheduler import run_scheduled_api_call
 
 from openai import OpenAI
 from google.cloud import texttospeech
+# Timepoints for SSML marks are only available in the beta API
+from google.cloud import texttospeech_v1beta1
 
+import html
 import os
 import tempfile
+import threading
 import requests
 import base64
 import gtts
@@ -37,10 +55,92 @@ import json
 
 config = get_config()
 
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+# Return the client called name for this process, creating it with make_client the first time.
+# Clients are kept per process because gRPC channels and connection pools can't be used after a fork.
+def shared_client(name, make_client):
+    key = ( name, os.getpid() )
+    with _shared_clients_lock:
+        if not key in _shared_clients:
+            _shared_clients[key] = make_client()
+        return _shared_clients[key]
+
+def make_http_session():
+    pool_size = int(config.get('tts', 'http_pool_maxsize'))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Keep-alive HTTP session used by the engines which call REST APIs directly
+def get_http_session():
+    return shared_client('http_session', make_http_session)
+
 class TTSEngine:
+    supports_batch_synthesis = False
+
     def create_mp3(self, language_id, voice_id, text, output_file):
         raise NotImplementedError
 
+    # Create mp3s for texts[i] in output_files[i], returning a list of booleans saying which ones succeeded
+    def create_mp3s(self, language_id, voice_id, texts, output_files, callback=None):
+        results = [ False ] * len(texts)
+        if not self.supports_batch_synthesis or len(texts) < 2:
+            batches = []
+            single_requests = list(range(len(texts)))
+        else:
+            batches = tts_batches([ self.batch_item_size(text) for text in texts ],
+                                  int(config.get('tts', 'batch_max_characters')), int(config.get('tts', 'batch_max_items')))
+            single_requests = []
+            post_task_update(callback, f"--- Creating {len(texts)} {self.tts_engine_type} mp3s in {len(batches)} batches")
+
+        for batch in batches:
+            try:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    batch_file = os.path.join(temp_dir, 'batch.mp3')
+                    intervals = self.synthesize_with_timings(language_id, voice_id, [ texts[i] for i in batch ], batch_file, callback=callback)
+                    split_audio_file(batch_file, intervals, [ output_files[i] for i in batch ])
+                for i in batch:
+                    results[i] = True
+            except Exception as e:
+                post_task_update(callback, f"*** Warning: batch synthesis of {len(batch)} texts failed, creating them one at a time: '{str(e)}'")
+                single_requests += batch
+
+        for i in sorted(single_requests):
+            results[i] = self.create_mp3(language_id, voice_id, texts[i], output_files[i], callback=callback)
+        return results
+
+    # Create an mp3 for the texts said one after the other, and return a list of ( start_time, end_time ) for each one
+    def synthesize_with_timings(self, language_id, voice_id, texts, output_file, callback=None):
+        raise NotImplementedError
+
+    # Contribution of a text to the size of a batch request
+    def batch_item_size(self, text):
+        return len(text) + 1
+
+    # Send one request to the engine's API, by calling function, when the rate limit for the engine allows it
+    def scheduled_request(self, function, callback=None):
+        return run_scheduled_api_call('tts', self.tts_engine_type, function, priority='bulk', callback=callback)
+
+# Divide items into consecutive batches whose total size is at most max_size and which contain at most max_items items
+def tts_batches(sizes, max_size, max_items):
+    batches = []
+    current_batch = []
+    current_size = 0
+    for i, size in enumerate(sizes):
+        if current_batch and ( current_size + size > max_size or len(current_batch) >= max_items ):
+            batches.append(current_batch)
+            current_batch = []
+            current_size = 0
+        current_batch.append(i)
+        current_size += size
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
 class ReadSpeakerEngine(TTSEngine):
     def __init__(self, api_key=None, base_url=None):
         self.tts_engine_type = 'readspeaker'
@@ -122,17 +222,20 @@ class ReadSpeakerEngine(TTSEngine):
             "text": text,
             "streaming": 0
         }
-        response = requests.post(self.base_url, data, stream=True)
-        if response.status_code == 200:
-            with open(output_file, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            return True
-        else:
-            return False
+        # Use 'with' so that the connection goes back to the pool even if we don't read the response
+        with self.scheduled_request(lambda: get_http_session().post(self.base_url, data, stream=True), callback=callback) as response:
+            if response.status_code == 200:
+                with open(output_file, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
+                return True
+            else:
+                return False
 
 class GoogleTTSEngine(TTSEngine):
+    supports_batch_synthesis = True
+
     def __init__(self):
         self.tts_engine_type = 'google'
         self.phonetic = False
@@ -216,34 +319,19 @@ class GoogleTTSEngine(TTSEngine):
             found_google_creds = self._load_google_application_creds(callback=callback)
 
             if found_google_creds:
-                # Initialize the client
-                client = texttospeech.TextToSpeechClient()
+                client = shared_client('google_tts', texttospeech.TextToSpeechClient)
 
                 # Set the text input
                 synthesis_input = texttospeech.SynthesisInput(text=text)
 
-                # Specify the voice, if possible using its name
-                if voice_id == 'default':
-                    voice = texttospeech.VoiceSelectionParams(
-                        language_code=language_id
-                        )
-                else:
-                    voice = texttospeech.VoiceSelectionParams(
-                        language_code=language_id,
-                        name=voice_id
-                        )
-
-                # Specify the audio configuration 
-                audio_config = texttospeech.AudioConfig(
-                    audio_encoding=texttospeech.AudioEncoding.MP3
-                )
+                voice, audio_config = self._voice_and_audio_config(texttospeech, language_id, voice_id)
 
                 # Perform the Text-to-Speech request
-                response = client.synthesize_speech(
+                response = self.scheduled_request(lambda: client.synthesize_speech(
                     input=synthesis_input, 
                     voice=voice, 
                     audio_config=audio_config
-                    )
+                    ), callback=callback)
 
                 # Save the audio to the file
                 with open(output_file, "wb") as out:
@@ -260,6 +348,50 @@ class GoogleTTSEngine(TTSEngine):
             post_task_update(callback, f"*** Warning: unable to create Google TTS mp3 for '{text}': {str(e)}")
             return False
 
+    # Put an SSML mark before each text and a pause after it, and split the audio at the marks
+    def synthesize_with_timings(self, language_id, voice_id, texts, output_file, callback=None):
+        if not self._load_google_application_creds(callback=callback):
+            raise ValueError('No Google credentials')
+        pause_ms = int(config.get('tts', 'batch_pause_ms'))
+        ssml = '<speak>' + \
+               ''.join(f'<mark name="{i}"/>{html.escape(text)}<break time="{pause_ms}ms"/>' for i, text in enumerate(texts)) + \
+               '<mark name="end"/></speak>'
+
+        client = shared_client('google_tts_v1beta1', texttospeech_v1beta1.TextToSpeechClient)
+        voice, audio_config = self._voice_and_audio_config(texttospeech_v1beta1, language_id, voice_id)
+        response = self.scheduled_request(lambda: client.synthesize_speech(request=texttospeech_v1beta1.SynthesizeSpeechRequest(
+            input=texttospeech_v1beta1.SynthesisInput(ssml=ssml),
+            voice=voice,
+            audio_config=audio_config,
+            enable_time_pointing=[ texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK ]
+            )), callback=callback)
+
+        with open(output_file, "wb") as out:
+            out.write(response.audio_content)
+        mark_times = { timepoint.mark_name: timepoint.time_seconds for timepoint in response.timepoints }
+        start_times = [ mark_times[str(i)] for i in range(len(texts)) ] + [ mark_times['end'] ]
+        return list(zip(start_times[:-1], start_times[1:]))
+
+    def batch_item_size(self, text):
+        # Escaped text plus the mark and break tags. Google's limit is on bytes rather than characters
+        return len(html.escape(text).encode('utf-8')) + 50
+
+    # Specify the voice, if possible using its name, and the audio configuration
+    def _voice_and_audio_config(self, api_module, language_id, voice_id):
+        if voice_id == 'default':
+            voice = api_module.VoiceSelectionParams(
+                language_code=language_id
+                )
+        else:
+            voice = api_module.VoiceSelectionParams(
+                language_code=language_id,
+                name=voice_id
+                )
+        audio_config = api_module.AudioConfig(
+            audio_encoding=api_module.AudioEncoding.MP3
+        )
+        return voice, audio_config
+
     def create_mp3_gtts(self, language_id, voice_id, text, output_file, callback=None):
         try:
             found_google_creds = self._load_google_application_creds(callback=callback)
@@ -282,6 +414,13 @@ class GoogleTTSEngine(TTSEngine):
             return False
 
     def _load_google_application_creds(self, callback=None):
+        global _google_creds_loaded
+        if _google_creds_loaded:
+            return True
+        _google_creds_loaded = self._find_google_application_creds(callback=callback)
+        return _google_creds_loaded
+
+    def _find_google_application_creds(self, callback=None):
         creds_file = os_environ_or_none('GOOGLE_APPLICATION_CREDENTIALS')
         creds_string = os_environ_or_none('GOOGLE_CREDENTIALS_JSON')
         
@@ -297,6 +436,9 @@ class GoogleTTSEngine(TTSEngine):
             post_task_update(callback, f"*** Warning: unable to find Google credentials in GOOGLE_APPLICATION_CREDENTIALS or GOOGLE_CREDENTIALS_JSON")
             return False
 
+# Set once Google credentials have been found, so that we don't look for them again on every request
+_google_creds_loaded = False
+
 class OpenAITTSEngine(TTSEngine):
     def __init__(self):
         self.tts_engine_type = 'openai'
@@ -319,13 +461,13 @@ class OpenAITTSEngine(TTSEngine):
                            
     def create_mp3(self, language_id, voice_id, text, output_file, callback=None):
         try: 
-            client = OpenAI(api_key=self.open_ai_key)
+            client = shared_client(( 'openai', self.open_ai_key ), lambda: OpenAI(api_key=self.open_ai_key, max_retries=0))
             speech_file_path = absolute_local_file_name(output_file)
-            response = client.audio.speech.create(
+            response = self.scheduled_request(lambda: client.audio.speech.create(
                               model="tts-1",
                               voice=voice_id,
                               input=text
-                              )
+                              ), callback=callback)
             response.stream_to_file(speech_file_path)
             return True
         
@@ -376,7 +518,7 @@ class ABAIREngine(TTSEngine):
                 "audioEncoding": "MP3"
             }
         }
-        response = requests.post(self.base_url, json=data)
+        response = self.scheduled_request(lambda: get_http_session().post(self.base_url, json=data), callback=callback)
         if response.status_code == 200:
             encoded_audio = response.json()["audioContent"]
             decoded_audio = base64.b64decode(encoded_audio)
@@ -387,6 +529,8 @@ class ABAIREngine(TTSEngine):
             return False
 
 class ElevenLabsEngine(TTSEngine):
+    supports_batch_synthesis = True
+
     def __init__(self, base_url=None):
         self.tts_engine_type = 'eleven_labs'
         self.phonetic = False
@@ -408,7 +552,7 @@ class ElevenLabsEngine(TTSEngine):
             "Content-Type": "application/json"
             }
 
-        response = requests.get(url, headers=headers)
+        response = get_http_session().get(url, headers=headers)
         
         data = response.json()
 
@@ -432,27 +576,17 @@ class ElevenLabsEngine(TTSEngine):
             }
 
             # Set up the data payload for the API request, including the text and voice settings
-            data = {
-                "text": TEXT_TO_SPEAK,
-                "model_id": "eleven_multilingual_v2",
-                "voice_settings": {
-                    "stability": 0.5,
-                    "similarity_boost": 0.8,
-                    "style": 0.0,
-                    "use_speaker_boost": True
-                }
-            }
-
-            response = requests.post(tts_url, headers=headers, json=data, stream=True)
-
-            if response.ok:
-                with open(OUTPUT_PATH, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                        f.write(chunk)
-                return True
-            else:
-                print(response.text)
-                return False
+            data = self._request_data(TEXT_TO_SPEAK)
+
+            with self.scheduled_request(lambda: get_http_session().post(tts_url, headers=headers, json=data, stream=True), callback=callback) as response:
+                if response.ok:
+                    with open(OUTPUT_PATH, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                    return True
+                else:
+                    print(response.text)
+                    return False
         except requests.exceptions.RequestException as e:
             post_task_update(callback, f"*** Warning: Network error while creating ElevenLabs TTS mp3 for '{text}': '{str(e)}'\n{traceback.format_exc()}")
             return False
@@ -462,6 +596,45 @@ class ElevenLabsEngine(TTSEngine):
         except Exception as e:
             post_task_update(callback, f"*** Warning: unable to create ElevenLabs TTS mp3 for '{text}': '{str(e)}'\n{traceback.format_exc()}")
             return False
+
+    # Join the texts with paragraph breaks, and split the audio where the first character of each text starts
+    def synthesize_with_timings(self, language_id, voice_id, texts, output_file, callback=None):
+        separator = '\n\n'
+        text = separator.join(texts)
+        tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/with-timestamps"
+        headers = {
+            "Accept": "application/json",
+            "xi-api-key": os.environ["ELEVEN_LABS_API_KEY"]
+        }
+        response = self.scheduled_request(lambda: get_http_session().post(tts_url, headers=headers, json=self._request_data(text)), callback=callback)
+        response.raise_for_status()
+        response_data = response.json()
+
+        alignment = response_data['alignment']
+        if len(alignment['characters']) != len(text):
+            raise ValueError(f'Alignment has {len(alignment["characters"])} characters, but the text has {len(text)}')
+        with open(absolute_local_file_name(output_file), "wb") as f:
+            f.write(base64.b64decode(response_data['audio_base64']))
+
+        start_times = []
+        offset = 0
+        for item in texts:
+            start_times.append(alignment['character_start_times_seconds'][offset])
+            offset += len(item) + len(separator)
+        start_times.append(alignment['character_end_times_seconds'][-1])
+        return list(zip(start_times[:-1], start_times[1:]))
+
+    def _request_data(self, text):
+        return {
+            "text": text,
+            "model_id": "eleven_multilingual_v2",
+            "voice_settings": {
+                "stability": 0.5,
+                "similarity_boost": 0.8,
+                "style": 0.0,
+                "use_speaker_boost": True
+            }
+        }
         
 ## Use ipa-reader.xyz to create an mp3 for a piece of IPA text.
 ##
@@ -587,7 +760,7 @@ class IPAReaderEngine(TTSEngine):
               'TE': 'trailers'
             }
 
-            response = requests.request("POST", self.execute_url, headers=headers, data=payload)
+            response = self.scheduled_request(lambda: get_http_session().request("POST", self.execute_url, headers=headers, data=payload), callback=callback)
 
             binary_data = response._content.decode('unicode_escape')
 
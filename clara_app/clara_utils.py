@@ -23,8 +23,10 @@ import requests
 import subprocess
 import copy
 import pytz
+import unicodedata
 
 from datetime import datetime, timezone
+from functools import lru_cache
 
 from PIL import Image
 
@@ -234,6 +236,30 @@ def copy_to_local_file(pathname1, pathname2):
     else:
         shutil.copyfile(abspathname1, abspathname2)
 
+# Open a file for binary reading without first copying it anywhere.
+# Returns a local file object or an S3 streaming body, depending on the value of _s3_storage
+def open_file_for_binary_read(pathname):
+    abspathname = absolute_file_name(pathname)
+
+    if _s3_storage:
+        fail_if_no_s3_bucket()
+        return _s3_client.get_object(Bucket=_s3_bucket_name, Key=abspathname)['Body']
+    else:
+        return open(abspathname, 'rb')
+
+# Write the contents of a binary stream to a file.
+# The file will be local or S3, depending on the value of _s3_storage
+def write_stream_to_file(stream, pathname):
+    abspathname = absolute_file_name(pathname)
+
+    if _s3_storage:
+        fail_if_no_s3_bucket()
+        _s3_client.upload_fileobj(stream, _s3_bucket_name, abspathname)
+    else:
+        os.makedirs(os.path.dirname(abspathname), exist_ok=True)
+        with open(abspathname, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+
 def copy_directory(pathname1, pathname2):
     abspathname1 = absolute_file_name(pathname1)
     abspathname2 = absolute_file_name(pathname2)
@@ -483,6 +509,26 @@ def list_files_in_directory(pathname):
     else:
         return os.listdir(abspathname)
 
+# Return the pathnames, relative to the directory and using '/' as separator, of all files under it
+def list_files_in_directory_recursively(pathname):
+    abspathname = absolute_file_name(pathname)
+
+    if _s3_storage:
+        fail_if_no_s3_bucket()
+        if not abspathname.endswith('/'):
+            abspathname += '/'
+        result = []
+        paginator = _s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=_s3_bucket_name, Prefix=abspathname):
+            result += [ item['Key'][len(abspathname):] for item in page.get('Contents', []) ]
+        return result
+    else:
+        result = []
+        for dirpath, _, filenames in os.walk(abspathname):
+            for filename in filenames:
+                result.append(os.path.relpath(os.path.join(dirpath, filename), abspathname).replace('\\', '/'))
+        return result
+
 def remove_file(pathname):
     abspathname = absolute_file_name(pathname)
 
@@ -629,6 +675,23 @@ def write_txt_file(data, pathname: str):
         with open(abspathname, 'w', encoding='utf-8') as f:
             f.write(data)
             
+# Append to a text file, creating it if necessary.
+# S3 objects can't be appended to, so in S3 mode we have to rewrite the object.
+def append_txt_file(data, pathname: str):
+    abspathname = absolute_file_name(pathname)
+
+    if _s3_storage:
+        fail_if_no_s3_bucket()
+        try:
+            obj = _s3_client.get_object(Bucket=_s3_bucket_name, Key=abspathname)
+            existing_data = obj['Body'].read().decode('utf-8')
+        except _s3_client.exceptions.NoSuchKey:
+            existing_data = ''
+        _s3_client.put_object(Bucket=_s3_bucket_name, Key=abspathname, Body=existing_data + data)
+    else:
+        with open(abspathname, 'a', encoding='utf-8') as f:
+            f.write(data)
+
 def write_local_txt_file(data, pathname: str):
     abspathname = absolute_local_file_name(pathname)
 
@@ -892,19 +955,46 @@ def canonical_word_for_audio(text):
     return text.lower()
 
 def canonical_text_for_audio(text, phonetic=False):
-    if phonetic:
-        return canonical_word_for_audio(text.strip())
+    return canonical_text_and_audio_content(text, phonetic=phonetic)[0]
+
+# True unless the string is just HTML tags, punctuation marks and separators
+def string_has_audio_content(text):
+    return canonical_text_and_audio_content(text)[1]
+
+_html_markup_regex = re.compile(r'<[^>]*>')
+
+# Only tags without attributes are ignored when deciding whether a string has audio content
+_simple_html_tag_regex = re.compile(r'<\/?\w+>')
+
+# str.translate table which deletes the characters with no audio content: punctuation marks, spaces, newlines and '|'.
+# It's filled in as characters are seen, so each character is only classified once.
+class NoAudioContentTable(dict):
+    def __missing__(self, code_point):
+        char = chr(code_point)
+        value = None if char in ' \n|' or unicodedata.category(char).startswith('P') else code_point
+        self[code_point] = value
+        return value
+
+_no_audio_content_table = NoAudioContentTable()
+
+# Return ( canonical_text_for_audio(text), string_has_audio_content(text) ).
+# The audio annotator asks for these for every word and segment, several times per render, so cache the results.
+@lru_cache(maxsize=100000)
+def canonical_text_and_audio_content(text, phonetic=False):
+    if '<' in text:
+        text_without_markup = _html_markup_regex.sub('', text)
+        text_without_simple_tags = _simple_html_tag_regex.sub('', text)
     else:
-        # Remove HTML markup
-        text = re.sub(r'<[^>]*>', '', text)
-
-        # Consolidate sequences of whitespaces to a single space
-        text = re.sub(r'\s+', ' ', text)
+        text_without_markup = text_without_simple_tags = text
 
-        # Trim leading and trailing spaces
-        text = text.strip()
+    if phonetic:
+        canonical_text = canonical_word_for_audio(text.strip())
+    else:
+        # Remove HTML markup, consolidate sequences of whitespaces to a single space and trim
+        canonical_text = ' '.join(text_without_markup.split())
 
-        return text
+    has_audio_content = bool(text_without_simple_tags.translate(_no_audio_content_table))
+    return canonical_text, has_audio_content
 
 def remove_blank_lines(text):
     lines = text.split('\n')
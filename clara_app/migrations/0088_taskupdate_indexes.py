@@ -0,0 +1,21 @@
+# Generated by Django 4.2.1 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clara_app', '0087_content_unique_access_count_contentaccess'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskupdate',
+            index=models.Index(fields=['report_id', 'read', 'timestamp'], name='clara_app_t_report__709204_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='taskupdate',
+            index=models.Index(fields=['timestamp'], name='clara_app_t_timesta_c41972_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clara_app', '0088_taskupdate_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagemetadata',
+            name='width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagemetadata',
+            name='height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagemetadata',
+            name='thumbnail_width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagemetadata',
+            name='thumbnail_height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagemetadata',
+            name='renditions',
+            field=models.JSONField(blank=True, default=list, help_text='Resized versions of the image, as dicts with keys "width", "height", "format" and "file".'),
+        ),
+    ]
@@ -338,7 +338,10 @@ class TaskUpdate(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['report_id', 'timestamp']),
-            # Consider adding additional indexes if needed for query optimization
+            # Status views fetch the unread updates for a report
+            models.Index(fields=['report_id', 'read', 'timestamp']),
+            # Used when deleting old updates
+            models.Index(fields=['timestamp']),
         ]
 
 
@@ -663,6 +666,12 @@ class ImageMetadata(models.Model):
     description_variable = models.CharField(max_length=255, blank=True, default='',
                                             help_text='Variable name for storing image understanding result.')
     description_variables = models.JSONField(blank=True, default=list, help_text='List of description variables for this image generation request.')
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    thumbnail_width = models.IntegerField(null=True, blank=True)
+    thumbnail_height = models.IntegerField(null=True, blank=True)
+    renditions = models.JSONField(blank=True, default=list,
+                                  help_text='Resized versions of the image, as dicts with keys "width", "height", "format" and "file".')
 
     class Meta:
         db_table = 'orm_image_metadata'
@@ -0,0 +1,128 @@
+"""
+Buffered channel for the progress messages that asynchronous tasks post through their callbacks.
+
+Workers can post dozens of messages per annotation chunk, including a heartbeat every few seconds
+while waiting for OpenAI. Rather than doing one TaskUpdate insert per message, the channel keeps
+a per-process buffer which is written with a single bulk insert when any of the following happens:
+
+- the buffer reaches max_buffered_updates messages
+- flush_interval_seconds have passed since the first message in the buffer was posted
+- a task posts one of the terminal status messages 'finished' or 'error'
+
+Consecutive heartbeat messages for the same task are coalesced, so only the most recent one is written.
+The channel also periodically deletes TaskUpdate records older than ttl_hours.
+"""
+
+from django.db import connections
+from django.utils import timezone
+
+from .models import TaskUpdate
+
+from .clara_utils import get_config
+
+from datetime import timedelta
+import atexit
+import threading
+import time
+import traceback
+
+config = get_config()
+
+# Messages posted repeatedly while a task is waiting; only the latest one is interesting
+_HEARTBEAT_PREFIXES = ( 'Waiting for OpenAI response', )
+
+_TERMINAL_MESSAGES = ( 'finished', 'error' )
+
+class TaskUpdateChannel:
+    def __init__(self, flush_interval_seconds=None, max_buffered_updates=None, ttl_hours=None, cleanup_interval_seconds=None):
+        self.flush_interval_seconds = flush_interval_seconds if flush_interval_seconds is not None else \
+                                      float(config.get('task_updates', 'flush_interval_seconds'))
+        self.max_buffered_updates = max_buffered_updates if max_buffered_updates is not None else \
+                                    int(config.get('task_updates', 'max_buffered_updates'))
+        self.ttl_hours = ttl_hours if ttl_hours is not None else \
+                         float(config.get('task_updates', 'ttl_hours'))
+        self.cleanup_interval_seconds = cleanup_interval_seconds if cleanup_interval_seconds is not None else \
+                                        float(config.get('task_updates', 'cleanup_interval_seconds'))
+        self._buffer = []
+        self._lock = threading.RLock()
+        # Held while swapping out and writing a batch, so that batches are written in the order they were posted
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._last_cleanup = 0.0
+
+    def post(self, report_id, user_id, task_type, message):
+        if len(message) > 1000:
+            message = message[:1000] + '...'
+        report_id = str(report_id)
+        with self._lock:
+            if is_heartbeat_message(message) and self._buffer:
+                last = self._buffer[-1]
+                if last.report_id == report_id and is_heartbeat_message(last.message):
+                    last.message = message
+                    return
+            self._buffer.append(TaskUpdate(report_id=report_id, user_id=user_id, task_type=task_type, message=message))
+            flush_now = message in _TERMINAL_MESSAGES or len(self._buffer) >= self.max_buffered_updates
+            if not flush_now and not self._timer:
+                self._timer = threading.Timer(self.flush_interval_seconds, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            # A problem with the progress messages mustn't abort the task that posted them
+            self._flush_logging_errors()
+
+    # The database is written under _write_lock, not _lock, so that other threads posting updates don't wait for the write.
+    # Flushes wait for each other, so a later batch, e.g. one ending in 'finished', never commits before an earlier one.
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                updates, self._buffer = self._buffer, []
+                cleanup_due = self._cleanup_is_due()
+            if updates:
+                # bulk_create sets the auto_now_add timestamps in order, and readers break ties on id
+                TaskUpdate.objects.bulk_create(updates)
+            if cleanup_due:
+                delete_old_task_updates(self.ttl_hours)
+
+    def _flush_from_timer(self):
+        try:
+            self._flush_logging_errors()
+        finally:
+            # Django database connections belong to the thread that opened them
+            connections.close_all()
+
+    def _flush_logging_errors(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f'*** Error when flushing task updates: {str(e)}\n{traceback.format_exc()}')
+
+    def _cleanup_is_due(self):
+        now = time.time()
+        if now - self._last_cleanup >= self.cleanup_interval_seconds:
+            self._last_cleanup = now
+            return True
+        return False
+
+def is_heartbeat_message(message):
+    return message.startswith(_HEARTBEAT_PREFIXES)
+
+def is_terminal_message(message):
+    return message in _TERMINAL_MESSAGES
+
+def delete_old_task_updates(ttl_hours):
+    time_threshold = timezone.now() - timedelta(hours=ttl_hours)
+    TaskUpdate.objects.filter(timestamp__lt=time_threshold).delete()
+
+_channel = None
+_channel_lock = threading.Lock()
+
+def get_task_update_channel():
+    global _channel
+    with _channel_lock:
+        if _channel is None:
+            _channel = TaskUpdateChannel()
+            atexit.register(_channel.flush)
+        return _channel
@@ -1,3 +1,27 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from . import clara_api_scheduler
+
+import os
+import tempfile
+
+class APISchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_db = clara_api_scheduler.config.get('api_scheduler', 'db', raw=True)
+        clara_api_scheduler._api_scheduler = None
+
+    def tearDown(self):
+        clara_api_scheduler.config.set('api_scheduler', 'db', self.original_db)
+        clara_api_scheduler._api_scheduler = None
+        self.temp_dir.cleanup()
+
+    # Every OpenAI and TTS request goes through the scheduler, so it must work before its directory exists
+    def test_scheduled_call_creates_missing_db_directory(self):
+        db_file = os.path.join(self.temp_dir.name, 'missing', 'tmp', 'api_scheduler.db')
+        clara_api_scheduler.config.set('api_scheduler', 'db', db_file)
+
+        result = clara_api_scheduler.run_scheduled_api_call('test_provider', 'test_model', lambda: 'response')
+
+        self.assertEqual(result, 'response')
+        self.assertTrue(os.path.isfile(db_file))
@@ -1,4 +1,8 @@
+from .tictactoe_bitboard import list_board_to_bitboards, player_and_opponent_masks, empty_mask, is_win
+from .tictactoe_bitboard import winning_squares, mask_to_indices, POPCOUNT
+
 import pprint
+import time
 
 def algebraic_to_index(algebraic):
     conversion = {
@@ -26,15 +30,8 @@ def get_turn_value(board):
     return 1 + 9 - len(get_available_moves(board))
 
 def check_win(board, player):
-    win_conditions = [
-        [0, 1, 2], [3, 4, 5], [6, 7, 8],  # horizontal
-        [0, 3, 6], [1, 4, 7], [2, 5, 8],  # vertical
-        [0, 4, 8], [2, 4, 6]  # diagonal
-    ]
-    for condition in win_conditions:
-        if all(board[i] == player for i in condition):
-            return True
-    return False
+    x_mask, o_mask = list_board_to_bitboards(board)
+    return is_win(x_mask if player == 'X' else o_mask)
 
 def check_draw(board):
     return all(s != ' ' for s in board)
@@ -47,7 +44,9 @@ def apply_move(board, move, player):
     new_board[move] = player
     return new_board
 
-def minimax(board, player, depth):
+# Plain recursive game-tree search. We normally use the solution table instead (see below),
+# but keep this for positions the table doesn't cover and for checking the table.
+def minimax_search(board, player, depth):
     opponent = get_opponent(player)
     
     if check_win(board, 'X'):
@@ -62,7 +61,7 @@ def minimax(board, player, depth):
         best_value = -float('inf')
         for move in get_available_moves(board):
             board[move] = player
-            value, _ = minimax(board, opponent, depth + 1)
+            value, _ = minimax_search(board, opponent, depth + 1)
             board[move] = ' '
             if value > best_value:
                 best_value = value
@@ -71,7 +70,7 @@ def minimax(board, player, depth):
         best_value = float('inf')
         for move in get_available_moves(board):
             board[move] = player
-            value, _ = minimax(board, opponent, depth + 1)
+            value, _ = minimax_search(board, opponent, depth + 1)
             board[move] = ' '
             if value < best_value:
                 best_value = value
@@ -79,6 +78,123 @@ def minimax(board, player, depth):
     
     return best_value, best_move
 
+# -----------------------------------------
+
+# Solution table.
+#
+# There are only 5,478 positions reachable from the empty board, so we solve them all once and then look them up,
+# instead of searching the game tree again every time we evaluate a position.
+# Positions are encoded in base 3 (empty = 0, X = 1, O = 2; square i has weight 3 ** i) and keyed on
+# ( code, player_to_move ). Each entry is a tuple ( value, best_move, correct_moves ), where
+#
+# - value is 1 if X wins, -1 if O wins, 0 for a draw, with best play
+# - best_move is the move minimax_search would choose, i.e. the lowest-numbered move with the best value, or None if the game is over
+# - correct_moves is the tuple of all moves which keep the value
+#
+# Positions which can't be reached from the empty board with X to move, e.g. O moving first, are solved
+# and added to the table the first time they're looked up.
+
+_SQUARE_CODES = { ' ': 0, 'X': 1, 'O': 2 }
+_POWERS_OF_3 = [ 3 ** i for i in range(9) ]
+
+_solution_table = {}
+
+# Separate cache for immediate_threats_and_opportunities, which is filled in on demand
+_threats_and_opportunities_table = {}
+
+def board_to_code(board):
+    return sum(_SQUARE_CODES[board[i]] * _POWERS_OF_3[i] for i in range(9))
+
+def get_solved_position(board, player):
+    _initialise_solution_table_if_necessary()
+    key = ( board_to_code(board), player )
+    if not key in _solution_table:
+        _solve_position(board.copy(), key[0], player)
+    return _solution_table[key]
+
+def get_correct_moves(board, player):
+    return list(get_solved_position(board, player)[2])
+
+def minimax(board, player, depth):
+    value, best_move, _ = get_solved_position(board, player)
+    return value, best_move
+
+def _initialise_solution_table_if_necessary():
+    if not _solution_table:
+        _solve_position([' '] * 9, 0, 'X')
+
+def _solve_position(board, code, player):
+    key = ( code, player )
+    if key in _solution_table:
+        return _solution_table[key][0]
+
+    if check_win(board, 'X'):
+        entry = ( 1, None, () )
+    elif check_win(board, 'O'):
+        entry = ( -1, None, () )
+    elif check_draw(board):
+        entry = ( 0, None, () )
+    else:
+        opponent = get_opponent(player)
+        player_code = _SQUARE_CODES[player]
+        move_values = []
+        for move in get_available_moves(board):
+            board[move] = player
+            move_values.append(( move, _solve_position(board, code + player_code * _POWERS_OF_3[move], opponent) ))
+            board[move] = ' '
+        values = [ value for move, value in move_values ]
+        best_value = max(values) if player == 'X' else min(values)
+        correct_moves = tuple(move for move, value in move_values if value == best_value)
+        entry = ( best_value, correct_moves[0], correct_moves )
+
+    _solution_table[key] = entry
+    return entry[0]
+
+# -----------------------------------------
+
+# Board symmetries.
+#
+# Each of the 8 symmetries of the square is a permutation of the indices: square i of the transformed board
+# is square symmetry[i] of the original one. A move at index i on the transformed board is therefore
+# the move symmetry[i] on the original board.
+
+def _symmetry_from_coordinate_map(coordinate_map):
+    symmetry = [ None ] * 9
+    for index in range(9):
+        row, column = divmod(index, 3)
+        new_row, new_column = coordinate_map(row, column)
+        symmetry[3 * new_row + new_column] = index
+    return tuple(symmetry)
+
+BOARD_SYMMETRIES = [ _symmetry_from_coordinate_map(coordinate_map) for coordinate_map in
+                     ( lambda r, c: ( r, c ),
+                       lambda r, c: ( c, 2 - r ),
+                       lambda r, c: ( 2 - r, 2 - c ),
+                       lambda r, c: ( 2 - c, r ),
+                       lambda r, c: ( r, 2 - c ),
+                       lambda r, c: ( 2 - r, c ),
+                       lambda r, c: ( c, r ),
+                       lambda r, c: ( 2 - c, 2 - r ) ) ]
+
+def apply_symmetry(board, symmetry):
+    return [ board[symmetry[index]] for index in range(9) ]
+
+# Move on the transformed board corresponding to 'move' on the original board
+def move_to_symmetric_move(move, symmetry):
+    return symmetry.index(move)
+
+# Move on the original board corresponding to 'move' on the transformed board
+def symmetric_move_to_move(move, symmetry):
+    return symmetry[move]
+
+# Return ( canonical_board_str, symmetry ), where canonical_board_str is the same for all boards which are
+# symmetric to each other, and symmetry is one that transforms 'board' into it
+def canonical_board_and_symmetry(board):
+    return min(( ''.join(apply_symmetry(board, symmetry)), symmetry ) for symmetry in BOARD_SYMMETRIES)
+
+def canonical_board_str(board):
+    return canonical_board_and_symmetry(board)[0]
+
 def get_board_from_positions(x_positions, o_positions):
     board = [' ' for _ in range(9)]
     for pos in x_positions:
@@ -122,82 +238,75 @@ def is_game_over(board):
     else:
         return 'ongoing', None
 
+# The threat functions work on bitboards (see tictactoe_bitboard.py) rather than trying each move on the list board.
+
 def get_threatened_moves(board, player):
-    threatened_moves = []
-    available_moves = get_available_moves(board)
-    for move in available_moves:
-        board[move] = player
-        if check_win(board, player):
-            threatened_moves.append(move)
-        board[move] = ' '
-    return threatened_moves
+    own_mask, other_mask = player_and_opponent_masks(*list_board_to_bitboards(board), player)
+    return mask_to_indices(winning_moves_mask(own_mask, other_mask))
 
 def get_threat_moves(board, player):
-    threat_moves = []
-    available_moves = get_available_moves(board)
-    for move in available_moves:
-        board[move] = player
-        if len(get_threatened_moves(board, player)) > 0:
-            threat_moves.append(move)
-        board[move] = ' '
-    return threat_moves
+    own_mask, other_mask = player_and_opponent_masks(*list_board_to_bitboards(board), player)
+    return mask_to_indices(threat_moves_mask(own_mask, other_mask, 1))
 
 def get_double_threat_moves(board, player):
-    double_threat_moves = []
-    available_moves = get_available_moves(board)
-    for move in available_moves:
-        board[move] = player
-        if len(get_threatened_moves(board, player)) > 1:
-            double_threat_moves.append(move)
-        board[move] = ' '
-    return double_threat_moves
+    own_mask, other_mask = player_and_opponent_masks(*list_board_to_bitboards(board), player)
+    return mask_to_indices(threat_moves_mask(own_mask, other_mask, 2))
+
+# Empty squares where 'own' would have a win after moving there.
+# If 'own' has already won, that's all the empty squares.
+def winning_moves_mask(own_mask, other_mask):
+    if is_win(own_mask):
+        return empty_mask(own_mask, other_mask)
+    return winning_squares(own_mask, other_mask)
 
+# Empty squares after which 'own' would have at least min_threats winning moves
+def threat_moves_mask(own_mask, other_mask, min_threats):
+    result = 0
+    for move in mask_to_indices(empty_mask(own_mask, other_mask)):
+        bit = 1 << move
+        if POPCOUNT[winning_moves_mask(own_mask | bit, other_mask)] >= min_threats:
+            result |= bit
+    return result
+
+# Look up the summary in the table, computing it if necessary.
+# The summary contains lists, so we give the caller a copy in case they change it.
 def immediate_threats_and_opportunities(board, player):
-    opponent = get_opponent(player)
+    key = ( board_to_code(board), player )
+    if not key in _threats_and_opportunities_table:
+        _threats_and_opportunities_table[key] = compute_immediate_threats_and_opportunities(board.copy(), player)
+    summary = _threats_and_opportunities_table[key]
+    return { item: ( value.copy() if isinstance(value, list) else value ) for item, value in summary.items() }
+
+def compute_immediate_threats_and_opportunities(board, player):
+    own_mask, other_mask = player_and_opponent_masks(*list_board_to_bitboards(board), player)
     move_summaries = {
-        'winning_moves': [],
-        'opponent_threats': [],
+        'winning_moves': [ index_to_algebraic(move) for move in mask_to_indices(winning_moves_mask(own_mask, other_mask)) ],
+        'opponent_threats': [ index_to_algebraic(move) for move in mask_to_indices(winning_moves_mask(other_mask, own_mask)) ],
         'double_threat': [],
         'single_threat': [],
         'double_threat_follow_up_to_single_threat': None
     }
     
-    available_moves = get_available_moves(board)
-    for move in available_moves:
-        board[move] = player
-        if check_win(board, player):
-            move_summaries['winning_moves'].append(index_to_algebraic(move))
-        board[move] = ' '
-        
-        board[move] = opponent
-        if check_win(board, opponent):
-            move_summaries['opponent_threats'].append(index_to_algebraic(move))
-        board[move] = ' '
-    
     # Check for double threats and single threats
-    for move in available_moves:
-        board[move] = player
-        threatened_moves = get_threatened_moves(board, player)
-        board[move] = ' '
-        if len(threatened_moves) > 1:
+    single_threat_moves = []
+    for move in mask_to_indices(empty_mask(own_mask, other_mask)):
+        n_threatened_moves = POPCOUNT[winning_moves_mask(own_mask | ( 1 << move ), other_mask)]
+        if n_threatened_moves > 1:
             move_summaries['double_threat'].append(index_to_algebraic(move))
-        elif len(threatened_moves) == 1:
+        elif n_threatened_moves == 1:
             move_summaries['single_threat'].append(index_to_algebraic(move))
+            single_threat_moves.append(move)
 
     # Check for follow-up double threat
-    for threat_move in move_summaries['single_threat']:
-        move_index = algebraic_to_index(threat_move)
-        board[move_index] = player
-        opponent_threat_moves = get_threatened_moves(board, player)
-        if opponent_threat_moves:
-            forced_move = opponent_threat_moves[0]  # Opponent's forced move
-            board[forced_move] = opponent
-            if not get_threatened_moves(board, opponent):  # Check that forced move is not itself a threat
-                follow_up_double_threat_moves = get_double_threat_moves(board, player)
-                if len(follow_up_double_threat_moves) > 0:
-                    move_summaries['double_threat_follow_up_to_single_threat'] = threat_move
-            board[forced_move] = ' '
-        board[move_index] = ' '
+    for threat_move in single_threat_moves:
+        own_mask_after_threat = own_mask | ( 1 << threat_move )
+        threatened_moves_mask = winning_moves_mask(own_mask_after_threat, other_mask)
+        if threatened_moves_mask:
+            forced_move_bit = threatened_moves_mask & -threatened_moves_mask  # Opponent's forced move
+            other_mask_after_forced_move = other_mask | forced_move_bit
+            if not winning_moves_mask(other_mask_after_forced_move, own_mask_after_threat):  # Check that forced move is not itself a threat
+                if threat_moves_mask(own_mask_after_threat, other_mask_after_forced_move, 2):
+                    move_summaries['double_threat_follow_up_to_single_threat'] = index_to_algebraic(threat_move)
 
     return move_summaries
 
@@ -222,5 +331,38 @@ def test_generate_position_summary(x_positions_algebraic, o_positions_algebraic,
 
     summary = generate_position_summary(board, player_to_move)
     pprint.pprint(summary)
-    
- 
+
+# Compare the time taken by the solution table and the plain recursive search to evaluate
+# every position reachable from the empty board, and check that they give the same answers
+def benchmark_solution_table():
+    _initialise_solution_table_if_necessary()
+    positions = []
+    for ( code, player ) in _solution_table:
+        if player == ( 'X' if code_to_n_pieces(code) % 2 == 0 else 'O' ):
+            positions.append(( code_to_board(code), player ))
+    print(f'--- Evaluating {len(positions)} positions')
+
+    start_time = time.time()
+    table_results = [ minimax(board, player, 0) for board, player in positions ]
+    table_time = time.time() - start_time
+    print(f'--- Solution table: {table_time:.3f} seconds')
+
+    start_time = time.time()
+    search_results = [ minimax_search(board, player, 0) for board, player in positions ]
+    search_time = time.time() - start_time
+    print(f'--- Recursive search: {search_time:.3f} seconds')
+
+    n_differences = len([ 1 for table_result, search_result in zip(table_results, search_results) if table_result != search_result ])
+    print(f'--- {n_differences} differences')
+    if table_time > 0:
+        print(f'--- Speedup: {search_time / table_time:.0f}x')
+
+def code_to_board(code):
+    board = []
+    for i in range(9):
+        board.append(' XO'[code % 3])
+        code //= 3
+    return board
+
+def code_to_n_pieces(code):
+    return len([ square for square in code_to_board(code) if square != ' ' ])
@@ -1,5 +1,11 @@
 from .tictactoe_engine import get_opponent, algebraic_to_index, index_to_algebraic, drawn_board_str, immediate_threats_and_opportunities
 from .tictactoe_gpt4 import call_gpt4_with_retry_for_cot_evaluation_async, format_board_for_gpt4
+from .tictactoe_jsonl_cache import JSONLCache, hash_for_cache_key
+from .clara_utils import get_config
+
+config = get_config()
+
+cot_evaluation_gpt_model = 'gpt-4o'
 
 cot_evaluation_template = """I am going to give you a position in a Tic-Tac-Toe game, a reliable ground-truth evaluation of the position,
 and a second analysis. Your task is to determine whether the second analysis is consistent with the ground-truth evaluation.
@@ -36,7 +42,13 @@ Provide your evaluation in JSON format as follows:
 Only provide the JSON, since the reply will be read by a Python script.
 """
 
-async def evaluate_cot_record_async(record):
+# If a cache is supplied, records that have already been evaluated are answered from it at no cost
+async def evaluate_cot_record_async(record, cache=None):
+    evaluation = {'evaluation': None, 'api_calls': []}
+    cached_evaluation = cache.get(record) if cache else None
+    if cached_evaluation:
+        record.update(cached_evaluation)
+        return {'evaluation': cached_evaluation, 'api_calls': []}
     try:
         board = record['board']
         player = record['player']
@@ -47,8 +59,11 @@ async def evaluate_cot_record_async(record):
         position_summary = threats_and_opportunities_to_english(threats_and_opportunities, player)
         formatted_request = cot_evaluation_template.format(player=player, algebraic_board=algebraic_board, formatted_board=formatted_board,
                                                            position_summary=position_summary, cot_record=cot_record)
-        evaluation = await call_gpt4_with_retry_for_cot_evaluation_async(formatted_request)
+        evaluation = await call_gpt4_with_retry_for_cot_evaluation_async(formatted_request, gpt_model=cot_evaluation_gpt_model)
         record.update(evaluation['evaluation'])
+        # Only successful evaluations are cached, so that failures are retried next time
+        if cache:
+            cache.put(record, evaluation['evaluation'])
     except Exception as e:
         #raise e
         record.update({
@@ -58,6 +73,30 @@ async def evaluate_cot_record_async(record):
         })
     return evaluation
         
+# Cache of CoT evaluations, keyed by a hash of the record and the evaluation setup.
+# The same CoT record is typically evaluated again in later cycles and in resumed runs.
+class CoTEvaluationCache(JSONLCache):
+    def get(self, record):
+        return super().get(cot_record_hash(record))
+
+    def put(self, record, evaluation):
+        super().put(cot_record_hash(record), evaluation)
+
+def cot_record_hash(record):
+    return hash_for_cache_key({ 'board': record['board'],
+                                'player': record['player'],
+                                'cot_record': record['cot_record'],
+                                'gpt_model': cot_evaluation_gpt_model,
+                                'template': cot_evaluation_template })
+
+_cot_evaluation_cache = None
+
+def get_cot_evaluation_cache():
+    global _cot_evaluation_cache
+    if _cot_evaluation_cache is None:
+        _cot_evaluation_cache = CoTEvaluationCache(config.get('tictactoe_experiments', 'cot_evaluation_cache'))
+    return _cot_evaluation_cache
+
 def threats_and_opportunities_to_english(threats_and_opportunities, player):
     opponent = get_opponent(player)
     descriptions = []
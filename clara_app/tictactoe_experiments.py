@@ -1,8 +1,11 @@
 
 from .tictactoe_repository import create_experiment_dir, get_experiment_dir, create_cycle_dir
 from .tictactoe_repository import save_game_log, correct_game_log_file, generate_cycle_summary
-from .tictactoe_engine import immediate_threats_and_opportunities
+from .tictactoe_repository import game_log_exists, is_cycle_complete, mark_cycle_complete, get_results_store
+from .tictactoe_results_store import metric_columns
 from .tictactoe_game import play_game_async
+from .tictactoe_gpt4 import set_llm_move_cache_enabled
+from .clara_utils import get_config
 
 import asyncio
 from collections import defaultdict
@@ -12,6 +15,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy.stats import ttest_ind
 
+config = get_config()
+
+experiment_opponents = [ 'random_player', 'minimal_gpt4_player', 'cot_player_without_few_shot',
+                         'cot_player_without_few_shot_explicit', 'minimax_player' ]
+
 def create_experiment0():
     create_experiment_dir('experiment0')
 
@@ -105,116 +113,128 @@ def run_experiment_async_incremental(num_cycles, starts_from_cycle=0):
                                             strategy='closest_few_shot_example_incremental', 
                                             starts_from_cycle=starts_from_cycle))
 
+# Cycles have to run in sequence, since each one takes its few-shot examples from the previous one.
+# Rerunning the same call after a crash resumes it: completed cycles are skipped,
+# and in a partially completed cycle only the games without a saved log are played.
+# If use_llm_move_cache is True or False, it overrides the config setting for the LLM move cache.
 async def run_experiment_cycles_async(experiment_name, num_cycles,
                                       strategy='n_maximally_different',
-                                      starts_from_cycle=0):
+                                      starts_from_cycle=0,
+                                      games_per_pairing=1,
+                                      use_llm_move_cache=None):
     create_experiment_dir(experiment_name, strategy=strategy)
+    if use_llm_move_cache is not None:
+        set_llm_move_cache_enabled(use_llm_move_cache)
     for cycle_number in range(starts_from_cycle, num_cycles):
-        await run_experiment_cycle_async(experiment_name, cycle_number)
-
-async def run_experiment_cycle_async(experiment_name, cycle_number):
+        if is_cycle_complete(experiment_name, cycle_number):
+            print(f'--- Cycle {cycle_number} of {experiment_name} already complete, skipping')
+            continue
+        await run_experiment_cycle_async(experiment_name, cycle_number, games_per_pairing=games_per_pairing)
+
+# The games in a cycle are independent, so we play them concurrently, at most max_concurrent_games at a time.
+# The LLM calls they make also go through the global rate limiter in tictactoe_gpt4.
+# Each game's log is saved as soon as it finishes, which is the checkpoint used when resuming.
+async def run_experiment_cycle_async(experiment_name, cycle_number, games_per_pairing=1):
     create_cycle_dir(experiment_name, cycle_number)
-    tasks = []
-    for opponent in ['random_player', 'minimal_gpt4_player', 'cot_player_without_few_shot',
-                     'cot_player_without_few_shot_explicit', 'minimax_player']:
-        tasks.append(asyncio.create_task(play_game_and_log_async(experiment_name, cycle_number, opponent, 'X')))
-        tasks.append(asyncio.create_task(play_game_and_log_async(experiment_name, cycle_number, opponent, 'O')))
-    await asyncio.gather(*tasks)
+    all_games = [ ( opponent, color, game_index )
+                  for opponent in experiment_opponents
+                  for color in ( 'X', 'O' )
+                  for game_index in range(games_per_pairing) ]
+    games_to_play = [ ( opponent, color, game_index ) for ( opponent, color, game_index ) in all_games
+                      if not game_log_exists(experiment_name, cycle_number, opponent, color, game_index=game_index) ]
+    if len(games_to_play) < len(all_games):
+        print(f'--- Resuming cycle {cycle_number}: {len(all_games) - len(games_to_play)} games already played, {len(games_to_play)} to play')
+
+    semaphore = asyncio.Semaphore(int(config.get('tictactoe_experiments', 'max_concurrent_games')))
+
+    async def play_bounded(opponent, color, game_index):
+        async with semaphore:
+            await play_game_and_log_async(experiment_name, cycle_number, opponent, color, game_index=game_index)
+
+    results = await asyncio.gather(*( play_bounded(opponent, color, game_index) for ( opponent, color, game_index ) in games_to_play ),
+                                   return_exceptions=True)
+    failures = [ ( game, result ) for game, result in zip(games_to_play, results) if isinstance(result, Exception) ]
+    for ( opponent, color, game_index ), e in failures:
+        print(f'*** Error in cycle {cycle_number}, game against {opponent} playing {color} (#{game_index}): "{str(e)}"')
+    if failures:
+        # Leave the cycle incomplete, so that rerunning the experiment plays just the missing games
+        raise ValueError(f'{len(failures)} games failed in cycle {cycle_number} of {experiment_name}')
+    
     summary = generate_cycle_summary(experiment_name, cycle_number)
+    mark_cycle_complete(experiment_name, cycle_number, len(all_games))
 
-async def play_game_and_log_async(experiment_name, cycle_number, opponent_player, color):
+async def play_game_and_log_async(experiment_name, cycle_number, opponent_player, color, game_index=0):
     if color == 'X':
         game_log = await play_game_async('cot_player_with_few_shot', opponent_player, experiment_name, cycle_number)
     else:
         game_log = await play_game_async(opponent_player, 'cot_player_with_few_shot', experiment_name, cycle_number)
-    save_game_log(experiment_name, cycle_number, opponent_player, color, game_log)
+    save_game_log(experiment_name, cycle_number, opponent_player, color, game_log, game_index=game_index)
 
 def generate_cycle_summaries(experiment_name, num_cycles):
     for cycle_number in range(num_cycles):
         generate_cycle_summary(experiment_name, cycle_number)
 
+# Make sure the results store has all the game logs for the first num_cycles cycles
+def get_synced_results_store(experiment_name, num_cycles):
+    results_store = get_results_store(experiment_name)
+    for cycle_number in range(num_cycles):
+        results_store.sync_cycle(cycle_number)
+    return results_store
+
 def analyze_experiment_results(experiment_name, num_cycles):
-    experiment_dir = get_experiment_dir(experiment_name)
+    results_store = get_synced_results_store(experiment_name, num_cycles)
         
     error_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {'correct': 0, 'incorrect': 0})))
     summary_scores = defaultdict(lambda: defaultdict(lambda: {'X': 0, 'O': 0, 'total': 0}))
-    experiment_cost = 0.0
 
-    for cycle_number in range(num_cycles):
-        cycle_dir = os.path.join(experiment_dir, f'cycle_{cycle_number}')
-        log_files = [os.path.join(cycle_dir, f) for f in os.listdir(cycle_dir) if f.startswith('game_log') and f.endswith('.json')]
-        for log_file in log_files:
-            with open(log_file, 'r') as f:
-                game_log = json.load(f)
-                metadata = game_log[0]
-                player_x = metadata['X']
-                player_o = metadata['O']
-
-                if 'score' in game_log[-1]:
-                    for player, score in game_log[-1]['score'].items():
-                        if game_log[0]['X'] == player:
-                            summary_scores[cycle_number][player]['X'] += score
-                        if game_log[0]['O'] == player:
-                            summary_scores[cycle_number][player]['O'] += score
-                        summary_scores[cycle_number][player]['total'] += score
-                    experiment_cost += game_log[-1]['total_cost']
-                
-                for entry in game_log[1:]:
-                    if 'board' in entry and 'move' in entry and 'player' in entry and 'correct_moves' in entry:
-                        board = entry['board']
-                        move = entry['move']
-                        correct_moves = entry['correct_moves']
-                        player = entry['player']
-                        current_player = player_x if player == 'X' else player_o
-                        threats_and_opportunities = immediate_threats_and_opportunities(board, player)
-
-                        if move in correct_moves:
-                            # If one of the conditions below are fulfilled, and we made a generally correct move,
-                            # count it as a success even if it wasn't specifically one of the moved given for the condition.
-                            # E.g. we could have an own_winning_move but play a threat before taking the win.
-                            error_counts[cycle_number][current_player]['overall_correctness']['correct'] += 1
-                            if threats_and_opportunities['winning_moves']:
-                                error_counts[cycle_number][current_player]['own_winning_move']['correct'] += 1
-                            # If there is more than one opponent threat we have a lost position, so there are no correct moves.
-                            if len(threats_and_opportunities['opponent_threats']) == 1:
-                                error_counts[cycle_number][current_player]['opponent_threat']['correct'] += 1
-                            if threats_and_opportunities['double_threat']:
-                                error_counts[cycle_number][current_player]['double_threat']['correct'] += 1
-                            if threats_and_opportunities['double_threat_follow_up_to_single_threat']:
-                                error_counts[cycle_number][current_player]['double_threat_follow_up']['correct'] += 1
-                        else:
-                            error_counts[cycle_number][current_player]['overall_correctness']['incorrect'] += 1
-                            if threats_and_opportunities['winning_moves']:
-                                error_counts[cycle_number][current_player]['own_winning_move']['incorrect'] += 1
-                            # If there is more than one opponent threat we have a lost position, so there are no correct moves.
-                            if len(threats_and_opportunities['opponent_threats']) == 1:
-                                error_counts[cycle_number][current_player]['opponent_threat']['incorrect'] += 1
-                            if threats_and_opportunities['double_threat']:
-                                error_counts[cycle_number][current_player]['double_threat']['incorrect'] += 1
-                            if threats_and_opportunities['double_threat_follow_up_to_single_threat']:
-                                error_counts[cycle_number][current_player]['double_threat_follow_up']['incorrect'] += 1
+    for metric in metric_columns:
+        for cycle_number, player_name, n_correct, n_incorrect in results_store.metric_counts(0, num_cycles - 1, metric):
+            error_counts[cycle_number][player_name][metric] = {'correct': n_correct, 'incorrect': n_incorrect}
+
+    for cycle_number, player_name, x_score, o_score in results_store.scores(0, num_cycles - 1):
+        summary_scores[cycle_number][player_name] = {'X': x_score, 'O': o_score, 'total': x_score + o_score}
+
+    experiment_cost = results_store.total_cost(0, num_cycles - 1)
 
     return error_counts, summary_scores, experiment_cost
 
-def plot_cycle_summaries(cycle_summaries, player_name, metric='overall_correctness', window_size=10):
-    if not metric in ( 'overall_correctness', 'own_winning_move', 'opponent_threat', 'double_threat', 'double_threat_follow_up'):
+# Arrays ( cycles, n_correct, n_incorrect ) for the moves by player_name relevant to the metric, read from the results store.
+# Cycles where the player made no relevant moves have zero counts.
+def metric_counts_by_cycle(experiment_name, num_cycles, player_name, metric='overall_correctness'):
+    results_store = get_synced_results_store(experiment_name, num_cycles)
+    counts = np.zeros(( num_cycles, 2 ))
+    rows = results_store.metric_counts(0, num_cycles - 1, metric, player_name=player_name)
+    if rows:
+        row_array = np.array([ ( cycle_number, n_correct, n_incorrect ) for cycle_number, _player_name, n_correct, n_incorrect in rows ])
+        counts[row_array[:, 0].astype(int)] = row_array[:, 1:]
+    return np.arange(num_cycles), counts[:, 0], counts[:, 1]
+
+# The same arrays, for summaries in the format returned by analyze_experiment_results
+def cycle_summaries_to_metric_counts(cycle_summaries, player_name, metric):
+    cycles = np.array(sorted(cycle_summaries.keys()), dtype=int)
+    counts = np.zeros(( len(cycles), 2 ))
+    for index, cycle_number in enumerate(cycles):
+        summary = cycle_summaries[cycle_number]
+        if player_name in summary and metric in summary[player_name]:
+            counts[index] = ( summary[player_name][metric]['correct'], summary[player_name][metric]['incorrect'] )
+    return cycles, counts[:, 0], counts[:, 1]
+
+def check_metric(metric):
+    if not metric in metric_columns:
         raise ValueError(f'Unknown metric {metric}')
-    
-    cycles = []
-    overall_correct = []
-    overall_incorrect = []
-    
-    for cycle_number, summary in cycle_summaries.items():
-        if player_name in summary:
-            cycles.append(cycle_number)
-            overall_correct.append(summary[player_name][metric]['correct'] if metric in summary[player_name] else 0)
-            overall_incorrect.append(summary[player_name][metric]['incorrect'] if metric in summary[player_name] else 0)
-        else:
-            overall_correct.append(0)
-            overall_incorrect.append(0)
-    
-    total_moves = [c + i for c, i in zip(overall_correct, overall_incorrect)]
-    accuracy = [c / t if t > 0 else 0 for c, t in zip(overall_correct, total_moves)]
+
+def plot_cycle_summaries(cycle_summaries, player_name, metric='overall_correctness', window_size=10):
+    check_metric(metric)
+    cycles, n_correct, n_incorrect = cycle_summaries_to_metric_counts(cycle_summaries, player_name, metric)
+    plot_smoothed_accuracy(cycles, n_correct, n_incorrect, metric, window_size)
+
+def plot_experiment_metric(experiment_name, num_cycles, player_name, metric='overall_correctness', window_size=10):
+    check_metric(metric)
+    cycles, n_correct, n_incorrect = metric_counts_by_cycle(experiment_name, num_cycles, player_name, metric=metric)
+    plot_smoothed_accuracy(cycles, n_correct, n_incorrect, metric, window_size)
+
+def plot_smoothed_accuracy(cycles, n_correct, n_incorrect, metric, window_size):
+    accuracy = accuracy_array(n_correct, n_incorrect)
     
     # Compute moving average
     accuracy_smoothed = np.convolve(accuracy, np.ones(window_size)/window_size, mode='valid')
@@ -227,38 +247,41 @@ def plot_cycle_summaries(cycle_summaries, player_name, metric='overall_correctne
     plt.legend()
     plt.show()
 
+# Proportion of correct moves, with 0 for cycles with no moves
+def accuracy_array(n_correct, n_incorrect):
+    total_moves = n_correct + n_incorrect
+    return np.divide(n_correct, total_moves, out=np.zeros(len(total_moves)), where=total_moves > 0)
+
 def compare_performance(cycle_summaries, player_name, start1, end1, start2, end2, metric='overall_correctness'):
-    if not metric in ( 'overall_correctness', 'own_winning_move', 'opponent_threat', 'double_threat', 'double_threat_follow_up'):
-        raise ValueError(f'Unknown metric {metric}')
-    
-    scores1 = [summary[player_name][metric]['correct'] / (summary[player_name][metric]['correct'] + summary[player_name][metric]['incorrect'])
-               for cycle_number, summary in cycle_summaries.items() if start1 <= cycle_number <= end1]
-    scores2 = [summary[player_name][metric]['correct'] / (summary[player_name][metric]['correct'] + summary[player_name][metric]['incorrect'])
-               for cycle_number, summary in cycle_summaries.items() if start2 <= cycle_number <= end2]
+    check_metric(metric)
+    cycles, n_correct, n_incorrect = cycle_summaries_to_metric_counts(cycle_summaries, player_name, metric)
+    return compare_accuracy_in_cycle_ranges(cycles, n_correct, n_incorrect, start1, end1, start2, end2)
+
+def compare_experiment_performance(experiment_name, player_name, start1, end1, start2, end2, metric='overall_correctness'):
+    check_metric(metric)
+    cycles, n_correct, n_incorrect = metric_counts_by_cycle(experiment_name, max(end1, end2) + 1, player_name, metric=metric)
+    return compare_accuracy_in_cycle_ranges(cycles, n_correct, n_incorrect, start1, end1, start2, end2)
+
+# t-test on the per-cycle accuracies in the two ranges of cycles. Cycles with no relevant moves are left out.
+def compare_accuracy_in_cycle_ranges(cycles, n_correct, n_incorrect, start1, end1, start2, end2):
+    has_moves = n_correct + n_incorrect > 0
+    accuracy = accuracy_array(n_correct, n_incorrect)
+    scores1 = accuracy[has_moves & ( cycles >= start1 ) & ( cycles <= end1 )]
+    scores2 = accuracy[has_moves & ( cycles >= start2 ) & ( cycles <= end2 )]
     
     t_stat, p_value = ttest_ind(scores1, scores2)
     return t_stat, p_value
 
 def plot_cycle_summaries_for_scores(summary_scores, player_name, window_size=10):
-    cycles = []
-    overall_correct = []
-    overall_incorrect = []
-    
-    for cycle_number, summary in summary_scores.items():
-        if player_name in summary:
-            cycles.append(cycle_number)
-            overall_correct.append(summary[player_name]['total'])
-        else:
-            overall_correct.append(0)
-    
-    total_scores = overall_correct
-    accuracy = [score for score in total_scores]
+    cycles = np.array(sorted(summary_scores.keys()), dtype=int)
+    total_scores = np.array([ summary_scores[cycle_number][player_name]['total'] if player_name in summary_scores[cycle_number] else 0
+                              for cycle_number in cycles ], dtype=float)
     
     # Compute moving average
-    accuracy_smoothed = np.convolve(accuracy, np.ones(window_size)/window_size, mode='valid')
-    cycles_smoothed = cycles[:len(accuracy_smoothed)]
+    scores_smoothed = np.convolve(total_scores, np.ones(window_size)/window_size, mode='valid')
+    cycles_smoothed = cycles[:len(scores_smoothed)]
     
-    plt.plot(cycles_smoothed, accuracy_smoothed, label=f"{player_name} Cycle Score (Smoothed)")
+    plt.plot(cycles_smoothed, scores_smoothed, label=f"{player_name} Cycle Score (Smoothed)")
     plt.xlabel('Cycle Number')
     plt.ylabel('Total Score')
     plt.title(f'Total Score for {player_name} Over Cycles (Smoothed)')
@@ -279,8 +302,7 @@ def compare_performance_for_scores(summary_scores, player_name, start1, end1, st
 
 def correct_all_game_logs(experiment_name, num_cycles):
     for cycle_number in range(num_cycles):
-        for opponent in ['random_player', 'minimal_gpt4_player', 'cot_player_without_few_shot',
-                         'cot_player_without_few_shot_explicit', 'minimax_player']:
+        for opponent in experiment_opponents:
             correct_game_log_file(experiment_name, cycle_number, opponent, 'X')
             correct_game_log_file(experiment_name, cycle_number, opponent, 'O')
 
@@ -0,0 +1,97 @@
+"""
+Selection of few-shot examples from a pool of CoT records.
+
+The pool for a cycle can be large, especially with the 'closest_few_shot_example_incremental' strategy where it grows
+every cycle, and the closest example is looked up on every move of every game. The closest example is the first one
+with the smallest relevance score, which counts one for a different player, one for a different centre square value,
+and the difference in turn. FewShotExampleIndex precomputes these features for each record. Records with the same
+features have the same score, so the index only needs to keep the first record for each combination of features.
+There are at most 2 * 9 * 3 of these, so a lookup takes constant time however large the pool is, and returns the
+same record as scoring the whole pool.
+
+The index also keys records on the board up to symmetry. If the pool contains the position being played,
+or a rotation or reflection of it, that record is preferred over others which only have the same features.
+
+select_diverse_entries keeps a running total of the distance from each candidate to the examples selected so far,
+so each step costs O(N) instead of rescoring every candidate against every selected example.
+"""
+
+from .tictactoe_engine import get_turn_value, get_center_square_value, canonical_board_str
+
+import random
+
+class FewShotExampleIndex:
+    def __init__(self, cot_records):
+        self.cot_records = cot_records
+        # ( player, turn, centre square value ) -> position in cot_records of the first record with those features
+        self._first_with_features = {}
+        # ( player, canonical board ) -> position in cot_records of the first record for the position up to symmetry
+        self._first_with_position = {}
+        for position, record in enumerate(cot_records):
+            self._first_with_features.setdefault(relevance_features(record['board'], record['player']), position)
+            self._first_with_position.setdefault(( record['player'], canonical_board_str(record['board']) ), position)
+
+    # Return the most relevant record for the position, or None if the pool is empty
+    def most_relevant(self, board, player):
+        if not self.cot_records:
+            return None
+        position = self._first_with_position.get(( player, canonical_board_str(board) ), None)
+        if position is None:
+            features = relevance_features(board, player)
+            _best_features, position = min(self._first_with_features.items(),
+                                           key=lambda item: ( relevance_features_distance(item[0], features), item[1] ))
+        return self.cot_records[position]
+
+def relevance_features(board, player):
+    return ( player, get_turn_value(board), get_center_square_value(board) )
+
+# Relevance score of records with features1 for a position with features2
+def relevance_features_distance(features1, features2):
+    player1, turn1, center1 = features1
+    player2, turn2, center2 = features2
+    return ( 0 if player1 == player2 else 1 ) + abs(turn1 - turn2) + ( 0 if center1 == center2 else 1 )
+
+# -----------------------------------------
+
+# Start with a random candidate, then repeatedly add the one with the largest total diversity_features_distance
+# to the candidates already selected. Ties go to the earliest candidate, and candidates equal to one already selected are skipped.
+def select_diverse_entries(candidates, N):
+    if not candidates:
+        return []
+
+    features = [ diversity_features(entry) for entry in candidates ]
+    available = [ True ] * len(candidates)
+    distance_totals = [ 0 ] * len(candidates)
+
+    selected = []
+    position = random.randrange(len(candidates))
+    while True:
+        chosen, chosen_features = candidates[position], features[position]
+        selected.append(chosen)
+        if len(selected) >= N:
+            break
+        best_position = None
+        for index in range(len(candidates)):
+            if not available[index]:
+                continue
+            if features[index] == chosen_features and candidates[index] == chosen:
+                available[index] = False
+                continue
+            distance_totals[index] += diversity_features_distance(features[index], chosen_features)
+            if best_position is None or distance_totals[index] > distance_totals[best_position]:
+                best_position = index
+        if best_position is None:
+            break
+        position = best_position
+
+    return selected
+
+def diversity_features(entry):
+    return ( entry['turn'],
+             0 if entry['player'] == 'X' else 1,
+             entry['player_relative_evaluation'],
+             len(entry['correct_moves']) / len(entry['legal_moves']) )
+
+# Sum of the differences in turn, player, player-relative evaluation and proportion of correct moves
+def diversity_features_distance(features1, features2):
+    return sum(abs(value1 - value2) for value1, value2 in zip(features1, features2))
@@ -14,37 +14,40 @@ known_players = ( 'random_player', 'human_player', 'minimax_player', 'minimal_gp
                   'cot_player_without_few_shot', 'cot_player_without_few_shot_explicit',
                   'cot_player_with_few_shot' )
 
+# Players return ( move, cot_record, prompt, cost, llm_cache_hit ).
+# llm_cache_hit is None unless the move came from an LLM request with the move cache switched on.
+
 def random_player(board, player, callback=None):
     moves = get_available_moves(board)
-    return random.choice(moves), None, None, 0
+    return random.choice(moves), None, None, 0, None
 
 def human_player(board, player, callback=None):
     draw_board(board)
     move = input(f"Player {player}, enter your move (e.g., a1, b2): ")
-    return algebraic_to_index(move), None, None, 0
+    return algebraic_to_index(move), None, None, 0, None
 
 def minimax_player(board, player, callback=None):
     _, best_move = minimax(board, player, 0)
-    return best_move, None, None, 0
+    return best_move, None, None, 0, None
 
 async def minimal_gpt4_player_async(board, player):
     response = await request_minimal_gpt4_move_async(board, player)
     total_cost = sum(call.cost for call in response['api_calls'])
-    return algebraic_to_index(response['selected_move']), None, response['prompt'], total_cost
+    return algebraic_to_index(response['selected_move']), None, response['prompt'], total_cost, response.get('cached', None)
 
 async def cot_player_without_few_shot_async(board, player):
     few_shot_examples = []
     cot_template_name = 'minimal'
     response = await request_cot_analysis_and_move_async(board, player, cot_template_name, few_shot_examples)
     total_cost = sum(call.cost for call in response['api_calls'])
-    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost
+    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost, response.get('cached', None)
 
 async def cot_player_without_few_shot_explicit_async(board, player):
     few_shot_examples = []
     cot_template_name = 'explicit'
     response = await request_cot_analysis_and_move_async(board, player, cot_template_name, few_shot_examples)
     total_cost = sum(call.cost for call in response['api_calls'])
-    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost
+    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost, response.get('cached', None)
 
 async def cot_player_with_few_shot_async(board, player, experiment_name, cycle_number):
     few_shot_examples, evaluation_cost = await get_best_few_shot_examples_async(experiment_name, cycle_number, board, player)
@@ -55,7 +58,7 @@ async def cot_player_with_few_shot_async(board, player, experiment_name, cycle_n
     else:
         response = await request_cot_analysis_and_move_async(board, player, cot_template_name, few_shot_examples)
     total_cost = sum(call.cost for call in response['api_calls']) + evaluation_cost
-    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost
+    return algebraic_to_index(response['selected_move']), response['cot_record'], response['prompt'], total_cost, response.get('cached', None)
 
 async def invoke_player_async(player_name, board, x_or_o, experiment_name, cycle_number):
     complain_if_unknown_player(player_name)
@@ -109,7 +112,7 @@ async def play_game_async(player1, player2, experiment_name, cycle_number):
         current_player = players[turn % 2]
         x_or_o = player_symbols[turn % 2]
         board_before_move = board.copy()
-        move, cot_record, prompt, cost = await invoke_player_async(current_player, board, x_or_o, experiment_name, cycle_number)
+        move, cot_record, prompt, cost, llm_cache_hit = await invoke_player_async(current_player, board, x_or_o, experiment_name, cycle_number)
         total_cost += cost
 
         log.append({
@@ -119,7 +122,8 @@ async def play_game_async(player1, player2, experiment_name, cycle_number):
             'prompt': prompt,
             'move': index_to_algebraic(move),
             'cot_record': cot_record,
-            'cost': cost
+            'cost': cost,
+            'llm_cache_hit': llm_cache_hit
         })
 
         board[move] = x_or_o
@@ -1,26 +1,46 @@
 from .tictactoe_engine import get_opponent, algebraic_to_index, index_to_algebraic, get_available_moves
-from .clara_chatgpt4 import get_api_chatgpt4_response, interpret_chat_gpt4_response_as_json
-from .clara_utils import post_task_update, post_task_update_async
+from .tictactoe_engine import canonical_board_and_symmetry, move_to_symmetric_move, symmetric_move_to_move
+from .tictactoe_jsonl_cache import JSONLCache, hash_for_cache_key
+from .clara_chatgpt4 import get_api_chatgpt4_response, acquire_openai_api_token, interpret_chat_gpt4_response_as_json, AsyncRateLimiter
+from .clara_utils import post_task_update, post_task_update_async, get_config
 from .clara_classes import ChatGPTError
 
 import asyncio
 from collections import defaultdict
+import re
 import traceback
 
+config = get_config()
+
 max_number_of_gpt4_tries = 5
 
+default_move_gpt_model = 'gpt-3.5-turbo' # change gpt model
+
+# Global limit on the LLM calls made by concurrently running games
+llm_rate_limiter = AsyncRateLimiter(int(config.get('tictactoe_experiments', 'max_concurrent_llm_calls')),
+                                    float(config.get('tictactoe_experiments', 'max_llm_calls_per_minute')))
+
 async def request_minimal_gpt4_move_async(board, player, callback=None):
     formatted_request = format_minimal_gpt4_request(board, player)
     available_moves = [index_to_algebraic(move) for move in get_available_moves(board)]
-    return await call_gpt4_with_retry_async(formatted_request, available_moves, callback=callback)
+    request_key = { 'request_type': 'minimal', 'template': minimal_template }
+    return await cached_llm_move_request_async(board, player, request_key, formatted_request,
+                                               lambda: call_gpt4_with_retry_async(formatted_request, available_moves, callback=callback))
 
 async def request_cot_analysis_and_move_async(board, player, cot_template_name, few_shot_examples, callback=None):
     formatted_request = format_cot_request(board, player, cot_template_name, few_shot_examples)
     available_moves = [index_to_algebraic(move) for move in get_available_moves(board)]
-    return await call_gpt4_with_retry_async(formatted_request, available_moves, callback=callback)
+    request_key = cot_request_cache_key('cot', cot_template_name, few_shot_examples)
+    return await cached_llm_move_request_async(board, player, request_key, formatted_request,
+                                               lambda: call_gpt4_with_retry_async(formatted_request, available_moves, callback=callback))
 
 async def request_cot_analysis_and_move_with_voting_async(board, player, cot_template_name, few_shot_examples, callback=None):
     formatted_request = format_cot_request(board, player, cot_template_name, few_shot_examples)
+    request_key = cot_request_cache_key('cot_with_voting', cot_template_name, few_shot_examples)
+    return await cached_llm_move_request_async(board, player, request_key, formatted_request,
+                                               lambda: request_cot_analysis_and_move_with_voting_uncached_async(board, formatted_request, callback=callback))
+
+async def request_cot_analysis_and_move_with_voting_uncached_async(board, formatted_request, callback=None):
     available_moves = [index_to_algebraic(move) for move in get_available_moves(board)]
 
     move_counts = defaultdict(int)
@@ -51,7 +71,80 @@ async def request_cot_analysis_and_move_with_voting_async(board, player, cot_tem
         if move_counts[move] == 2:
             return {'selected_move': move, 'cot_record': cot_records[move], 'prompt': formatted_request, 'api_calls': api_calls}
 
-async def call_gpt4_with_retry_async(formatted_request, available_moves, gpt_model='gpt-3.5-turbo', callback=None): # change gpt model
+# -----------------------------------------
+
+# Optional cache for LLM move requests.
+#
+# The same positions, up to the 8 board symmetries, come up again and again across games and cycles.
+# For deterministic or evaluation runs we can reuse the response instead of sending a new request.
+# Responses are keyed on the canonical board under symmetry, the player, the kind of request, the template,
+# the few-shot examples and the model. They are stored in canonical orientation, and the selected move and
+# the squares mentioned in the CoT record are mapped back through the symmetry when a cached response is used.
+#
+# Responses returned when the cache is enabled have a 'cached' field saying whether they came from the cache.
+# The cache should be switched off for experiments that depend on sampling diversity.
+
+_llm_move_cache_enabled = config.getboolean('tictactoe_experiments', 'llm_move_cache_enabled')
+_llm_move_cache = None
+
+def set_llm_move_cache_enabled(enabled):
+    global _llm_move_cache_enabled
+    _llm_move_cache_enabled = enabled
+
+def llm_move_cache_enabled():
+    return _llm_move_cache_enabled
+
+def get_llm_move_cache():
+    global _llm_move_cache
+    if _llm_move_cache is None:
+        _llm_move_cache = JSONLCache(config.get('tictactoe_experiments', 'llm_move_cache'))
+    return _llm_move_cache
+
+def cot_request_cache_key(request_type, cot_template_name, few_shot_examples):
+    return { 'request_type': request_type,
+             'template': cot_template_explicit if cot_template_name == 'explicit' else cot_template,
+             'few_shot_examples': hash_for_cache_key(format_examples_for_cot(few_shot_examples)) }
+
+async def cached_llm_move_request_async(board, player, request_key, formatted_request, request_function):
+    if not llm_move_cache_enabled():
+        return await request_function()
+
+    canonical_board, symmetry = canonical_board_and_symmetry(board)
+    key = hash_for_cache_key(dict(request_key, board=canonical_board, player=player, gpt_model=default_move_gpt_model))
+    cache = get_llm_move_cache()
+    cached_response = cache.get(key)
+    if cached_response:
+        return { 'selected_move': map_squares_from_canonical(cached_response['selected_move'], symmetry),
+                 'cot_record': map_squares_from_canonical(cached_response['cot_record'], symmetry),
+                 'prompt': formatted_request,
+                 'api_calls': [],
+                 'cached': True }
+
+    response = await request_function()
+    # Don't cache failures
+    if response['selected_move'] is not None:
+        cache.put(key, { 'selected_move': map_squares_to_canonical(response['selected_move'], symmetry),
+                         'cot_record': map_squares_to_canonical(response['cot_record'], symmetry) })
+    response['cached'] = False
+    return response
+
+_algebraic_square_regex = re.compile(r'\b[a-c][1-3]\b')
+
+# Rewrite the squares in text about the original board to refer to the canonical board
+def map_squares_to_canonical(text, symmetry):
+    if text is None:
+        return None
+    return _algebraic_square_regex.sub(lambda m: index_to_algebraic(move_to_symmetric_move(algebraic_to_index(m.group(0)), symmetry)), text)
+
+# Rewrite the squares in text about the canonical board to refer to the original board
+def map_squares_from_canonical(text, symmetry):
+    if text is None:
+        return None
+    return _algebraic_square_regex.sub(lambda m: index_to_algebraic(symmetric_move_to_move(algebraic_to_index(m.group(0)), symmetry)), text)
+
+# -----------------------------------------
+
+async def call_gpt4_with_retry_async(formatted_request, available_moves, gpt_model=default_move_gpt_model, callback=None):
     api_calls = []
     n_attempts = 0
     limit = max_number_of_gpt4_tries
@@ -62,7 +155,10 @@ async def call_gpt4_with_retry_async(formatted_request, available_moves, gpt_mod
         n_attempts += 1
         await post_task_update_async(callback, f'--- Calling {gpt_model} (attempt #{n_attempts})')
         try:
-            api_call = await get_api_chatgpt4_response(formatted_request, config_info={'gpt_model': gpt_model}, callback=callback)
+            # Wait for the API rate limit before taking a slot, so that waiting calls don't hold slots
+            config_info = await acquire_openai_api_token({'gpt_model': gpt_model, 'api_priority': 'bulk'})
+            async with llm_rate_limiter:
+                api_call = await get_api_chatgpt4_response(formatted_request, config_info=config_info, callback=callback)
             api_calls.append(api_call)
             response_string = api_call.response
             move_info = interpret_chat_gpt4_response_as_json(api_call.response, object_type='dict')
@@ -87,7 +183,10 @@ async def call_gpt4_with_retry_for_cot_evaluation_async(formatted_request, gpt_m
         n_attempts += 1
         await post_task_update_async(callback, f'--- Calling {gpt_model} (attempt #{n_attempts})')
         try:
-            api_call = await get_api_chatgpt4_response(formatted_request, config_info={'gpt_model': gpt_model}, callback=callback)
+            # Wait for the API rate limit before taking a slot, so that waiting calls don't hold slots
+            config_info = await acquire_openai_api_token({'gpt_model': gpt_model, 'api_priority': 'bulk'})
+            async with llm_rate_limiter:
+                api_call = await get_api_chatgpt4_response(formatted_request, config_info=config_info, callback=callback)
             api_calls.append(api_call)
             response_string = api_call.response
             evaluation = interpret_chat_gpt4_response_as_json(api_call.response, object_type='dict')
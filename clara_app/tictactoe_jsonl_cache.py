@@ -0,0 +1,57 @@
+"""
+Persistent key-value cache for the tic-tac-toe experiments, used for LLM responses that are expensive to recompute.
+
+The cache is an append-only JSONL file, one { "key": ..., "value": ... } record per line, so that concurrently
+running games can add to it cheaply. The whole file is read into memory the first time the cache is used.
+If a key occurs more than once, the last record wins. Files written by the original CoTEvaluationCache,
+whose records are { "key": ..., "evaluation": ... }, are read as well.
+"""
+
+from .clara_utils import absolute_file_name
+
+import hashlib
+import json
+import os
+import threading
+
+class JSONLCache:
+    def __init__(self, path):
+        self.path = absolute_file_name(path)
+        self._lock = threading.Lock()
+        self._entries = None
+        self._needs_newline = False
+
+    def get(self, key):
+        self._load_if_necessary()
+        return self._entries.get(key, None)
+
+    def put(self, key, value):
+        with self._lock:
+            self._load_if_necessary()
+            self._entries[key] = value
+            with open(self.path, 'a', encoding='utf-8') as f:
+                if self._needs_newline:
+                    f.write('\n')
+                    self._needs_newline = False
+                f.write(json.dumps({ 'key': key, 'value': value }) + '\n')
+
+    def _load_if_necessary(self):
+        if self._entries is not None:
+            return
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            for line in text.split('\n'):
+                # A crash can leave a partial last line, which we just ignore, as we do any other malformed line
+                try:
+                    item = json.loads(line)
+                    entries[item['key']] = item['value'] if 'value' in item else item['evaluation']
+                except ( ValueError, KeyError, TypeError ):
+                    pass
+            self._needs_newline = text != '' and not text.endswith('\n')
+        self._entries = entries
+
+# Hash a JSON-serialisable structure, to use as a cache key
+def hash_for_cache_key(key_material):
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode('utf-8')).hexdigest()
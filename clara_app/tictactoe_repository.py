@@ -1,5 +1,7 @@
-from .tictactoe_evaluate_cot import evaluate_cot_record_async
-from .tictactoe_engine import minimax, get_available_moves, apply_move, get_opponent, get_turn_value, get_center_square_value
+from .tictactoe_evaluate_cot import evaluate_cot_record_async, get_cot_evaluation_cache
+from .tictactoe_results_store import ExperimentResultsStore
+from .tictactoe_few_shot_index import FewShotExampleIndex, select_diverse_entries
+from .tictactoe_engine import minimax, get_correct_moves, get_available_moves, apply_move, get_opponent, get_turn_value, get_center_square_value
 from .tictactoe_engine import index_to_algebraic, algebraic_to_index, drawn_board_str, check_win, check_draw
 from .clara_utils import absolute_file_name, file_exists, directory_exists
 
@@ -9,24 +11,31 @@ from datetime import datetime
 import random
 from collections import defaultdict
 import asyncio
+import tempfile
 
 supported_strategies = ( 'n_maximally_different', 'closest_few_shot_example',
                          'closest_few_shot_example_explicit', 'closest_few_shot_example_explicit_with_voting',
                          'closest_few_shot_example_incremental' )
 
+# If the experiment already exists, we keep its metadata so that it can be resumed
 def create_experiment_dir(experiment_name, strategy='n_maximally_different', base_dir='$CLARA/tictactoe_experiments'):
     if not strategy in supported_strategies:
         raise ValueError(f'Unknown strategy {strategy}. Needs to be one of: {supported_strategies}')
     experiment_dir = get_experiment_dir(experiment_name, base_dir=base_dir)
     os.makedirs(experiment_dir, exist_ok=True)
+    metadata_path = os.path.join(experiment_dir, 'metadata.json')
+    if os.path.exists(metadata_path):
+        existing_strategy = get_experiment_strategy(experiment_name)
+        if existing_strategy != strategy:
+            raise ValueError(f'Experiment {experiment_name} already exists with strategy {existing_strategy}, not {strategy}')
+        return
     metadata = {
         'experiment_name': experiment_name,
         'start_date': datetime.now().isoformat(),
         'strategy': strategy,
         'cycles': []
     }
-    with open(os.path.join(experiment_dir, 'metadata.json'), 'w') as f:
-        json.dump(metadata, f, indent=4)
+    write_json_file_atomically(metadata, metadata_path)
     
 def get_experiment_dir(experiment_name, base_dir='$CLARA/tictactoe_experiments'):
     abs_base_dir = absolute_file_name(base_dir)
@@ -35,6 +44,14 @@ def get_experiment_dir(experiment_name, base_dir='$CLARA/tictactoe_experiments')
     experiment_dir = os.path.join(abs_base_dir, experiment_name)
     return experiment_dir
 
+_results_stores = {}
+
+def get_results_store(experiment_name):
+    experiment_dir = get_experiment_dir(experiment_name)
+    if not experiment_dir in _results_stores:
+        _results_stores[experiment_dir] = ExperimentResultsStore(experiment_dir)
+    return _results_stores[experiment_dir]
+
 def get_experiment_strategy(experiment_name):
     experiment_dir = get_experiment_dir(experiment_name)
     experiment_metadata_path = os.path.join(experiment_dir, 'metadata.json')
@@ -46,6 +63,7 @@ def cot_template_name_for_experiment_name(experiment_name):
     strategy = get_experiment_strategy(experiment_name)
     return 'explicit' if strategy in ( 'closest_few_shot_example_explicit', 'closest_few_shot_example_explicit_with_voting' ) else 'minimal'
 
+# If the cycle already exists, e.g. because we're resuming it after a crash, we leave the metadata alone
 def create_cycle_dir(experiment_name, cycle_number):
     experiment_dir = get_experiment_dir(experiment_name)
     cycle_dir = get_cycle_dir(experiment_name, cycle_number)
@@ -54,17 +72,36 @@ def create_cycle_dir(experiment_name, cycle_number):
     experiment_metadata_path = os.path.join(experiment_dir, 'metadata.json')
     with open(experiment_metadata_path, 'r') as f:
         experiment_metadata = json.load(f)
-    experiment_metadata['cycles'].append(cycle_number)
-    with open(experiment_metadata_path, 'w') as f:
-        json.dump(experiment_metadata, f, indent=4)
-
-    cycle_metadata_path = os.path.join(cycle_dir, 'metadata.json')                             
-    cycle_metadata = {
-        'cycle_number': cycle_number,
-        'start_date': datetime.now().isoformat()
-    }
-    with open(cycle_metadata_path, 'w') as f:
-        json.dump(cycle_metadata, f, indent=4)
+    if not cycle_number in experiment_metadata['cycles']:
+        experiment_metadata['cycles'].append(cycle_number)
+        write_json_file_atomically(experiment_metadata, experiment_metadata_path)
+
+    cycle_metadata_path = os.path.join(cycle_dir, 'metadata.json')
+    if not os.path.exists(cycle_metadata_path):
+        cycle_metadata = {
+            'cycle_number': cycle_number,
+            'start_date': datetime.now().isoformat()
+        }
+        write_json_file_atomically(cycle_metadata, cycle_metadata_path)
+
+def get_cycle_metadata(experiment_name, cycle_number):
+    cycle_metadata_path = os.path.join(get_cycle_dir(experiment_name, cycle_number), 'metadata.json')
+    if not os.path.exists(cycle_metadata_path):
+        return None
+    with open(cycle_metadata_path, 'r') as f:
+        return json.load(f)
+
+# A cycle is complete when all its games have been played and the summary has been produced
+def is_cycle_complete(experiment_name, cycle_number):
+    cycle_metadata = get_cycle_metadata(experiment_name, cycle_number)
+    return cycle_metadata is not None and 'end_date' in cycle_metadata
+
+def mark_cycle_complete(experiment_name, cycle_number, n_games):
+    cycle_metadata_path = os.path.join(get_cycle_dir(experiment_name, cycle_number), 'metadata.json')
+    cycle_metadata = get_cycle_metadata(experiment_name, cycle_number)
+    cycle_metadata['end_date'] = datetime.now().isoformat()
+    cycle_metadata['n_games'] = n_games
+    write_json_file_atomically(cycle_metadata, cycle_metadata_path)
 
 def get_cycle_dir(experiment_name, cycle_number):
     experiment_dir = get_experiment_dir(experiment_name)
@@ -73,7 +110,17 @@ def get_cycle_dir(experiment_name, cycle_number):
     cycle_dir = os.path.join(experiment_dir, f'cycle_{cycle_number}')
     return cycle_dir
 
-def save_game_log(experiment_name, cycle_number, opponent_player, color, game_log):
+# The first game for each pairing keeps the original file name, so that existing experiments can still be read
+def game_log_path(experiment_name, cycle_number, opponent_player, color, game_index=0, extension='json'):
+    cycle_dir = get_cycle_dir(experiment_name, cycle_number)
+    suffix = '' if game_index == 0 else f'_{game_index}'
+    return os.path.join(cycle_dir, f'game_log_{opponent_player}_{color}{suffix}.{extension}')
+
+# The JSON log is the checkpoint for a finished game: if it exists, the game doesn't need to be played again
+def game_log_exists(experiment_name, cycle_number, opponent_player, color, game_index=0):
+    return os.path.exists(game_log_path(experiment_name, cycle_number, opponent_player, color, game_index=game_index))
+
+def save_game_log(experiment_name, cycle_number, opponent_player, color, game_log, game_index=0):
     metadata_entry = { 'experiment': experiment_name,
                        'cycle_number': cycle_number,
                        'X': 'cot_player_with_few_shot' if color == 'X' else opponent_player,
@@ -81,17 +128,29 @@ def save_game_log(experiment_name, cycle_number, opponent_player, color, game_lo
     game_log = [ metadata_entry ] + game_log
         
     annotate_game_log(game_log)
-    cycle_dir = get_cycle_dir(experiment_name, cycle_number)
-    log_path = os.path.join(cycle_dir, f'game_log_{opponent_player}_{color}.json')
-    
-    with open(log_path, 'w') as f:
-        json.dump(game_log, f, indent=4)
 
+    # Write the human-readable version first, so that the JSON log only appears when everything is saved
     human_readable_log = game_log_to_human_readable_str(game_log)
-    human_readable_log_path = os.path.join(cycle_dir, f'game_log_{opponent_player}_{color}.txt')
+    human_readable_log_path = game_log_path(experiment_name, cycle_number, opponent_player, color, game_index=game_index, extension='txt')
     with open(human_readable_log_path, 'w', encoding='utf-8') as f:
         f.write(human_readable_log)
 
+    log_path = game_log_path(experiment_name, cycle_number, opponent_player, color, game_index=game_index)
+    write_json_file_atomically(game_log, log_path)
+    get_results_store(experiment_name).record_game(cycle_number, os.path.basename(log_path), game_log)
+
+# Write to a temporary file and rename it, so that a crash can't leave a truncated file behind
+def write_json_file_atomically(data, path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def correct_game_log_file(experiment_name, cycle_number, opponent_player, color):
     cycle_dir = get_cycle_dir(experiment_name, cycle_number)
     log_path = os.path.join(cycle_dir, f'game_log_{opponent_player}_{color}.json')
@@ -106,6 +165,7 @@ def correct_game_log_file(experiment_name, cycle_number, opponent_player, color)
     
     with open(log_path, 'w') as f:
         json.dump(game_log, f, indent=4)
+    get_results_store(experiment_name).record_game(cycle_number, os.path.basename(log_path), game_log)
     
     human_readable_log = game_log_to_human_readable_str(game_log)
     human_readable_log_path = os.path.join(cycle_dir, f'game_log_{opponent_player}_{color}.txt')
@@ -153,8 +213,7 @@ def annotate_game_log(game_log):
                 # In a lost position, there are no "correct" moves
                 correct_moves = []
             else:
-                correct_moves = [index_to_algebraic(move) for move in get_available_moves(board)
-                                 if minimax(apply_move(board, move, player), get_opponent(player), 0)[0] == evaluation]
+                correct_moves = [index_to_algebraic(move) for move in get_correct_moves(board, player)]
             entry.update({
                 'evaluation': evaluation,
                 'player_relative_evaluation': relative_evaluation,
@@ -182,17 +241,58 @@ def game_log_to_human_readable_str(game_log):
             out_str += '\n'
     return out_str
 
+# Games in a cycle run concurrently, and they all want the cycle's few-shot examples on their first move.
+# The lock makes sure only one of them evaluates the candidates; the others then read the cached examples.
+# asyncio locks are bound to an event loop, and each run of an experiment uses its own asyncio.run,
+# so the locks are recreated when the loop changes.
+_few_shot_example_locks = {}
+_few_shot_example_locks_loop = None
+
+# ( experiment_name, cycle_number ) -> ( signature of few_shot_examples.json, few-shot examples, FewShotExampleIndex for them ),
+# so that we don't reread and reindex the examples on every move. The entry is replaced if the file changes,
+# e.g. when an experiment directory is recreated and the examples are computed again.
+_few_shot_example_indexes = {}
+
+def few_shot_example_lock(experiment_name, cycle_number):
+    global _few_shot_example_locks, _few_shot_example_locks_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _few_shot_example_locks_loop:
+        _few_shot_example_locks = {}
+        _few_shot_example_locks_loop = loop
+    key = ( experiment_name, cycle_number )
+    if not key in _few_shot_example_locks:
+        _few_shot_example_locks[key] = asyncio.Lock()
+    return _few_shot_example_locks[key]
+
 async def get_best_few_shot_examples_async(experiment_name, cycle_number, board, player, N=5):
     strategy = get_experiment_strategy(experiment_name)
-    cycle_dir = get_cycle_dir(experiment_name, cycle_number)
-    cache_path = os.path.join(cycle_dir, 'few_shot_examples.json')
-    consistent_cot_records = None
-    total_evaluation_cost = 0
 
     if cycle_number == 0:
         # We have nothing to extract few-shot example from
         return [], 0
 
+    key = ( experiment_name, cycle_number )
+    total_evaluation_cost = 0
+    async with few_shot_example_lock(experiment_name, cycle_number):
+        signature = few_shot_examples_signature(experiment_name, cycle_number)
+        if signature is None or _few_shot_example_indexes.get(key, ( None, ))[0] != signature:
+            selected_entries, total_evaluation_cost = await get_cycle_few_shot_examples_async(experiment_name, cycle_number, strategy, N)
+            _few_shot_example_indexes[key] = ( few_shot_examples_signature(experiment_name, cycle_number),
+                                               selected_entries, FewShotExampleIndex(selected_entries) )
+    _signature, selected_entries, index = _few_shot_example_indexes[key]
+    
+    if strategy == 'n_maximally_different':
+        return selected_entries, total_evaluation_cost
+    elif strategy in ( 'closest_few_shot_example', 'closest_few_shot_example_explicit', 'closest_few_shot_example_incremental', 'closest_few_shot_example_explicit_with_voting' ):
+        return most_relevant_cot_entries_for_position(index, board, player), total_evaluation_cost
+
+# Return the few-shot examples for the cycle, computing and caching them if necessary, together with the cost of computing them
+async def get_cycle_few_shot_examples_async(experiment_name, cycle_number, strategy, N):
+    cycle_dir = get_cycle_dir(experiment_name, cycle_number)
+    cache_path = os.path.join(cycle_dir, 'few_shot_examples.json')
+    consistent_cot_records = None
+    total_evaluation_cost = 0
+
     if file_exists(cache_path):
         # We have examples cached
         with open(cache_path, 'r') as f:
@@ -211,8 +311,10 @@ async def get_best_few_shot_examples_async(experiment_name, cycle_number, board,
 
         print(f'Found {len(candidates)} candidate CoT records to use.')
 
-        evaluation_results = await asyncio.gather(*(evaluate_cot_record_async(candidate) for candidate in candidates))
-        total_evaluation_cost = sum(result['api_calls'][0].cost for result in evaluation_results)
+        cot_evaluation_cache = get_cot_evaluation_cache()
+        evaluation_results = await asyncio.gather(*(evaluate_cot_record_async(candidate, cache=cot_evaluation_cache) for candidate in candidates))
+        # Cached evaluations and failed ones may have no API calls
+        total_evaluation_cost = sum(call.cost for result in evaluation_results for call in result['api_calls'])
 
         consistent_cot_records = [ candidate for candidate in candidates
                                    if not ( 'logically_consistent' in candidate and not candidate['logically_consistent'] ) and
@@ -235,13 +337,10 @@ async def get_best_few_shot_examples_async(experiment_name, cycle_number, board,
             selected_entries = previous_entries + consistent_cot_records
         else:
             raise ValueError(f"Unknown strategy {strategy} in get_best_few_shot_examples_async. Must be one of {supported_strategies}")
-        cache_few_shot_examples(experiment_name, cycle_number, selected_entries)
         cache_inconsistent_few_shot_examples(experiment_name, cycle_number, inconsistent_cot_records)
-    
-    if strategy == 'n_maximally_different':
-        return selected_entries, total_evaluation_cost
-    elif strategy in ( 'closest_few_shot_example', 'closest_few_shot_example_explicit', 'closest_few_shot_example_incremental', 'closest_few_shot_example_explicit_with_voting' ):
-        return most_relevant_cot_entries_for_position(selected_entries, board, player), total_evaluation_cost
+        cache_few_shot_examples(experiment_name, cycle_number, selected_entries)
+
+    return selected_entries, total_evaluation_cost
 
 def select_usable_cot_protocol_entries_from_log(annotated_log):
     usable_entries = []
@@ -254,52 +353,25 @@ def select_usable_cot_protocol_entries_from_log(annotated_log):
             usable_entries.append(entry)
     return usable_entries
 
-def select_diverse_entries(candidates, N):
-    if not candidates:
-        return []
-
-    selected = [random.choice(candidates)]
-    while len(selected) < N:
-        remaining_candidates = [entry for entry in candidates if entry not in selected]
-        if not remaining_candidates:
-            break
-        best_candidate = max(remaining_candidates, key=lambda entry: combined_difference_score_for_diverse(entry, selected))
-        selected.append(best_candidate)
-
-    return selected
-
+# cot_records is either a list of records or a FewShotExampleIndex built from one
 def most_relevant_cot_entries_for_position(cot_records, board, player):
-    if not cot_records:
-        return []
-    else:
-        best_candidate = min(cot_records, key=lambda entry: relevance_score(entry, board, player))
-        return [ best_candidate ]
-
-def combined_difference_score_for_diverse(entry, selected):
-    return sum(difference_metric_for_diverse(entry, sel) for sel in selected)
-
-def difference_metric_for_diverse(entry1, entry2):
-    turn_diff = abs(entry1['turn'] - entry2['turn'])
-    player_diff = 0 if entry1['player'] == entry2['player'] else 1
-    evaluation_diff = abs(entry1['player_relative_evaluation'] - entry2['player_relative_evaluation'])
-    correct_move_proportion_diff = abs(
-        (len(entry1['correct_moves']) / len(entry1['legal_moves'])) - 
-        (len(entry2['correct_moves']) / len(entry2['legal_moves']))
-    )
-    return turn_diff + player_diff + evaluation_diff + correct_move_proportion_diff
-
-def relevance_score(entry, board, player):
-    player_diff = 0 if entry['player'] == player else 1
-    turn_diff = abs(get_turn_value(entry['board']) - get_turn_value(board))
-    center_square_value_diff = 0 if get_center_square_value(entry['board']) == get_center_square_value(board) else 1
-
-    return player_diff + turn_diff + center_square_value_diff
+    index = cot_records if isinstance(cot_records, FewShotExampleIndex) else FewShotExampleIndex(cot_records)
+    best_candidate = index.most_relevant(board, player)
+    return [ best_candidate ] if best_candidate is not None else []
+
+# Modification time and size of the cached few-shot examples for the cycle, or None if there aren't any
+def few_shot_examples_signature(experiment_name, cycle_number):
+    cache_path = os.path.join(get_cycle_dir(experiment_name, cycle_number), 'few_shot_examples.json')
+    try:
+        stat = os.stat(cache_path)
+    except FileNotFoundError:
+        return None
+    return ( stat.st_mtime_ns, stat.st_size )
 
 def cache_few_shot_examples(experiment_name, cycle_number, entries):
     cycle_dir = get_cycle_dir(experiment_name, cycle_number)
     cache_path = os.path.join(cycle_dir, 'few_shot_examples.json')
-    with open(cache_path, 'w') as f:
-        json.dump(entries, f, indent=4)
+    write_json_file_atomically(entries, cache_path)
 
 def cache_inconsistent_few_shot_examples(experiment_name, cycle_number, entries):
     cycle_dir = get_cycle_dir(experiment_name, cycle_number)
@@ -308,29 +380,20 @@ def cache_inconsistent_few_shot_examples(experiment_name, cycle_number, entries)
         json.dump(entries, f, indent=4)
 
 def generate_cycle_summary(experiment_name, cycle_number):
-    cycle_dir = get_cycle_dir(experiment_name, cycle_number)
-    log_files = [f for f in os.listdir(cycle_dir) if f.startswith('game_log') and f.endswith('.json')]
-    
-    summary_scores = defaultdict(lambda: {'X': 0.0, 'O': 0.0, 'total': 0.0})
-    total_cycle_cost = 0
-
-    for log_file in log_files:
-        with open(os.path.join(cycle_dir, log_file), 'r') as f:
-            game_log = json.load(f)
-            if 'score' in game_log[-1]:
-                for player, score in game_log[-1]['score'].items():
-                    if game_log[0]['X'] == player:
-                        summary_scores[player]['X'] += score
-                    if game_log[0]['O'] == player:
-                        summary_scores[player]['O'] += score
-                    summary_scores[player]['total'] += score
-                total_cycle_cost += game_log[-1]['total_cost']
-
-    summary = {player: score for player, score in summary_scores.items()}
+    results_store = get_results_store(experiment_name)
+    results_store.sync_cycle(cycle_number)
+
+    summary = { player: { 'X': x_score, 'O': o_score, 'total': x_score + o_score }
+                for _cycle_number, player, x_score, o_score in results_store.scores(cycle_number, cycle_number) }
+    total_cycle_cost = results_store.total_cost(cycle_number, cycle_number)
+    n_cache_hits, n_cache_lookups = results_store.llm_cache_stats(cycle_number, cycle_number)
+
     print(f"Cycle {cycle_number} Summary for {experiment_name}:")
     for player, score in summary.items():
         print(f"{player}: X: {score['X']} | O: {score['O']} | Total: {score['total']}")
     print(f"Total cost for cycle {cycle_number}: ${total_cycle_cost:.2f}")
+    if n_cache_lookups > 0:
+        print(f"LLM move cache hit rate for cycle {cycle_number}: {n_cache_hits}/{n_cache_lookups} ({100.0 * n_cache_hits / n_cache_lookups:.1f}%)")
     
     return summary, total_cycle_cost
 
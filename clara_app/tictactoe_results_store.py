@@ -0,0 +1,189 @@
+"""
+Results store for tic-tac-toe experiments.
+
+The game logs in the cycle directories are the primary record of an experiment, but reading them all back
+for every summary or plot means opening and parsing thousands of JSON files. The results store keeps the
+information the analysis functions need in a SQLite database in the experiment directory, results.db, with two tables:
+
+- games: one row per game log, with the players, their scores and the total cost
+- moves: one row per move, with whether it was correct, which kinds of threats and opportunities were present,
+  and whether the move came from the LLM move cache
+
+Rows are written when a game log is saved. If a log is rewritten, e.g. by correct_game_log_file,
+its rows are replaced. Logs from experiments run before the store existed are imported on demand by sync_cycle.
+
+Summaries are then GROUP BY queries over these tables.
+"""
+
+from .tictactoe_engine import immediate_threats_and_opportunities
+
+from contextlib import closing
+import json
+import os
+import sqlite3
+
+# Metrics used in the analysis functions, mapped to the column in the moves table saying whether a move is relevant to it
+metric_columns = { 'overall_correctness': None,
+                   'own_winning_move': 'own_winning_move',
+                   'opponent_threat': 'opponent_threat',
+                   'double_threat': 'double_threat',
+                   'double_threat_follow_up': 'double_threat_follow_up' }
+
+_schema = """
+CREATE TABLE IF NOT EXISTS games (
+    cycle INTEGER NOT NULL,
+    log_file TEXT NOT NULL,
+    player_x TEXT NOT NULL,
+    player_o TEXT NOT NULL,
+    score_x REAL,
+    score_o REAL,
+    total_cost REAL,
+    PRIMARY KEY ( cycle, log_file )
+);
+CREATE TABLE IF NOT EXISTS moves (
+    cycle INTEGER NOT NULL,
+    log_file TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    player_name TEXT NOT NULL,
+    move TEXT NOT NULL,
+    correct INTEGER NOT NULL,
+    own_winning_move INTEGER NOT NULL,
+    opponent_threat INTEGER NOT NULL,
+    double_threat INTEGER NOT NULL,
+    double_threat_follow_up INTEGER NOT NULL,
+    cost REAL,
+    llm_cache_hit INTEGER,
+    PRIMARY KEY ( cycle, log_file, turn )
+);
+CREATE INDEX IF NOT EXISTS moves_by_player ON moves ( player_name, cycle );
+"""
+
+move_columns = ( 'cycle', 'log_file', 'turn', 'player', 'player_name', 'move', 'correct',
+                 'own_winning_move', 'opponent_threat', 'double_threat', 'double_threat_follow_up', 'cost', 'llm_cache_hit' )
+
+# Columns added after the first version of the store, with their types
+_added_move_columns = { 'llm_cache_hit': 'INTEGER' }
+
+def add_missing_columns(connection):
+    existing_columns = set( row[1] for row in connection.execute('PRAGMA table_info(moves)').fetchall() )
+    for column, column_type in _added_move_columns.items():
+        if not column in existing_columns:
+            connection.execute(f'ALTER TABLE moves ADD COLUMN {column} {column_type}')
+    connection.commit()
+
+class ExperimentResultsStore:
+    def __init__(self, experiment_dir):
+        self.experiment_dir = experiment_dir
+        self.path = os.path.join(experiment_dir, 'results.db')
+        self._schema_created = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        if not self._schema_created:
+            connection.executescript(_schema)
+            add_missing_columns(connection)
+            self._schema_created = True
+        return connection
+
+    # Add or replace the rows for a game log
+    def record_game(self, cycle_number, log_file, game_log):
+        game_row = game_log_to_game_row(cycle_number, log_file, game_log)
+        move_rows = game_log_to_move_rows(cycle_number, log_file, game_log)
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM moves WHERE cycle = ? AND log_file = ?', ( cycle_number, log_file ))
+            connection.execute('INSERT OR REPLACE INTO games VALUES ( ?, ?, ?, ?, ?, ?, ? )', game_row)
+            connection.executemany(f'INSERT INTO moves ( {", ".join(move_columns)} ) VALUES ( {", ".join("?" for column in move_columns)} )', move_rows)
+
+    def recorded_log_files(self, cycle_number):
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT log_file FROM games WHERE cycle = ?', ( cycle_number, )).fetchall()
+        return set( row[0] for row in rows )
+
+    # Import any game logs in the cycle directory which aren't in the store yet
+    def sync_cycle(self, cycle_number):
+        cycle_dir = os.path.join(self.experiment_dir, f'cycle_{cycle_number}')
+        if not os.path.isdir(cycle_dir):
+            return
+        log_files = [ f for f in os.listdir(cycle_dir) if f.startswith('game_log') and f.endswith('.json') ]
+        recorded = self.recorded_log_files(cycle_number)
+        for log_file in log_files:
+            if not log_file in recorded:
+                with open(os.path.join(cycle_dir, log_file), 'r') as f:
+                    game_log = json.load(f)
+                self.record_game(cycle_number, log_file, game_log)
+
+    # Rows ( cycle, player_name, X score, O score ) for the finished games in cycles first_cycle to last_cycle inclusive
+    def scores(self, first_cycle, last_cycle):
+        query = f"""SELECT cycle, player, SUM(x), SUM(o) FROM (
+                        SELECT cycle, player_x AS player, score_x AS x, 0 AS o FROM games WHERE score_x IS NOT NULL
+                        UNION ALL
+                        SELECT cycle, player_o AS player, 0 AS x, score_o AS o FROM games WHERE score_o IS NOT NULL )
+                    WHERE cycle BETWEEN ? AND ?
+                    GROUP BY cycle, player ORDER BY cycle, player"""
+        with closing(self._connect()) as connection:
+            return connection.execute(query, ( first_cycle, last_cycle )).fetchall()
+
+    def total_cost(self, first_cycle, last_cycle):
+        query = """SELECT COALESCE(SUM(total_cost), 0) FROM games
+                   WHERE score_x IS NOT NULL AND cycle BETWEEN ? AND ?"""
+        with closing(self._connect()) as connection:
+            return connection.execute(query, ( first_cycle, last_cycle )).fetchone()[0]
+
+    # ( n_cache_hits, n_cache_lookups ) for the LLM moves made with the LLM move cache switched on
+    def llm_cache_stats(self, first_cycle, last_cycle):
+        query = """SELECT COALESCE(SUM(llm_cache_hit), 0), COUNT(llm_cache_hit) FROM moves
+                   WHERE cycle BETWEEN ? AND ?"""
+        with closing(self._connect()) as connection:
+            return connection.execute(query, ( first_cycle, last_cycle )).fetchone()
+
+    # Rows ( cycle, player_name, n_correct, n_incorrect ) for the moves relevant to the metric.
+    # If player_name is given, only moves by that player are counted.
+    def metric_counts(self, first_cycle, last_cycle, metric, player_name=None):
+        if not metric in metric_columns:
+            raise ValueError(f'Unknown metric {metric}')
+        conditions = [ 'cycle BETWEEN ? AND ?' ]
+        parameters = [ first_cycle, last_cycle ]
+        if metric_columns[metric]:
+            conditions.append(f'{metric_columns[metric]} = 1')
+        if player_name:
+            conditions.append('player_name = ?')
+            parameters.append(player_name)
+        query = f"""SELECT cycle, player_name, SUM(correct), SUM(1 - correct) FROM moves
+                    WHERE {' AND '.join(conditions)}
+                    GROUP BY cycle, player_name ORDER BY cycle, player_name"""
+        with closing(self._connect()) as connection:
+            return connection.execute(query, parameters).fetchall()
+
+def game_log_to_game_row(cycle_number, log_file, game_log):
+    metadata = game_log[0]
+    final_record = game_log[-1]
+    if 'score' in final_record:
+        score_x = final_record['score'].get(metadata['X'], None)
+        score_o = final_record['score'].get(metadata['O'], None)
+    else:
+        score_x = score_o = None
+    return ( cycle_number, log_file, metadata['X'], metadata['O'], score_x, score_o, final_record.get('total_cost', None) )
+
+def game_log_to_move_rows(cycle_number, log_file, game_log):
+    metadata = game_log[0]
+    rows = []
+    for index, entry in enumerate(game_log[1:], start=1):
+        if 'board' in entry and 'move' in entry and 'player' in entry and 'correct_moves' in entry:
+            player = entry['player']
+            threats_and_opportunities = immediate_threats_and_opportunities(entry['board'], player)
+            rows.append(( cycle_number,
+                          log_file,
+                          entry.get('turn', index),
+                          player,
+                          metadata['X'] if player == 'X' else metadata['O'],
+                          entry['move'],
+                          int(entry['move'] in entry['correct_moves']),
+                          int(bool(threats_and_opportunities['winning_moves'])),
+                          # If there is more than one opponent threat we have a lost position, so there are no correct moves.
+                          int(len(threats_and_opportunities['opponent_threats']) == 1),
+                          int(bool(threats_and_opportunities['double_threat'])),
+                          int(bool(threats_and_opportunities['double_threat_follow_up_to_single_threat'])),
+                          entry.get('cost', None),
+                          None if entry.get('llm_cache_hit', None) is None else int(entry['llm_cache_hit']) ))
+    return rows
@@ -39,6 +39,7 @@ urlpatterns = [
     path('confirm_transfer/', views.confirm_transfer, name='confirm_transfer'),
     path('credit_balance/', views.credit_balance, name='credit_balance'),
     path('view_task_updates/', views.view_task_updates, name='view_task_updates'),
+    path('task_updates_stream/<str:report_id>/', views.task_updates_stream, name='task_updates_stream'),
     path('activity/<int:activity_id>/activity_detail/', views.activity_detail, name='activity_detail'),
     path('create_activity/', views.create_activity, name='create_activity'),
     path('list_activities/', views.list_activities, name='list_activities'),
@@ -137,6 +138,8 @@ urlpatterns = [
     path('projects/<int:project_id>/metadata/<str:version>/', views.get_metadata_for_version, name='get_metadata_for_version'),
     path('rendered_texts/<int:project_id>/<str:phonetic_or_normal>/static/<path:filename>', views.serve_rendered_text_static, name='serve_rendered_text'),
     path('rendered_texts/<int:project_id>/<str:phonetic_or_normal>/multimedia/<path:filename>', views.serve_rendered_text_multimedia, name='serve_rendered_text'),
+    path('rendered_texts/<int:project_id>/<str:phonetic_or_normal>/audio_bundle/<int:page_number>', views.serve_rendered_text_audio_bundle, name='serve_rendered_text_audio_bundle'),
+    path('api_scheduler_status/', views.api_scheduler_status, name='api_scheduler_status'),
     path('rendered_texts/<int:project_id>/<str:phonetic_or_normal>/<path:filename>', views.serve_rendered_text, name='serve_rendered_text'),
 
     path('serve_zipfile/<int:project_id>/', views.serve_zipfile, name='serve_zipfile'),
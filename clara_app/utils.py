@@ -10,6 +10,8 @@ from django.core.mail import EmailMessage
 from .models import CLARAProject, User, UserConfiguration, HumanAudioInfo, PhoneticHumanAudioInfo, FormatPreferences, Acknowledgements
 from .models import APICall, ProjectPermissions, LanguageMaster, TaskUpdate, Update, FriendRequest, Content, SatisfactionQuestionnaire
 
+from .task_update_channel import get_task_update_channel
+
 from .clara_main import CLARAProjectInternal
 
 from .clara_dependencies import CLARADependencies
@@ -32,6 +34,8 @@ def get_user_config(user):
     """
     Returns a dictionary of configuration settings for the given user.
     """
+    # Used by clara_api_scheduler to give users who are running out of credit lower priority
+    credit = float(user.userprofile.credit) if hasattr(user, 'userprofile') else None
     try:
         user_config = UserConfiguration.objects.get(user=user)
     except UserConfiguration.DoesNotExist:
@@ -40,6 +44,7 @@ def get_user_config(user):
             'clara_version': 'full_clara',
             'gpt_model': 'gpt-4-1106-preview',
             'max_annotation_words': 250,
+            'credit': credit,
             # Add more default configurations here as needed
         }
 
@@ -48,6 +53,7 @@ def get_user_config(user):
         'open_ai_api_key': user_config.open_ai_api_key,
         'gpt_model': user_config.gpt_model,
         'max_annotation_words': user_config.max_annotation_words,
+        'credit': credit,
     }
 
 def user_has_open_ai_key_or_credit(user):
@@ -72,10 +78,14 @@ def make_asynch_callback_and_report_id(request, task_type):
 ##        message = message[:1000] + '...'
 ##    TaskUpdate.objects.create(report_id=report_id, message=message)
 
+##def post_task_update_in_db(report_id, user_id, task_type, message):
+##    if len(message) > 1000:
+##        message = message[:1000] + '...'
+##    TaskUpdate.objects.create(report_id=report_id, user_id=user_id, task_type=task_type, message=message)
+
+# Messages are buffered and written in batches, see task_update_channel.py
 def post_task_update_in_db(report_id, user_id, task_type, message):
-    if len(message) > 1000:
-        message = message[:1000] + '...'
-    TaskUpdate.objects.create(report_id=report_id, user_id=user_id, task_type=task_type, message=message)
+    get_task_update_channel().post(report_id, user_id, task_type, message)
 
 # Extract unread messages for a given task ID
 ##def get_task_updates(report_id):
@@ -87,11 +97,12 @@ def post_task_update_in_db(report_id, user_id, task_type, message):
 ##    return messages
 
 def get_task_updates(report_id):
-    updates = TaskUpdate.objects.filter(report_id=report_id, read=False).order_by('timestamp')
-    messages = [update.message for update in updates]
+    updates = list(TaskUpdate.objects.filter(report_id=report_id, read=False).order_by('timestamp', 'id').values_list('id', 'message'))
+    messages = [ message for ( id, message ) in updates ]
     
     # Mark the updates as read
-    updates.update(read=True)
+    if updates:
+        TaskUpdate.objects.filter(id__in=[ id for ( id, message ) in updates ]).update(read=True)
     
     return messages
 
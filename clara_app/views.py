@@ -1,14 +1,14 @@
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, FileResponse, JsonResponse, Http404
+from django.http import HttpResponse, FileResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.clickjacking import xframe_options_sameorigin
 from django.core.paginator import Paginator
 from django.contrib import messages
 from django.conf import settings
 from django import forms
-from django.db import transaction
+from django.db import transaction, connections
 from django.db.models import Count, Avg, Q, Max, F, Case, Value, When, IntegerField, Sum
 from django.db.models.functions import Lower
 from django.core.exceptions import PermissionDenied
@@ -49,6 +49,7 @@ from .utils import get_user_config, user_has_open_ai_key_or_credit, create_inter
 from .utils import get_user_api_cost, get_project_api_cost, get_project_operation_costs, get_project_api_duration, get_project_operation_durations
 from .utils import user_is_project_owner, user_has_a_project_role, user_has_a_named_project_role, language_master_required
 from .utils import post_task_update_in_db, get_task_updates, has_saved_internalised_and_annotated_text
+from .task_update_channel import is_terminal_message
 from .utils import uploaded_file_to_file, create_update, current_friends_of_user, get_phase_up_to_date_dict
 from .utils import send_mail_or_print_trace, get_zoom_meeting_start_date, get_previous_week_start_date
 
@@ -56,7 +57,10 @@ from .clara_main import CLARAProjectInternal
 #from .clara_audio_repository import AudioRepository
 from .clara_audio_repository_orm import AudioRepositoryORM
 from .clara_image_repository_orm import ImageRepositoryORM
+from .clara_image_request_dag import image_request_sequence_hash, run_image_request_dag
 from .clara_audio_annotator import AudioAnnotator
+from .clara_audio_cache import local_audio_file, audio_manifest_page, audio_bundle_etag, audio_bundle_for_page, warm_up_rendered_audio_in_background
+from .clara_api_scheduler import api_scheduler_metrics
 #from .clara_phonetic_lexicon_repository import PhoneticLexiconRepository
 from .clara_phonetic_lexicon_repository_orm import PhoneticLexiconRepositoryORM
 from .clara_prompt_templates import PromptTemplateRepository
@@ -100,6 +104,8 @@ import pprint
 import uuid
 import traceback
 import tempfile
+import threading
+import time
 import pandas as pd
 
 config = get_config()
@@ -830,6 +836,49 @@ def view_task_updates(request):
     
     return render(request, 'clara_app/view_task_updates.html', {'updates': updates, 'clara_version': clara_version})
 
+# Optional server-sent events alternative to polling one of the *_status endpoints, used by render_text_monitor.html.
+# The updates are posted by worker processes, so we still have to look in the database, but no more often
+# than the status pages do, and only for rows after the last one sent.
+# Messages are not marked as read, so a status page polling the same task still gets all of them.
+# The stream closes when the task reports 'finished' or 'error', or after stream_max_seconds, to free the worker.
+# The browser then reconnects with the id of the last event, and the stream carries on from there.
+@login_required
+def task_updates_stream(request, report_id):
+    poll_seconds = float(config.get('task_updates', 'stream_poll_seconds'))
+    max_seconds = float(config.get('task_updates', 'stream_max_seconds'))
+    # Only the user who started the task can see its messages
+    if TaskUpdate.objects.filter(report_id=report_id).exclude(user_id=request.user.username).exists():
+        raise PermissionDenied("You don't have permission to follow this task.")
+    updates = TaskUpdate.objects.filter(report_id=report_id, user_id=request.user.username)
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID', 0))
+    except ValueError:
+        last_id = 0
+
+    def event_stream():
+        nonlocal last_id
+        start_time = time.time()
+        yield f"retry: {int(poll_seconds * 1000)}\n\n"
+        while time.time() - start_time < max_seconds:
+            new_updates = list(updates.filter(id__gt=last_id).order_by('timestamp', 'id').values_list('id', 'message'))
+            messages = [ message for ( id, message ) in new_updates ]
+            terminal_messages = [ message for message in messages if is_terminal_message(message) ]
+            status = terminal_messages[-1] if terminal_messages else 'unknown'
+            if messages:
+                last_id = max(id for ( id, message ) in new_updates)
+                yield f"id: {last_id}\ndata: {json.dumps({'messages': messages, 'status': status})}\n\n"
+            else:
+                # SSE comment line, keeps the connection alive
+                yield ": keep-alive\n\n"
+            if status != 'unknown':
+                return
+            time.sleep(poll_seconds)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 # Allow a language master to edit a phonetic lexicon
 @login_required
 @language_master_required
@@ -4927,11 +4976,10 @@ def generate_image_descriptions(project_id, callback=None):
                     raise ValueError('Response is not a JSON list')
                 if not is_well_formed_description_list(response_object, callback=callback):
                     raise ValueError(f'Error: response {response_object} is not a well-formed description list')
-                clara_project_internal.remove_all_project_image_descriptions(callback=callback)
-                for description in response_object:
-                    description_variable = description['description_variable']
-                    explanation = description['explanation']
-                    clara_project_internal.add_project_image_description(description_variable, explanation, callback=callback)
+                descriptions = [ ( description['description_variable'], description['explanation'] )
+                                 for description in response_object ]
+                if not clara_project_internal.replace_all_project_image_descriptions(descriptions, callback=callback):
+                    raise ValueError('Unable to store description list')
                 post_task_update(callback, "finished")
                 return True
             except Exception as e:
@@ -5224,96 +5272,60 @@ def check_and_correct_initialization_in_image_request_sequence(sequence, project
 #   'current_image': image_file_path
 #  }
 # current_image may be null
+#
+# The requests are run as a dependency graph (see clara_image_request_dag), so that requests which don't depend
+# on each other, typically the images for different pages, are processed in parallel.
+# Completed requests are recorded in the project directory. If the task fails and is then rerun with the same
+# requests, it continues with the ones that were not completed.
 
 def create_and_add_coherent_dall_e_3_images(project_id, requests, callback=None):
     try:
         project = get_object_or_404(CLARAProject, pk=project_id)
         clara_project_internal = CLARAProjectInternal(project.internal_id, project.l2, project.l1)
         user = project.user
-        config_info = get_user_config(user)
+        # Image sequences are long background jobs, so they shouldn't hold up interactive requests
+        config_info = dict(get_user_config(user), api_priority='bulk')
         temp_dir = tempfile.mkdtemp()
-        
-        for request in requests:
-            n_tries = 0
-            retry_limit = int(config.get('dall_e_3', 'retry_limit'))
-            request_succeeded = False
-            
-            while not request_succeeded and n_tries <= retry_limit:
-                try:
-                    request_type = request['request_type']
-                    image_name = request['image_name']
-                    page = request['page']
-                    position = request['position']
-                    user_prompt = request['user_prompt']
-                    content_description = request['content_description']
-                    style_description = request['style_description']
-                    current_image = request['current_image']
-                    description_variable = request['description_variable']
-                    description_variables = request['description_variables']
-
-                    if request_type not in ('image-generation', 'image-understanding'):
-                        post_task_update(callback, f"*** Error: unknown request type in image generation sequence: {request_type}")
-                        post_task_update(callback, "error")
-                        return False
-
-                    if request_type == 'image-generation':
-                        full_prompt = f"""Create an image based on the following request: {user_prompt}
-
-Make the style of the image consistent with the style of the previously generated image described here: {style_description}
-        """
-                        for description_variable in description_variables:
-                            image_description = clara_project_internal.get_project_image_description(description_variable, callback=callback)
-                            description_text = clara_project_internal.get_image_understanding_result(description_variable, callback=callback)
-                            if image_description and description_text:
-                                explanation_text = image_description.explanation
-                                full_prompt += f"\n\nDepict {explanation_text} according to this description: {description_text}"
-
-                        tmp_image_file = os.path.join(temp_dir, f'{image_name}_{page}_{position}.jpg')
-                        post_task_update(callback, f"--- Creating DALL-E-3 image: name {image_name}, page {page}, position {position}")
-                        api_calls_generate = call_chat_gpt4_image(full_prompt, tmp_image_file, config_info=config_info, callback=callback)
-                        store_api_calls(api_calls_generate, project, project.user, 'image')
-                        post_task_update(callback, f"--- Image created: {tmp_image_file}")
-
-                        clara_project_internal.add_project_image(image_name, tmp_image_file, 
-                                                                 associated_text='', associated_areas='',
-                                                                 page=page, position=position,
-                                                                 user_prompt=user_prompt,
-                                                                 description_variables=description_variables,
-                                                                 request_type=request_type)
-                        post_task_update(callback, f"--- Image stored")
-                        request_succeeded = True
-
-                    elif request_type == 'image-understanding':
-                        post_task_update(callback, f"--- Creating a description of part of image")
-                        generated_image_object = clara_project_internal.get_generated_project_image_by_position(page, position, callback=callback)
-                        if not generated_image_object:
-                            post_task_update(callback, "error")
-                            return False
-
-                        generated_image_file_path = generated_image_object.image_file_path
-                        if not file_exists(generated_image_file_path):
-                            post_task_update(callback, f"Error: unable to find generated image for page={page}, position={position}")
-                            post_task_update(callback, "error")
-                            return False
-                        api_call_interpret = call_chat_gpt4_interpret_image(user_prompt, generated_image_file_path,
-                                                                            config_info=config_info, callback=callback)
-                        description = api_call_interpret.response
-                        clara_project_internal.store_image_understanding_result(description_variable, description,
-                                                                                image_name=image_name, page=page, position=position, user_prompt=user_prompt,
-                                                                                callback=callback)
-                        post_task_update(callback, f"--- Description created for '{description_variable}': '{description}'")
-                        request_succeeded = True
+        # Fetch all the images and descriptions up front, rather than querying the database for each one inside the loop
+        image_data = clara_project_internal.get_project_image_data(callback=callback)
+        if not image_data:
+            post_task_update(callback, "error")
+            return False
 
-                except Exception as e:
-                    post_task_update(callback, f"{request_type} task failed for page = {page}, position = {position}")
-                    post_task_update(callback, f"Exception: {str(e)}\n{traceback.format_exc()}")
-                    n_tries += 1
-            
-            if not request_succeeded:
-                post_task_update(callback, f"*** Error: giving up on {request_type} task after {retry_limit} unsuccessful attempts")
+        for request in requests:
+            if request['request_type'] not in ('image-generation', 'image-understanding'):
+                post_task_update(callback, f"*** Error: unknown request type in image generation sequence: {request['request_type']}")
                 post_task_update(callback, "error")
                 return False
-        
+
+        requests_hash = image_request_sequence_hash(requests)
+        completed = clara_project_internal.get_coherent_image_request_progress(requests_hash)
+        if completed:
+            post_task_update(callback, f"--- Resuming: {len(completed)}/{len(requests)} image requests already completed")
+
+        image_data_lock = threading.Lock()
+
+        def run_request(index):
+            try:
+                return run_coherent_image_request(requests[index], project, clara_project_internal, config_info,
+                                                  image_data, image_data_lock, temp_dir, callback=callback)
+            finally:
+                # Each worker thread has its own database connection
+                connections.close_all()
+
+        def record_completed(index):
+            completed.append(index)
+            clara_project_internal.save_coherent_image_request_progress(requests_hash, sorted(completed))
+
+        max_workers = int(config.get('dall_e_3', 'max_concurrent_requests'))
+        failed = run_image_request_dag(requests, run_request, max_workers, completed=completed, on_completed=record_completed)
+
+        if failed:
+            post_task_update(callback, f"*** Error: {len(failed)} image request(s) failed. Completed requests have been saved, so running the task again will continue from there")
+            post_task_update(callback, "error")
+            return False
+
+        clara_project_internal.remove_coherent_image_request_progress()
         post_task_update(callback, "finished")
         return True
     
@@ -5325,6 +5337,86 @@ Make the style of the image consistent with the style of the previously generate
     finally:
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
+
+# Carry out one request from a coherent image sequence, retrying up to the retry limit. Returns True if it succeeded.
+# This runs on a worker thread, so access to image_data goes through image_data_lock.
+def run_coherent_image_request(request, project, clara_project_internal, config_info, image_data, image_data_lock, temp_dir, callback=None):
+    n_tries = 0
+    retry_limit = int(config.get('dall_e_3', 'retry_limit'))
+    request_type = request['request_type']
+    page = request['page']
+    position = request['position']
+    
+    while n_tries <= retry_limit:
+        try:
+            image_name = request['image_name']
+            user_prompt = request['user_prompt']
+            style_description = request['style_description']
+            description_variable = request['description_variable']
+            description_variables = request['description_variables']
+
+            if request_type == 'image-generation':
+                full_prompt = f"""Create an image based on the following request: {user_prompt}
+
+Make the style of the image consistent with the style of the previously generated image described here: {style_description}
+        """
+                for description_variable in description_variables:
+                    with image_data_lock:
+                        image_description = image_data.get_description(description_variable)
+                        description_text = image_data.get_understanding_result(description_variable)
+                    if image_description and description_text:
+                        explanation_text = image_description.explanation
+                        full_prompt += f"\n\nDepict {explanation_text} according to this description: {description_text}"
+
+                tmp_image_file = os.path.join(temp_dir, f'{image_name}_{page}_{position}.jpg')
+                post_task_update(callback, f"--- Creating DALL-E-3 image: name {image_name}, page {page}, position {position}")
+                api_calls_generate = call_chat_gpt4_image(full_prompt, tmp_image_file, config_info=config_info, callback=callback)
+                store_api_calls(api_calls_generate, project, project.user, 'image')
+                post_task_update(callback, f"--- Image created: {tmp_image_file}")
+
+                clara_project_internal.add_project_image(image_name, tmp_image_file, 
+                                                         associated_text='', associated_areas='',
+                                                         page=page, position=position,
+                                                         user_prompt=user_prompt,
+                                                         description_variables=description_variables,
+                                                         request_type=request_type)
+                stored_image = clara_project_internal.get_project_image(image_name, callback=callback)
+                if stored_image:
+                    with image_data_lock:
+                        image_data.update_image(stored_image)
+                post_task_update(callback, f"--- Image stored")
+                return True
+
+            elif request_type == 'image-understanding':
+                post_task_update(callback, f"--- Creating a description of part of image")
+                with image_data_lock:
+                    generated_image_object = image_data.get_generated_image_by_position(page, position)
+                if not generated_image_object:
+                    post_task_update(callback, f"*** Error: no generated image found for page={page}, position={position}")
+                    return False
+
+                generated_image_file_path = generated_image_object.image_file_path
+                if not file_exists(generated_image_file_path):
+                    post_task_update(callback, f"Error: unable to find generated image for page={page}, position={position}")
+                    return False
+                api_call_interpret = call_chat_gpt4_interpret_image(user_prompt, generated_image_file_path,
+                                                                    config_info=config_info, callback=callback)
+                description = api_call_interpret.response
+                clara_project_internal.store_image_understanding_result(description_variable, description,
+                                                                        image_name=image_name, page=page, position=position, user_prompt=user_prompt,
+                                                                        callback=callback)
+                with image_data_lock:
+                    image_data.update_understanding_result(description_variable, description)
+                post_task_update(callback, f"--- Description created for '{description_variable}': '{description}'")
+                return True
+
+        except Exception as e:
+            post_task_update(callback, f"{request_type} task failed for page = {page}, position = {position}")
+            post_task_update(callback, f"Exception: {str(e)}\n{traceback.format_exc()}")
+            n_tries += 1
+    
+    post_task_update(callback, f"*** Error: giving up on {request_type} task for page = {page}, position = {position} after {retry_limit} unsuccessful attempts")
+    return False
     
 # This is the API endpoint that the JavaScript will poll
 @login_required
@@ -6313,8 +6405,11 @@ def confirm_funding_approvals(request):
 
 @xframe_options_sameorigin
 def serve_rendered_text(request, project_id, phonetic_or_normal, filename):
-    file_path = absolute_file_name(Path(output_dir_for_project_id(project_id, phonetic_or_normal)) / f"{filename}")
+    output_dir = output_dir_for_project_id(project_id, phonetic_or_normal)
+    file_path = absolute_file_name(Path(output_dir) / f"{filename}")
     if file_exists(file_path):
+        # The reader will probably click on words soon, so get this node's audio cache ready for them
+        warm_up_rendered_audio_in_background(output_dir)
         content_type, _ = mimetypes.guess_type(unquote(str(file_path)))
         if _s3_storage:
             s3_file = _s3_bucket.Object(key=file_path).get()
@@ -6340,7 +6435,10 @@ def serve_rendered_text_multimedia(request, project_id, phonetic_or_normal, file
     file_path = absolute_file_name(Path(output_dir_for_project_id(project_id, phonetic_or_normal)) / f"multimedia/{filename}")
     if file_exists(file_path):
         content_type, _ = mimetypes.guess_type(unquote(str(file_path)))
-        if _s3_storage:
+        if content_type and content_type.startswith('audio/'):
+            # On S3, this serves a copy from the local disk cache, fetching it first if necessary
+            return FileResponse(open(local_audio_file(file_path), 'rb'), content_type=content_type)
+        elif _s3_storage:
             s3_file = _s3_bucket.Object(key=file_path).get()
             return HttpResponse(s3_file['Body'].read(), content_type=content_type)
         else:
@@ -6348,6 +6446,29 @@ def serve_rendered_text_multimedia(request, project_id, phonetic_or_normal, file
     else:
         raise Http404
 
+# Serve the word and segment audio for a rendered page in one response, as JSON mapping the data-audio values to base64 mp3s.
+# The browser can keep the response for bundle_max_age_seconds, and after that revalidates it with the ETag.
+def serve_rendered_text_audio_bundle(request, project_id, phonetic_or_normal, page_number):
+    output_dir = output_dir_for_project_id(project_id, phonetic_or_normal)
+    manifest_page = audio_manifest_page(output_dir, page_number)
+    if manifest_page is None:
+        raise Http404
+    warm_up_rendered_audio_in_background(output_dir)
+    etag = audio_bundle_etag(manifest_page)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = JsonResponse({ 'audio': audio_bundle_for_page(manifest_page) })
+    response['ETag'] = etag
+    response['Cache-Control'] = f"private, max-age={int(config.get('audio_cache', 'bundle_max_age_seconds'))}"
+    return response
+
+# Queue depths, wait times and retry counts for the external API rate limits, see clara_api_scheduler
+@login_required
+@user_passes_test(lambda u: u.userprofile.is_admin)
+def api_scheduler_status(request):
+    return JsonResponse({ 'buckets': api_scheduler_metrics() })
+
 # Serve up self-contained zipfile of HTML pages created from a project
 @login_required
 def serve_zipfile(request, project_id):
@@ -6411,11 +6532,8 @@ def serve_audio_file(request, engine_id, l2, voice_id, base_filename):
     file_path = absolute_file_name( Path(base_dir) / engine_id / l2 / voice_id / base_filename )
     if file_exists(file_path):
         content_type, _ = mimetypes.guess_type(unquote(str(file_path)))
-        if _s3_storage:
-            s3_file = _s3_bucket.Object(key=file_path).get()
-            return HttpResponse(s3_file['Body'].read(), content_type=content_type)
-        else:
-            return HttpResponse(open(file_path, 'rb'), content_type=content_type)
+        # On S3, this serves a copy from the local disk cache, fetching it first if necessary
+        return FileResponse(open(local_audio_file(file_path), 'rb'), content_type=content_type)
     else:
         raise Http404
 
@@ -0,0 +1,131 @@
+"""
+Bitboard representation of tic-tac-toe positions.
+
+A position is a pair of 9-bit masks ( x_mask, o_mask ), one for each player. Square i has bit 1 << i,
+where i = file + 3 * ( rank - 1 ), so a1 = 0, b1 = 1, c1 = 2, a2 = 3, ... c3 = 8. This is the same numbering
+used for list boards in the C-LARA tic-tac-toe engine.
+
+With this representation, checking for wins, threats and forks is a few bit operations on
+precomputed tables, instead of copying the board and rescanning the winning lines for every candidate move.
+
+The module has no dependencies, and the same file is used by clara_app (tictactoe_bitboard.py) and
+the tic-tac-toe web app (tictactoe_app/bitboard.py), which are deployed separately. Keep the two copies identical.
+
+Adapters are provided for the two board formats in use:
+
+- list boards: a list of 9 strings, each one 'X', 'O' or ' ', indexed as above
+- algebraic dict boards: a dict from 'a1' ... 'c3' to 'X', 'O' or ''
+"""
+
+FULL_MASK = 0b111111111
+
+SQUARES_ALGEBRAIC = [ f'{file}{rank}' for rank in '123' for file in 'abc' ]
+
+SQUARE_BITS = { square: 1 << index for index, square in enumerate(SQUARES_ALGEBRAIC) }
+
+CENTER_MASK = SQUARE_BITS['b2']
+
+CORNERS_MASK = SQUARE_BITS['a1'] | SQUARE_BITS['c1'] | SQUARE_BITS['a3'] | SQUARE_BITS['c3']
+
+def squares_to_mask(indices):
+    mask = 0
+    for index in indices:
+        mask |= 1 << index
+    return mask
+
+# Rows, columns, diagonals
+WIN_MASKS = [ squares_to_mask(line) for line in
+              ( ( 0, 1, 2 ), ( 3, 4, 5 ), ( 6, 7, 8 ),
+                ( 0, 3, 6 ), ( 1, 4, 7 ), ( 2, 5, 8 ),
+                ( 0, 4, 8 ), ( 2, 4, 6 ) ) ]
+
+POPCOUNT = [ bin(mask).count('1') for mask in range(1 << 9) ]
+
+# N_LINES_COMPLETED[mask] is the number of winning lines completely contained in mask
+N_LINES_COMPLETED = [ sum(1 for win_mask in WIN_MASKS if mask & win_mask == win_mask) for mask in range(1 << 9) ]
+
+def popcount(mask):
+    return POPCOUNT[mask]
+
+def mask_to_indices(mask):
+    return [ index for index in range(9) if mask & ( 1 << index ) ]
+
+def mask_to_algebraic(mask):
+    return [ SQUARES_ALGEBRAIC[index] for index in mask_to_indices(mask) ]
+
+# -----------------------------------------
+# Adapters
+
+def list_board_to_bitboards(board):
+    x_mask = 0
+    o_mask = 0
+    for index in range(9):
+        if board[index] == 'X':
+            x_mask |= 1 << index
+        elif board[index] == 'O':
+            o_mask |= 1 << index
+    return x_mask, o_mask
+
+def bitboards_to_list_board(x_mask, o_mask):
+    return [ 'X' if x_mask & ( 1 << index ) else 'O' if o_mask & ( 1 << index ) else ' ' for index in range(9) ]
+
+def dict_board_to_bitboards(board):
+    x_mask = 0
+    o_mask = 0
+    for square, bit in SQUARE_BITS.items():
+        if board[square] == 'X':
+            x_mask |= bit
+        elif board[square] == 'O':
+            o_mask |= bit
+    return x_mask, o_mask
+
+def bitboards_to_dict_board(x_mask, o_mask):
+    return { square: 'X' if x_mask & bit else 'O' if o_mask & bit else '' for square, bit in SQUARE_BITS.items() }
+
+# Return the masks as ( player_mask, opponent_mask )
+def player_and_opponent_masks(x_mask, o_mask, player):
+    return ( x_mask, o_mask ) if player == 'X' else ( o_mask, x_mask )
+
+# -----------------------------------------
+# Position analysis
+
+def empty_mask(own_mask, other_mask):
+    return FULL_MASK & ~( own_mask | other_mask )
+
+def is_win(mask):
+    return N_LINES_COMPLETED[mask] > 0
+
+def is_full(own_mask, other_mask):
+    return own_mask | other_mask == FULL_MASK
+
+# Empty squares where 'own' would complete a line
+def winning_squares(own_mask, other_mask):
+    result = 0
+    for win_mask in WIN_MASKS:
+        if POPCOUNT[own_mask & win_mask] == 2 and not other_mask & win_mask:
+            result |= win_mask & ~own_mask
+    return result
+
+# Empty squares which would give 'own' at least min_threats different winning squares on the next move.
+# min_threats=2 gives the fork moves
+def threat_creating_squares(own_mask, other_mask, min_threats=1):
+    result = 0
+    empty = empty_mask(own_mask, other_mask)
+    for index in range(9):
+        bit = 1 << index
+        if empty & bit and POPCOUNT[winning_squares(own_mask | bit, other_mask)] >= min_threats:
+            result |= bit
+    return result
+
+def fork_squares(own_mask, other_mask):
+    return threat_creating_squares(own_mask, other_mask, min_threats=2)
+
+# Lines where 'mask' has exactly n_own squares and 'empty' has exactly n_empty squares
+def count_lines(mask, empty, n_own, n_empty):
+    return sum(1 for win_mask in WIN_MASKS
+               if POPCOUNT[mask & win_mask] == n_own and POPCOUNT[empty & win_mask] == n_empty)
+
+# Lines containing 'bit' where 'mask' has exactly n_own squares and 'empty' has exactly n_empty squares
+def count_lines_through(bit, mask, empty, n_own, n_empty):
+    return sum(1 for win_mask in WIN_MASKS
+               if win_mask & bit and POPCOUNT[mask & win_mask] == n_own and POPCOUNT[empty & win_mask] == n_empty)
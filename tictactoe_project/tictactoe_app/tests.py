@@ -5,6 +5,10 @@ from django.contrib.auth.tokens import default_token_generator
 from tictactoe_app.forms import UserRegistrationForm
 from tictactoe_app.models.user_model import TicTacToeUser
 from datetime import datetime, timedelta, timezone
+from django.test import SimpleTestCase
+import itertools
+from tictactoe_app import bitboard
+from tictactoe_app.views.game_utils import check_win, evaluate_move_score, evaluate_move_description, evaluate_all_moves
 
 class TicTacToeUserModelTests(TestCase):
 
@@ -208,4 +212,134 @@ class PasswordResetTests(TestCase):
 
         # Authenticate with the new password
         user = authenticate(username="resetuser", password=new_password)
-        self.assertIsNotNone(user)
\ No newline at end of file
+        self.assertIsNotNone(user)
+
+
+
+# Reference versions of the board functions from before they were rewritten to use bitboards
+
+REFERENCE_WIN_PATTERNS = [
+    ['a1', 'a2', 'a3'], ['b1', 'b2', 'b3'], ['c1', 'c2', 'c3'],
+    ['a1', 'b1', 'c1'], ['a2', 'b2', 'c2'], ['a3', 'b3', 'c3'],
+    ['a1', 'b2', 'c3'], ['a3', 'b2', 'c1']
+]
+
+def reference_check_win(board):
+    winning_combinations = [
+        ['a3', 'b3', 'c3'], ['a2', 'b2', 'c2'], ['a1', 'b1', 'c1'],
+        ['a3', 'a2', 'a1'], ['b3', 'b2', 'b1'], ['c3', 'c2', 'c1'],
+        ['a3', 'b2', 'c1'], ['c3', 'b2', 'a1']
+    ]
+    for combo in winning_combinations:
+        if board[combo[0]] == board[combo[1]] and board[combo[1]] == board[combo[2]] and board[combo[0]] != '':
+            return board[combo[0]]
+    return None
+
+def reference_evaluate_move_score(board, move, is_ai_turn=True):
+    score = 0
+    player = 'O' if is_ai_turn else 'X'
+    opponent = 'X' if is_ai_turn else 'O'
+    board_copy = board.copy()
+    board_copy[move] = player
+    for pattern in REFERENCE_WIN_PATTERNS:
+        if all(board_copy[square] == player for square in pattern):
+            score += 100
+    if is_ai_turn:
+        for pattern in REFERENCE_WIN_PATTERNS:
+            x_count = sum(1 for square in pattern if board[square] == opponent)
+            empty_count = sum(1 for square in pattern if board[square] == '')
+            if x_count == 2 and empty_count == 1 and move in pattern:
+                score += 50
+    if move == 'b2':
+        score += 10
+    elif move in ['a3', 'c3', 'a1', 'c1']:
+        score += 5
+    for pattern in REFERENCE_WIN_PATTERNS:
+        o_count = sum(1 for square in pattern if board_copy[square] == player)
+        empty_count = sum(1 for square in pattern if board_copy[square] == '')
+        if o_count == 2 and empty_count == 1:
+            score += 25
+    return score
+
+def reference_evaluate_move_description(board, move, is_ai_turn=True):
+    player = 'O' if is_ai_turn else 'X'
+    opponent = 'X' if is_ai_turn else 'O'
+    board_copy = board.copy()
+    board_copy[move] = player
+    for pattern in REFERENCE_WIN_PATTERNS:
+        if all(board_copy[square] == player for square in pattern):
+            return "This move can help you win" if is_ai_turn else "This move can help the opponent win"
+    if is_ai_turn:
+        for pattern in REFERENCE_WIN_PATTERNS:
+            x_count = sum(1 for square in pattern if board[square] == opponent)
+            empty_count = sum(1 for square in pattern if board[square] == '')
+            if x_count == 2 and empty_count == 1 and move in pattern:
+                return "This move can block the opponent from winning"
+    for pattern in REFERENCE_WIN_PATTERNS:
+        o_count = sum(1 for square in pattern if board_copy[square] == player)
+        empty_count = sum(1 for square in pattern if board_copy[square] == '')
+        if o_count == 2 and empty_count == 1:
+            return "This move sets up a future win by creating 2 in a row"
+    return "This move is neutral"
+
+def reference_list_board_check_win(board, player):
+    win_conditions = [
+        [0, 1, 2], [3, 4, 5], [6, 7, 8],
+        [0, 3, 6], [1, 4, 7], [2, 5, 8],
+        [0, 4, 8], [2, 4, 6]
+    ]
+    return any(all(board[i] == player for i in condition) for condition in win_conditions)
+
+def all_legal_dict_boards():
+    """
+    All boards where X has the same number of pieces as O or one more, whether or not the game is over.
+    """
+    for cells in itertools.product(['', 'X', 'O'], repeat=9):
+        n_x = cells.count('X')
+        n_o = cells.count('O')
+        if n_x == n_o or n_x == n_o + 1:
+            yield dict(zip(bitboard.SQUARES_ALGEBRAIC, cells))
+
+class BitboardEquivalenceTests(SimpleTestCase):
+
+    def test_adapters_round_trip(self):
+        """
+        Test that converting a board to bitboards and back gives the same board, in both formats.
+        """
+        for board in all_legal_dict_boards():
+            x_mask, o_mask = bitboard.dict_board_to_bitboards(board)
+            self.assertEqual(bitboard.bitboards_to_dict_board(x_mask, o_mask), board)
+            list_board = [ board[square] or ' ' for square in bitboard.SQUARES_ALGEBRAIC ]
+            self.assertEqual(bitboard.list_board_to_bitboards(list_board), ( x_mask, o_mask ))
+            self.assertEqual(bitboard.bitboards_to_list_board(x_mask, o_mask), list_board)
+
+    def test_is_win_matches_list_board_check_win(self):
+        """
+        Test that the bitboard win check agrees with the list-based check used by the C-LARA engine.
+        """
+        for board in all_legal_dict_boards():
+            list_board = [ board[square] or ' ' for square in bitboard.SQUARES_ALGEBRAIC ]
+            x_mask, o_mask = bitboard.list_board_to_bitboards(list_board)
+            self.assertEqual(bitboard.is_win(x_mask), reference_list_board_check_win(list_board, 'X'))
+            self.assertEqual(bitboard.is_win(o_mask), reference_list_board_check_win(list_board, 'O'))
+
+    def test_check_win(self):
+        for board in all_legal_dict_boards():
+            self.assertEqual(check_win(board), reference_check_win(board))
+
+    def test_move_evaluation(self):
+        """
+        Test that the move scores and descriptions are the same as the ones from the reference versions.
+        """
+        for board in all_legal_dict_boards():
+            unoccupied = [ square for square in bitboard.SQUARES_ALGEBRAIC if board[square] == '' ]
+            for move in unoccupied:
+                for is_ai_turn in ( True, False ):
+                    self.assertEqual(evaluate_move_score(board, move, is_ai_turn),
+                                     reference_evaluate_move_score(board, move, is_ai_turn))
+                    self.assertEqual(evaluate_move_description(board, move, is_ai_turn),
+                                     reference_evaluate_move_description(board, move, is_ai_turn))
+            self.assertEqual(evaluate_all_moves(board, unoccupied, 'hard'),
+                             { move: reference_evaluate_move_score(board, move) for move in unoccupied })
+            self.assertEqual(evaluate_all_moves(board, unoccupied, 'medium'),
+                             { move: reference_evaluate_move_description(board, move) for move in unoccupied })
@@ -1,5 +1,19 @@
 import random, re
 from django.http import JsonResponse
+from ..bitboard import SQUARE_BITS, CENTER_MASK, CORNERS_MASK, N_LINES_COMPLETED
+from ..bitboard import dict_board_to_bitboards, squares_to_mask, empty_mask, count_lines, count_lines_through
+
+# Winning combinations as bitboard masks, in the order check_win tests them
+WINNING_COMBINATION_MASKS = [
+    squares_to_mask([6, 7, 8]),  # Top row
+    squares_to_mask([3, 4, 5]),  # Middle row
+    squares_to_mask([0, 1, 2]),  # Bottom row
+    squares_to_mask([6, 3, 0]),  # Left column
+    squares_to_mask([7, 4, 1]),  # Middle column
+    squares_to_mask([8, 5, 2]),  # Right column
+    squares_to_mask([6, 4, 2]),  # Left diagonal
+    squares_to_mask([8, 4, 0])   # Right diagonal
+]
 
 def check_win(board):
     """
@@ -15,22 +29,14 @@ def check_win(board):
     Returns:
         str or None: Returns 'X' or 'O' if there is a winner, otherwise returns None.
     """
-    # Define all possible winning combinations
-    winning_combinations = [
-        ['a3', 'b3', 'c3'],  # Top row
-        ['a2', 'b2', 'c2'],  # Middle row
-        ['a1', 'b1', 'c1'],  # Bottom row
-        ['a3', 'a2', 'a1'],  # Left column
-        ['b3', 'b2', 'b1'],  # Middle column
-        ['c3', 'c2', 'c1'],  # Right column
-        ['a3', 'b2', 'c1'],  # Left diagonal
-        ['c3', 'b2', 'a1']   # Right diagonal
-    ]
-
-    # Check each winning combination to see if all three positions are the same and not empty
-    for combo in winning_combinations:
-        if board[combo[0]] == board[combo[1]] and board[combo[1]] == board[combo[2]] and board[combo[0]] != '':
-            return board[combo[0]]  # Return 'X' or 'O' if we have a winner
+    x_mask, o_mask = dict_board_to_bitboards(board)
+
+    # Check each winning combination to see if all three positions belong to the same player
+    for combo_mask in WINNING_COMBINATION_MASKS:
+        if x_mask & combo_mask == combo_mask:
+            return 'X'
+        if o_mask & combo_mask == combo_mask:
+            return 'O'
     return None # No winner found
 
 def initialize_board():
@@ -228,52 +234,36 @@ def evaluate_move_score(board, move, is_ai_turn=True):
     Returns:
         int: The heuristic score of the move.
     """
+    x_mask, o_mask = dict_board_to_bitboards(board)
+    return evaluate_move_score_bits(x_mask, o_mask, move, is_ai_turn)
+
+def evaluate_move_score_bits(x_mask, o_mask, move, is_ai_turn=True):
+    """
+    Bitboard version of evaluate_move_score, for a board already converted with dict_board_to_bitboards.
+    """
     score = 0
-    player = 'O' if is_ai_turn else 'X'
-    opponent = 'X' if is_ai_turn else 'O'
-    
-    # Create a copy of the board with the move applied
-    board_copy = board.copy()
-    board_copy[move] = player  # Apply the current move to the copy
-
-    # Define winning patterns
-    win_patterns = [
-        ['a1', 'a2', 'a3'], 
-        ['b1', 'b2', 'b3'], 
-        ['c1', 'c2', 'c3'], 
-        ['a1', 'b1', 'c1'], 
-        ['a2', 'b2', 'c2'], 
-        ['a3', 'b3', 'c3'], 
-        ['a1', 'b2', 'c3'], 
-        ['a3', 'b2', 'c1']  
-    ]
+    own, other = ( o_mask, x_mask ) if is_ai_turn else ( x_mask, o_mask )
+    move_bit = SQUARE_BITS[move]
+
+    # The board with the move applied
+    own_after = own | move_bit
+    other_after = other & ~move_bit
     
     # Check if the move results in a win
-    for pattern in win_patterns:
-        if all(board_copy[square] == player for square in pattern):
-            score += 100  # High score for winning move
+    score += 100 * N_LINES_COMPLETED[own_after]  # High score for winning move
 
-    # Check if the move blocks the opponent from winning
+    # Check if the move blocks the opponent from winning, i.e. 'X' (opponent) has two out of three in a winning pattern
     if is_ai_turn:
-        for pattern in win_patterns:
-            # Check if 'X' (opponent) has two out of three in a winning pattern and block them
-            x_count = sum(1 for square in pattern if board[square] == opponent)
-            empty_count = sum(1 for square in pattern if board[square] == '')
-            if x_count == 2 and empty_count == 1 and move in pattern:
-                score += 50  # High score for blocking the opponent's winning move
+        score += 50 * count_lines_through(move_bit, other, empty_mask(own, other), 2, 1)
     
     # Additional heuristic: prioritize center and corners
-    if move == 'b2':
+    if move_bit & CENTER_MASK:
         score += 10  # Center is a good strategic position
-    elif move in ['a3', 'c3', 'a1', 'c1']:
+    elif move_bit & CORNERS_MASK:
         score += 5  # Corners are valuable positions
 
     # New heuristic: check if the move creates two-in-a-row for the AI with an empty square for a future win
-    for pattern in win_patterns:
-        o_count = sum(1 for square in pattern if board_copy[square] == player)
-        empty_count = sum(1 for square in pattern if board_copy[square] == '')
-        if o_count == 2 and empty_count == 1:
-            score += 25  # Reward moves that set up a future win (two in a row with one empty)
+    score += 25 * count_lines(own_after, empty_mask(own_after, other_after), 2, 1)
 
     return score
 
@@ -289,42 +279,29 @@ def evaluate_move_description(board, move, is_ai_turn=True):
     Returns:
         str: A string description of the move's nature.
     """
-    player = 'O' if is_ai_turn else 'X'
-    opponent = 'X' if is_ai_turn else 'O'
-    # Create a copy of the board with the move applied
-    board_copy = board.copy()
-    board_copy[move] = player
-    
-    # Define winning patterns
-    win_patterns = [
-        ['a1', 'a2', 'a3'], 
-        ['b1', 'b2', 'b3'], 
-        ['c1', 'c2', 'c3'], 
-        ['a1', 'b1', 'c1'], 
-        ['a2', 'b2', 'c2'], 
-        ['a3', 'b3', 'c3'], 
-        ['a1', 'b2', 'c3'], 
-        ['a3', 'b2', 'c1']  
-    ]
+    x_mask, o_mask = dict_board_to_bitboards(board)
+    return evaluate_move_description_bits(x_mask, o_mask, move, is_ai_turn)
+
+def evaluate_move_description_bits(x_mask, o_mask, move, is_ai_turn=True):
+    """
+    Bitboard version of evaluate_move_description, for a board already converted with dict_board_to_bitboards.
+    """
+    own, other = ( o_mask, x_mask ) if is_ai_turn else ( x_mask, o_mask )
+    move_bit = SQUARE_BITS[move]
+
+    # The board with the move applied
+    own_after = own | move_bit
+    other_after = other & ~move_bit
     
     # Check if the move results in a win for AI or player
-    for pattern in win_patterns:
-        if all(board_copy[square] == ('O' if is_ai_turn else 'X') for square in pattern):
-            return "This move can help you win" if is_ai_turn else "This move can help the opponent win"
+    if N_LINES_COMPLETED[own_after]:
+        return "This move can help you win" if is_ai_turn else "This move can help the opponent win"
     # Check if the move blocks the opponent from winning
-    if is_ai_turn:
-        for pattern in win_patterns:
-            # Check if 'X' (opponent) has two out of three in a winning pattern and block them
-            x_count = sum(1 for square in pattern if board[square] == opponent)
-            empty_count = sum(1 for square in pattern if board[square] == '')
-            if x_count == 2 and empty_count == 1 and move in pattern:
-                return "This move can block the opponent from winning"
+    if is_ai_turn and count_lines_through(move_bit, other, empty_mask(own, other), 2, 1):
+        return "This move can block the opponent from winning"
     
-    for pattern in win_patterns:
-        o_count = sum(1 for square in pattern if board_copy[square] == player)
-        empty_count = sum(1 for square in pattern if board_copy[square] == '')
-        if o_count == 2 and empty_count == 1:
-            return "This move sets up a future win by creating 2 in a row"
+    if count_lines(own_after, empty_mask(own_after, other_after), 2, 1):
+        return "This move sets up a future win by creating 2 in a row"
     
     # Default description for other moves
     return "This move is neutral"
@@ -340,12 +317,14 @@ def evaluate_all_moves(board, unoccupied, level='medium'):
     Returns:
         dict: A dictionary where keys are unoccupied squares and values are their heuristic scores.
     """
+    # Convert the board once, rather than once per move
+    x_mask, o_mask = dict_board_to_bitboards(board)
     move_characteristics = {}
     for move in unoccupied:
         if level == 'hard':
-            score = evaluate_move_score(board, move)
+            score = evaluate_move_score_bits(x_mask, o_mask, move)
         else:
-            score = evaluate_move_description(board, move)
+            score = evaluate_move_description_bits(x_mask, o_mask, move)
         move_characteristics[move] = score
     return move_characteristics
 